@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+"""
+解析ホットパスのオフライン・マイクロベンチマーク
+
+ネットワークには一切触れず、bench/fixtures/ の固定データだけを使う。
+関数ごとに実行時間（min/median/mean）と、1回あたりのメモリ確保量
+（tracemallocのピーク・呼び出し後に残った確保量）を測り、JSONで保存する。
+
+  python bench/bench_parsers.py                      # 計測して bench/results/<commit>.json に保存
+  python bench/bench_parsers.py --filter jpx         # 名前に jpx を含むケースだけ
+  python bench/bench_parsers.py --compare old.json new.json
+"""
+
+from __future__ import annotations
+
+import argparse
+import csv
+import gc
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable
+
+ROOT = Path(__file__).resolve().parent.parent
+FIXTURES = Path(__file__).resolve().with_name("fixtures")
+RESULTS = Path(__file__).resolve().with_name("results")
+sys.path.insert(0, str(ROOT))
+
+import pandas as pd  # noqa: E402
+
+import scraper  # noqa: E402
+
+
+def _read_rows(name: str) -> list[list[str]]:
+    with open(FIXTURES / name, "r", encoding="utf-8-sig", newline="") as file:
+        return list(csv.reader(file))
+
+
+def _read_yahoo(name: str) -> pd.DataFrame:
+    return pd.read_csv(FIXTURES / name, index_col="Date", parse_dates=True)
+
+
+@contextmanager
+def _fixture_csv(rows: list[list[str]]):
+    """fetch_opinc_yoy の get_csv をフィクスチャ応答に差し替える。"""
+    original = scraper.get_csv
+    scraper.get_csv = lambda code, path: rows
+    try:
+        yield
+    finally:
+        scraper.get_csv = original
+
+
+@contextmanager
+def _quiet():
+    """[DEBUG-25MA] 等の標準出力を計測対象から外す。"""
+    original = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = original
+
+
+def build_cases() -> dict[str, Callable[[], Any]]:
+    pl_rows = _read_rows("irbank_pl_horizontal.csv")
+    all_rows = _read_rows("irbank_all_horizontal.csv")
+    all_text = (FIXTURES / "irbank_all_horizontal.csv").read_text(encoding="utf-8-sig")
+    vertical_rows = _read_rows("irbank_vertical.csv")
+    dividend_rows = _read_rows("irbank_dividend.csv")
+    qq_rows = _read_rows("irbank_qq_yoy.csv")
+
+    cells = [cell for row in all_rows for cell in row]
+    labels = [cell for cell in all_rows[0]] + [row[0] for row in vertical_rows]
+
+    pdf_bytes = (FIXTURES / "jpx_margin.pdf").read_bytes()
+    jpx_payloads = {
+        kind: (FIXTURES / f"jpx_margin.{kind}").read_bytes()
+        for kind in ("xlsx", "csv", "zip")
+    }
+    jpx_frames = {
+        kind: scraper._read_jpx_payload(f"https://example.invalid/margin.{kind}", "", payload)[0]
+        for kind, payload in jpx_payloads.items()
+    }
+    jpx_html = (FIXTURES / "jpx_margin_page.html").read_text(encoding="utf-8")
+
+    yahoo_plain = _read_yahoo("yahoo_nosplit.csv")
+    yahoo_split = _read_yahoo("yahoo_split.csv")
+    expected = yahoo_plain.index.max().date()
+    yahoo_split_work = scraper._prepare_yahoo_frame("0000", yahoo_split)
+
+    listed_rows = [
+        {
+            "code": str(1300 + index),
+            "name": f"Company{1300 + index}",
+            "segment": "プライム(内国株式)",
+            "sector_code": "3650",
+            "sector": "電気機器",
+        }
+        for index in range(4400)
+    ]
+    listed_path = Path(tempfile.mkdtemp()) / "listed_index.tsv"
+    scraper._write_listed_index(listed_path, listed_rows, {"as_of": "20260101"})
+
+    margin_archive = pd.DataFrame(
+        {
+            "publication_date": pd.to_datetime("2026-01-02")
+            + pd.to_timedelta([7 * (index // 4000) for index in range(4 * 4000)], unit="D"),
+            "code": [str(1300 + index % 4000) for index in range(4 * 4000)],
+            "short": [(index * 7919) % 3_000_000 for index in range(4 * 4000)],
+            "long": [(index * 104729) % 9_000_000 for index in range(4 * 4000)],
+        }
+    )
+
+    fundamentals_sample = pd.concat(
+        [
+            scraper.fundamentals_long("0000", scraper.CSV_PL, pl_rows),
+            scraper.fundamentals_long("0000", scraper.CSV_DIV, dividend_rows),
+        ],
+        ignore_index=True,
+    )
+    fundamentals_store = pd.concat(
+        [fundamentals_sample.assign(code=str(1300 + index)) for index in range(4000)],
+        ignore_index=True,
+    )
+
+    def run_cells(function):
+        return lambda: [function(cell) for cell in cells]
+
+    def opinc_with_fixture():
+        with _fixture_csv(qq_rows):
+            return scraper.fetch_opinc_yoy("0000")
+
+    cases: dict[str, Callable[[], Any]] = {
+        "safe_float.all_csv_cells": run_cells(scraper.safe_float),
+        "coerce_numeric.all_csv_cells": lambda: scraper.coerce_numeric(cells),
+        "_norm_label.headers": lambda: [scraper._norm_label(label) for label in labels],
+        "read_csv_rows.all_horizontal": lambda: scraper.read_csv_rows(io.StringIO(all_text)),
+        "read_csv_rows.all_horizontal.full": lambda: list(csv.reader(io.StringIO(all_text))),
+        "metric_value.horizontal_pl.eps": lambda: scraper.metric_value(pl_rows, scraper.EPS_KEYS),
+        "metric_value.horizontal_all.equity": lambda: scraper.metric_value(all_rows, scraper.EQ_KEYS),
+        "metric_value.horizontal_all.missing": lambda: scraper.metric_value(all_rows, scraper.DPS_KEYS),
+        "metric_value.vertical.bps": lambda: scraper.metric_value(vertical_rows, scraper.BPS_KEYS),
+        "dividend_per_share.dividend_csv": lambda: scraper.dividend_per_share(dividend_rows),
+        "dividend_per_share.fallback_scan": lambda: scraper.dividend_per_share(all_rows),
+        "fetch_opinc_yoy.qq_csv": opinc_with_fixture,
+        "_candidate_urls_from_html.jpx_page": lambda: scraper._candidate_urls_from_html(
+            jpx_html,
+            scraper.JPX_MARGIN_PAGE,
+        ),
+        "_parse_jpx_pdf_balances.pdf": lambda: scraper._parse_jpx_pdf_balances(pdf_bytes),
+        "_read_listed_index.4400": lambda: scraper._read_listed_index(listed_path),
+        "filter_listed_index.sector": lambda: scraper.filter_listed_index(
+            listed_rows,
+            segments="内国株式",
+            sectors="3650,銀行業",
+        ),
+        "margin_trend_metrics.4w_4000": lambda: scraper.margin_trend_metrics(margin_archive),
+        "fundamentals_long.horizontal_all": lambda: scraper.fundamentals_long("0000", scraper.CSV_ALL, all_rows),
+        "fundamental_metrics.5y_4000": lambda: scraper.fundamental_metrics(fundamentals_store),
+        "yahoo_metrics.no_split": lambda: scraper.yahoo_metrics("0000", yahoo_plain, expected),
+        "yahoo_metrics.split_in_window": lambda: scraper.yahoo_metrics("0000", yahoo_split, expected),
+        "compute_indicators.split_in_window": lambda: scraper.compute_indicators(yahoo_split_work),
+        "price_metric_series.split_in_window": lambda: scraper.price_metric_series(yahoo_split_work),
+    }
+    for kind, payload in jpx_payloads.items():
+        cases[f"_read_jpx_payload.{kind}"] = (
+            lambda payload=payload, kind=kind: scraper._read_jpx_payload(
+                f"https://example.invalid/margin.{kind}",
+                "",
+                payload,
+            )
+        )
+    for kind, frame in jpx_frames.items():
+        cases[f"_parse_jpx_frame_balances.{kind}"] = lambda frame=frame: scraper._parse_jpx_frame_balances(frame)
+    return cases
+
+
+def measure(
+    function: Callable[[], Any],
+    *,
+    min_time: float,
+    max_repeat: int,
+) -> dict[str, Any]:
+    with _quiet():
+        function()  # ウォームアップ
+
+        timings: list[float] = []
+        total_start = time.perf_counter()
+        gc.collect()
+        gc.disable()
+        try:
+            while len(timings) < max_repeat and (
+                len(timings) < 3 or time.perf_counter() - total_start < min_time
+            ):
+                start = time.perf_counter()
+                function()
+                timings.append(time.perf_counter() - start)
+        finally:
+            gc.enable()
+
+        # 確保量は時間計測と分けて1回だけ測る（tracemallocは実行を遅くする）。
+        gc.collect()
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot()
+        baseline, _ = tracemalloc.get_traced_memory()
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+
+    differences = after.compare_to(before, "filename")
+    retained_blocks = sum(max(0, diff.count_diff) for diff in differences)
+    retained_bytes = sum(diff.size_diff for diff in differences)
+
+    return {
+        "repeat": len(timings),
+        "min_s": min(timings),
+        "median_s": statistics.median(timings),
+        "mean_s": statistics.fmean(timings),
+        "stdev_s": statistics.stdev(timings) if len(timings) > 1 else 0.0,
+        "peak_alloc_bytes": max(0, peak - baseline),
+        "retained_bytes": retained_bytes,
+        "retained_blocks": retained_blocks,
+    }
+
+
+def _git_commit() -> str:
+    try:
+        return (
+            subprocess.run(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=ROOT,
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout.strip()
+            or "unknown"
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run(args: argparse.Namespace) -> int:
+    cases = build_cases()
+    selected = {
+        name: function
+        for name, function in cases.items()
+        if not args.filter or any(token in name for token in args.filter)
+    }
+    if not selected:
+        print(f"[FATAL] no benchmark matches filter={args.filter}", flush=True)
+        return 1
+
+    commit = _git_commit()
+    results: dict[str, Any] = {}
+    for name, function in selected.items():
+        result = measure(function, min_time=args.min_time, max_repeat=args.max_repeat)
+        results[name] = result
+        print(
+            f"{name:<45} median={result['median_s'] * 1e3:9.3f}ms "
+            f"min={result['min_s'] * 1e3:9.3f}ms "
+            f"peak={result['peak_alloc_bytes'] / 1024:9.1f}KiB "
+            f"n={result['repeat']}",
+            flush=True,
+        )
+
+    payload = {
+        "meta": {
+            "commit": commit,
+            "script_version": scraper.SCRIPT_VERSION,
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "platform": platform.platform(),
+        },
+        "results": results,
+    }
+    output = Path(args.output) if args.output else RESULTS / f"{commit}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(payload, indent=2, ensure_ascii=False) + "\n", encoding="utf-8")
+    print(f"results written: {output}", flush=True)
+    return 0
+
+
+def compare(old_path: str, new_path: str, threshold: float) -> int:
+    old = json.loads(Path(old_path).read_text(encoding="utf-8"))
+    new = json.loads(Path(new_path).read_text(encoding="utf-8"))
+    print(
+        f"old={old['meta'].get('commit')} new={new['meta'].get('commit')} "
+        f"(ratio = new/old, median time)",
+        flush=True,
+    )
+
+    regressions = 0
+    for name in sorted(set(old["results"]) | set(new["results"])):
+        before = old["results"].get(name)
+        after = new["results"].get(name)
+        if before is None or after is None:
+            print(f"{name:<45} {'only in old' if after is None else 'only in new'}")
+            continue
+        ratio = after["median_s"] / before["median_s"] if before["median_s"] else float("inf")
+        peak_ratio = (
+            after["peak_alloc_bytes"] / before["peak_alloc_bytes"]
+            if before["peak_alloc_bytes"]
+            else float("nan")
+        )
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  SLOWER"
+            regressions += 1
+        elif ratio < 1 - threshold:
+            flag = "  faster"
+        print(
+            f"{name:<45} {before['median_s'] * 1e3:9.3f}ms -> {after['median_s'] * 1e3:9.3f}ms "
+            f"x{ratio:5.2f} peak x{peak_ratio:5.2f}{flag}"
+        )
+    return 1 if regressions else 0
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="offline parser micro-benchmarks")
+    parser.add_argument("--output", help="結果JSONの保存先（既定: bench/results/<commit>.json）")
+    parser.add_argument("--filter", action="append", help="ケース名の部分一致（複数可）")
+    parser.add_argument("--min-time", type=float, default=0.5, help="ケースごとの最小計測秒数")
+    parser.add_argument("--max-repeat", type=int, default=200)
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    parser.add_argument("--threshold", type=float, default=0.10, help="回帰とみなす中央値の悪化率")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        return compare(args.compare[0], args.compare[1], args.threshold)
+    return run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
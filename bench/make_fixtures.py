@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+"""
+ベンチマーク用フィクスチャ生成スクリプト
+
+IRBANK / JPX / Yahoo Finance の実レイアウトを模した固定データを
+bench/fixtures/ に書き出す。乱数は固定シードなので、何度実行しても
+同じ内容になる（XLSXはopenpyxlが作成日時を埋め込むため、バイト列だけ変わる）。
+
+  python bench/make_fixtures.py
+"""
+
+from __future__ import annotations
+
+import csv
+import io
+import random
+import sys
+import zipfile
+from datetime import date, timedelta
+from pathlib import Path
+
+import pandas as pd
+
+FIXTURES = Path(__file__).resolve().with_name("fixtures")
+SEED = 20260725
+FIXED_ZIP_TIME = (2026, 7, 24, 18, 0, 0)
+
+
+def _codes(count: int) -> list[str]:
+    rng = random.Random(SEED)
+    codes: set[str] = set()
+    while len(codes) < count:
+        number = rng.randint(1300, 9999)
+        if rng.random() < 0.05:
+            codes.add(f"{number // 10:03d}A")
+        else:
+            codes.add(str(number))
+    return sorted(codes)
+
+
+def _signed(rng: random.Random, low: float, high: float, digits: int = 1) -> str:
+    value = round(rng.uniform(low, high), digits)
+    if value < 0:
+        # IRBANKは負数を△表記する列がある。
+        return f"△{abs(value):,.{digits}f}"
+    return f"{value:,.{digits}f}"
+
+
+# ====== IRBANK CSV ======
+def irbank_horizontal_rows(years: int = 30, extra_columns: int = 0) -> list[list[str]]:
+    """年度が行、項目が列に並ぶ形式（fy-*.csv の現行レイアウト）。"""
+    rng = random.Random(SEED + years + extra_columns)
+    header = [
+        "年度",
+        "売上高",
+        "営業利益",
+        "経常利益",
+        "当期純利益",
+        "EPS",
+        "ROE",
+        "BPS",
+        "自己資本",
+        "総資産",
+        "自己資本比率",
+    ] + [f"項目{index}" for index in range(extra_columns)]
+    rows = [header]
+    for offset in range(years):
+        year = 2026 - years + offset
+        row = [f"{year}/03"]
+        row.append(f"{rng.randint(10_000, 900_000) * 1_000_000:,}")
+        row.extend(_signed(rng, -5e9, 9e10, 0) for _ in range(3))
+        row.append(_signed(rng, -50, 400, 2))
+        row.append(_signed(rng, -10, 30, 2))
+        row.append(f"{rng.uniform(100, 5000):,.2f}")
+        row.append(f"{rng.randint(10_000, 900_000) * 1_000_000:,}")
+        row.append(f"{rng.randint(50_000, 1_900_000) * 1_000_000:,}")
+        row.append(f"{rng.uniform(10, 90):.1f}")
+        row.extend(_signed(rng, -1e6, 1e6, 0) for _ in range(extra_columns))
+        rows.append(row)
+    # 最新年度は予想値が未記入のことがある。
+    rows.append(["2026/03 予"] + ["-"] * (len(header) - 1))
+    return rows
+
+
+def irbank_vertical_rows(years: int = 12) -> list[list[str]]:
+    """項目が行、年度が列に並ぶ形式（旧レイアウト）。"""
+    rng = random.Random(SEED - years)
+    periods = [f"{2026 - years + offset}/03" for offset in range(years)]
+    labels = [
+        "売上高",
+        "営業利益",
+        "当期純利益",
+        "1株当たり当期純利益（円）",
+        "1株当たり純資産（円）",
+        "自己資本",
+        "総資産",
+        "ROE（％）",
+    ]
+    rows = [["項目"] + periods]
+    for label in labels:
+        values = [_signed(rng, -1e4, 1e6, 1) for _ in periods]
+        values[-1] = "-"
+        rows.append([label] + values)
+    return rows
+
+
+def irbank_dividend_rows(years: int = 30) -> list[list[str]]:
+    rng = random.Random(SEED + 7)
+    rows = [
+        ["配当", "", "", ""],
+        ["年度", "中間", "期末", "合計"],
+    ]
+    for offset in range(years):
+        first = round(rng.uniform(0, 60), 1)
+        second = round(rng.uniform(0, 60), 1)
+        rows.append([f"{2026 - years + offset}/03", str(first), str(second), str(round(first + second, 1))])
+    return rows
+
+
+def irbank_quarterly_yoy_rows(quarters: int = 80) -> list[list[str]]:
+    rng = random.Random(SEED + 11)
+    rows = [["期間", "前年同期比"]]
+    for offset in range(quarters):
+        year = 2026 - quarters // 4 + offset // 4
+        rows.append([f"{year}/{(offset % 4) * 3 + 3:02d}", _signed(rng, -95, 300, 1)])
+    return rows
+
+
+def _write_csv(path: Path, rows: list[list[str]]) -> None:
+    with open(path, "w", encoding="utf-8-sig", newline="") as file:
+        csv.writer(file).writerows(rows)
+
+
+# ====== JPX 信用残高 ======
+def jpx_balance_records(count: int) -> list[tuple[str, str, int, int, int, int]]:
+    rng = random.Random(SEED + count)
+    records = []
+    for code in _codes(count):
+        short = rng.randint(0, 3_000_000)
+        long = rng.randint(0, 9_000_000)
+        records.append(
+            (
+                code,
+                f"銘柄{code}",
+                short,
+                rng.randint(-200_000, 200_000),
+                long,
+                rng.randint(-200_000, 200_000),
+            )
+        )
+    return records
+
+
+def _pdf_escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def text_pdf_bytes(lines: list[str], lines_per_page: int = 64) -> bytes:
+    """Helveticaの本文行だけを持つ最小構成のPDFを組み立てる。"""
+    pages = [lines[start : start + lines_per_page] for start in range(0, len(lines), lines_per_page)]
+    objects: list[bytes] = []
+
+    page_ids = [3 + index * 2 for index in range(len(pages))]
+    font_id = 3 + len(pages) * 2
+    objects.append(b"<< /Type /Catalog /Pages 2 0 R >>")
+    kids = " ".join(f"{page_id} 0 R" for page_id in page_ids)
+    objects.append(f"<< /Type /Pages /Kids [{kids}] /Count {len(pages)} >>".encode())
+
+    for page_id, page_lines in zip(page_ids, pages):
+        stream_lines = ["BT", "/F1 8 Tf", "10 TL", "24 812 Td"]
+        for line in page_lines:
+            stream_lines.append(f"({_pdf_escape(line)}) Tj T*")
+        stream_lines.append("ET")
+        stream = "\n".join(stream_lines).encode("latin-1")
+        objects.append(
+            (
+                f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                f"/Resources << /Font << /F1 {font_id} 0 R >> >> "
+                f"/Contents {page_id + 1} 0 R >>"
+            ).encode()
+        )
+        objects.append(
+            f"<< /Length {len(stream)} >>\nstream\n".encode() + stream + b"\nendstream"
+        )
+
+    objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+    output = io.BytesIO()
+    output.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(output.tell())
+        output.write(f"{number} 0 obj\n".encode() + body + b"\nendobj\n")
+    xref_offset = output.tell()
+    output.write(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode())
+    for offset in offsets:
+        output.write(f"{offset:010d} 00000 n \n".encode())
+    output.write(
+        f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode()
+    )
+    return output.getvalue()
+
+
+def jpx_pdf_lines(records) -> list[str]:
+    lines = [
+        "Outstanding Margin Trading (Application Basis) 2026/07/24",
+        "Name Code ISIN Short Change Long Change",
+    ]
+    for code, _, short, short_change, long, long_change in records:
+        new_code = f"{code}0"
+        isin = f"JP3{new_code}0000"
+        short_text = f"{short_change:,}" if short_change >= 0 else f"-{abs(short_change):,}"
+        lines.append(
+            f"Company{code} {new_code} {isin} {short:,} {short_text} {long:,} {long_change:,}"
+        )
+    return lines
+
+
+def jpx_frame(records) -> pd.DataFrame:
+    rows: list[list[object]] = [
+        ["銘柄別信用取引週末残高", None, None, None, None, None, None],
+        ["2026年7月24日申込現在", None, None, None, None, None, None],
+        [None, None, None, "売残高", None, "買残高", None],
+        ["銘柄名", "コード", "市場", "合計", "前週比", "合計", "前週比"],
+    ]
+    for code, name, short, short_change, long, long_change in records:
+        rows.append([name, f"{code}0", "プライム", short, short_change, long, long_change])
+    return pd.DataFrame(rows)
+
+
+def _zip_bytes(name: str, payload: bytes) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        info = zipfile.ZipInfo(name, date_time=FIXED_ZIP_TIME)
+        info.compress_type = zipfile.ZIP_DEFLATED
+        archive.writestr(info, payload)
+    return buffer.getvalue()
+
+
+def _xlsx_bytes(frame: pd.DataFrame) -> bytes:
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
+        frame.to_excel(writer, header=False, index=False)
+    return buffer.getvalue()
+
+
+def jpx_html(attachments: list[str]) -> str:
+    rows = []
+    for index, name in enumerate(attachments):
+        day = date(2026, 7, 24) - timedelta(days=7 * index)
+        rows.append(
+            f'<tr><td>{day:%Y年%m月%d日}</td><td>銘柄別信用取引週末残高</td>'
+            f'<td><a href="/markets/statistics-equities/margin/tvdivq0000001rnl-att/{name}">'
+            f"{name}</a></td></tr>"
+        )
+    filler = "".join(
+        f'<li><a href="/news/{index}.html">お知らせ {index}</a>'
+        f'<img src="/common/images/icon{index}.png"></li>'
+        for index in range(200)
+    )
+    return (
+        "<!DOCTYPE html><html><head>"
+        '<link rel="stylesheet" href="/common/css/base.css">'
+        '<script src="/common/js/base.js"></script></head><body>'
+        f"<ul>{filler}</ul>"
+        '<section><h2>銘柄別信用取引週末残高</h2><table>'
+        + "".join(rows)
+        + "</table></section>"
+        "<script>var files = {\"latest\": \"\\/markets\\/statistics-equities\\/margin\\/"
+        "tvdivq0000001rnl-att\\/syumatsu2026072400.pdf\"};</script>"
+        "</body></html>"
+    )
+
+
+# ====== Yahoo Finance ======
+def yahoo_frame(sessions: int = 490, split_offset: int | None = None) -> pd.DataFrame:
+    rng = random.Random(SEED + sessions + (split_offset or 0))
+    index = pd.bdate_range(end=pd.Timestamp(2026, 7, 24), periods=sessions)
+    closes: list[float] = []
+    price = 2400.0
+    split_position = sessions - split_offset if split_offset else None
+    for position in range(sessions):
+        if position == split_position:
+            price /= 2
+        price *= 1 + rng.uniform(-0.03, 0.031)
+        closes.append(round(price, 1))
+    frame = pd.DataFrame(
+        {
+            "Open": [value * 0.995 for value in closes],
+            "High": [value * 1.012 for value in closes],
+            "Low": [value * 0.988 for value in closes],
+            "Close": closes,
+            "Adj Close": closes,
+            "Volume": [float(rng.randint(10_000, 3_000_000)) for _ in closes],
+            "Dividends": [0.0] * sessions,
+            "Stock Splits": [0.0] * sessions,
+        },
+        index=index,
+    )
+    frame.index.name = "Date"
+    frame.iloc[sessions - 130, frame.columns.get_loc("Dividends")] = 25.0
+    frame.iloc[sessions - 10, frame.columns.get_loc("Dividends")] = 27.5
+    if split_position is not None:
+        frame.iloc[split_position, frame.columns.get_loc("Stock Splits")] = 2.0
+    return frame
+
+
+def main() -> int:
+    FIXTURES.mkdir(parents=True, exist_ok=True)
+
+    _write_csv(FIXTURES / "irbank_pl_horizontal.csv", irbank_horizontal_rows(30))
+    _write_csv(FIXTURES / "irbank_all_horizontal.csv", irbank_horizontal_rows(40, extra_columns=60))
+    _write_csv(FIXTURES / "irbank_vertical.csv", irbank_vertical_rows(12))
+    _write_csv(FIXTURES / "irbank_dividend.csv", irbank_dividend_rows(30))
+    _write_csv(FIXTURES / "irbank_qq_yoy.csv", irbank_quarterly_yoy_rows(80))
+
+    records = jpx_balance_records(600)
+    (FIXTURES / "jpx_margin.pdf").write_bytes(text_pdf_bytes(jpx_pdf_lines(records)))
+    frame = jpx_frame(records)
+    (FIXTURES / "jpx_margin.xlsx").write_bytes(_xlsx_bytes(frame))
+    csv_bytes = frame.to_csv(header=False, index=False).encode("cp932")
+    (FIXTURES / "jpx_margin.csv").write_bytes(csv_bytes)
+    (FIXTURES / "jpx_margin.zip").write_bytes(_zip_bytes("syumatsu20260724.csv", csv_bytes))
+    (FIXTURES / "jpx_margin_page.html").write_text(
+        jpx_html([f"syumatsu2026{month:02d}{day:02d}00.pdf" for month, day in ((7, 24), (7, 17), (7, 10), (7, 3))]),
+        encoding="utf-8",
+    )
+
+    yahoo_frame(490).to_csv(FIXTURES / "yahoo_nosplit.csv")
+    yahoo_frame(490, split_offset=12).to_csv(FIXTURES / "yahoo_split.csv")
+
+    for path in sorted(FIXTURES.iterdir()):
+        print(f"{path.name} {path.stat().st_size}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,518 @@
+# -*- coding: utf-8 -*-
+"""
+IRBANK / JPX / Yahoo Finance の代替サーバー（負荷試験用）
+
+任意件数の合成ユニバースに対して、scraper.py が叩く3系統の応答を返す。
+  /irbank/files/{code}/{path}                  IRBANK配布CSV
+  /jpx/markets/statistics-equities/margin/05.html（英語版も）と添付PDF
+  /yahoo/v8/finance/chart/{symbol}             Yahoo chart API（日足JSON）
+  /stooq/q/d/l/?s={code}.jp                    Stooq日足CSV（Yahooと同じ系列）
+  /jpx/markets/statistics-equities/misc/...att/data_j.xls  上場銘柄一覧（ETag/304対応）
+
+レイテンシ分布、404/429/5xx の発生率、本文の低速送信を設定できる。
+
+  python bench/upstream_server.py --universe 4000 --write-tickers /tmp/tickers.txt \\
+      --latency lognormal:80,0.6 --p429 0.02 --p5xx 0.01
+
+  TICKERS_FILE=/tmp/tickers.txt POLITE_SLEEP_SCALE=0 \\
+  IRBANK_BASE_URL=http://127.0.0.1:8765/irbank \\
+  JPX_BASE_URL=http://127.0.0.1:8765/jpx \\
+  YAHOO_CHART_BASE_URL=http://127.0.0.1:8765/yahoo \\
+  STOOQ_BASE_URL=http://127.0.0.1:8765/stooq \\
+  python scraper.py
+
+/__stats で経路・ステータス別の件数とレイテンシ分位をJSONで返す。
+"""
+
+from __future__ import annotations
+
+import argparse
+import bisect
+import csv
+import hashlib
+import io
+import json
+import math
+import random
+import re
+import socket
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import date, datetime, time as dt_time, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import scraper  # noqa: E402
+from make_fixtures import text_pdf_bytes  # noqa: E402
+
+JPX_ATTACHMENT_DIR = "/markets/statistics-equities/margin/tvdivq0000001rnl-att/"
+JPX_LISTED_PATH = "/markets/statistics-equities/misc/tvdivq0000001vg2-att/data_j.xls"
+LISTED_SEGMENTS = ["プライム（内国株式）", "スタンダード（内国株式）", "グロース（内国株式）", "ETF・ETN"]
+LISTED_SECTORS = [
+    ("0050", "水産・農林業"),
+    ("3050", "食料品"),
+    ("3650", "電気機器"),
+    ("3700", "輸送用機器"),
+    ("5250", "情報・通信業"),
+    ("6100", "小売業"),
+    ("7050", "銀行業"),
+    ("9050", "サービス業"),
+]
+RANGE_SESSIONS = {
+    "1d": 1,
+    "5d": 5,
+    "1mo": 22,
+    "3mo": 64,
+    "6mo": 125,
+    "1y": 245,
+    "2y": 490,
+    "5y": 1225,
+    "max": 2500,
+}
+
+
+def synthetic_codes(count: int) -> list[str]:
+    """4桁数字コードを先に使い切り、足りなければ英字入りコードを足す。"""
+    codes = [str(1300 + index) for index in range(min(count, 8700))]
+    letters = "ACDFGHJKLMNPRSTUWXY"
+    index = 0
+    while len(codes) < count:
+        codes.append(f"{130 + index % 870:03d}{letters[index // 870 % len(letters)]}")
+        index += 1
+    return codes
+
+
+def _rng(*parts: object) -> random.Random:
+    digest = hashlib.sha256("|".join(str(part) for part in parts).encode()).digest()
+    return random.Random(int.from_bytes(digest[:8], "big"))
+
+
+# ====== 応答本文 ======
+def irbank_csv(code: str, path: str) -> bytes | None:
+    rng = _rng("irbank", code, path)
+    years = 25 if path != scraper.CSV_ALL else 40
+    rows: list[list[str]]
+
+    if path == scraper.CSV_QQ:
+        rows = [["期間", "前年同期比"]]
+        for offset in range(80):
+            value = round(rng.uniform(-90, 250), 1)
+            text = f"△{abs(value)}" if value < 0 else str(value)
+            rows.append([f"{2006 + offset // 4}/{(offset % 4) * 3 + 3:02d}", text])
+    elif path == scraper.CSV_DIV:
+        rows = [["配当", "", "", ""], ["年度", "中間", "期末", "合計"]]
+        for offset in range(years):
+            first, second = round(rng.uniform(0, 50), 1), round(rng.uniform(0, 50), 1)
+            rows.append([f"{2001 + offset}/03", str(first), str(second), str(round(first + second, 1))])
+    elif path in (scraper.CSV_PL, scraper.CSV_BS, scraper.CSV_PS, scraper.CSV_ALL):
+        header = ["年度", "売上高", "当期純利益", "EPS", "BPS", "自己資本", "総資産", "ROE", "自己資本比率", "DPS"]
+        if path == scraper.CSV_ALL:
+            header += [f"項目{index}" for index in range(60)]
+        rows = [header]
+        for offset in range(years):
+            equity = rng.randint(10_000, 900_000) * 1_000_000
+            row = [
+                f"{2026 - years + offset}/03",
+                f"{rng.randint(10_000, 900_000) * 1_000_000:,}",
+                f"{rng.randint(-5_000, 90_000) * 1_000_000:,}",
+                f"{rng.uniform(-20, 400):.2f}",
+                f"{rng.uniform(100, 5000):.2f}",
+                f"{equity:,}",
+                f"{int(equity * rng.uniform(1.2, 4)):,}",
+                f"{rng.uniform(-5, 25):.2f}",
+                f"{rng.uniform(10, 85):.1f}",
+                f"{rng.uniform(0, 120):.1f}",
+            ]
+            row += [f"{rng.randint(-10**6, 10**6):,}" for _ in header[len(row):]]
+            rows.append(row)
+    else:
+        return None
+
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator="\n").writerows(rows)
+    return buffer.getvalue().encode("utf-8-sig")
+
+
+def jpx_page(prefix: str, publications: list[date]) -> bytes:
+    links = "".join(
+        f'<tr><td>{day:%Y年%m月%d日}</td><td>銘柄別信用取引週末残高</td>'
+        f'<td><a href="{prefix}{JPX_ATTACHMENT_DIR}syumatsu{day:%Y%m%d}00.pdf">PDF</a></td></tr>'
+        for day in publications
+    )
+    return (
+        "<!DOCTYPE html><html><head><title>銘柄別信用取引週末残高</title></head><body>"
+        f"<section><h2>銘柄別信用取引週末残高</h2><table>{links}</table></section>"
+        "</body></html>"
+    ).encode("utf-8")
+
+
+def jpx_pdf(codes: list[str], publication: date) -> bytes:
+    lines = [f"Outstanding Margin Trading (Application Basis) {publication:%Y/%m/%d}"]
+    for code in codes:
+        rng = _rng("jpx", code, publication.isoformat())
+        short = rng.randint(1, 3_000_000)
+        long = rng.randint(0, 9_000_000)
+        change = rng.randint(-200_000, 200_000)
+        lines.append(
+            f"Company{code} {code}0 JP3{code}00000 {short:,} {change:,} {long:,} {abs(change):,}"
+        )
+    return text_pdf_bytes(lines)
+
+
+def listed_companies(codes: list[str], as_of: date) -> bytes:
+    """JPX上場銘柄一覧と同じ列の xlsx（xls の代わり。pandas は中身で判別する）。"""
+    import pandas as pd
+
+    records = []
+    for code in codes:
+        rng = _rng("listed", code)
+        segment = rng.choices(LISTED_SEGMENTS, weights=[4, 4, 2, 1])[0]
+        sector_code, sector = ("-", "-") if segment == "ETF・ETN" else rng.choice(LISTED_SECTORS)
+        records.append(
+            {
+                "日付": as_of.strftime("%Y%m%d"),
+                "コード": code,
+                "銘柄名": f"Company{code}",
+                "市場・商品区分": segment,
+                "33業種コード": sector_code,
+                "33業種区分": sector,
+            }
+        )
+    buffer = io.BytesIO()
+    pd.DataFrame(records).to_excel(buffer, index=False)
+    return buffer.getvalue()
+
+
+def daily_bars(symbol: str, sessions: list[date]) -> tuple[list[int], dict[str, list[float | int]], dict[int, float]]:
+    """銘柄ごとに固定の日足系列（始値時刻, 四本値と出来高, 配当）。Yahoo・Stooqで共通。"""
+    rng = _rng("yahoo", symbol)
+    price = rng.uniform(300, 9000)
+    timestamps: list[int] = []
+    quote: dict[str, list[float | int]] = {key: [] for key in ("open", "high", "low", "close", "volume")}
+    for session in sessions:
+        price *= 1 + rng.uniform(-0.03, 0.031)
+        close = round(price, 1)
+        opened = datetime.combine(session, dt_time(9, 0), scraper.JST)
+        timestamps.append(int(opened.timestamp()))
+        quote["open"].append(round(close * rng.uniform(0.98, 1.02), 1))
+        quote["high"].append(round(close * 1.02, 1))
+        quote["low"].append(round(close * 0.98, 1))
+        quote["close"].append(close)
+        quote["volume"].append(rng.randint(1_000, 3_000_000))
+
+    dividends: dict[int, float] = {}
+    for position in range(len(sessions) - 120, 0, -245):
+        dividends[timestamps[position]] = round(rng.uniform(5, 60), 1)
+    return timestamps, quote, dividends
+
+
+def yahoo_chart(symbol: str, sessions: list[date], keep: slice = slice(None)) -> bytes:
+    """全期間で系列を決めてから keep で切り出す（期間指定が違っても同じ値になる）。"""
+    timestamps, quote, dividends = daily_bars(symbol, sessions)
+    events: dict[str, dict[str, dict[str, float]]] = {
+        "dividends": {str(stamp): {"amount": amount, "date": stamp} for stamp, amount in dividends.items()}
+    }
+
+    timestamps = timestamps[keep]
+    quote = {key: values[keep] for key, values in quote.items()}
+    kept = set(timestamps)
+    events["dividends"] = {
+        stamp: event for stamp, event in events["dividends"].items() if int(stamp) in kept
+    }
+    payload = {
+        "chart": {
+            "result": [
+                {
+                    "meta": {"symbol": symbol, "exchangeTimezoneName": "Asia/Tokyo", "currency": "JPY"},
+                    "timestamp": timestamps,
+                    "events": events,
+                    "indicators": {"quote": [quote], "adjclose": [{"adjclose": quote["close"]}]},
+                }
+            ],
+            "error": None,
+        }
+    }
+    return json.dumps(payload, separators=(",", ":")).encode("utf-8")
+
+
+def stooq_csv(symbol: str, sessions: list[date], keep: slice = slice(None)) -> bytes:
+    """StooqのCSV形式。Yahooと同じ系列を返す（主・副どちらが勝っても指標が一致する）。"""
+    _, quote, _ = daily_bars(symbol, sessions)
+    lines = ["Date,Open,High,Low,Close,Volume"]
+    for position in range(len(sessions))[keep]:
+        lines.append(
+            f"{sessions[position].isoformat()},{quote['open'][position]},{quote['high'][position]},"
+            f"{quote['low'][position]},{quote['close'][position]},{quote['volume'][position]}"
+        )
+    return ("\n".join(lines) + "\n").encode("ascii")
+
+
+# ====== 障害注入 ======
+def parse_latency(spec: str):
+    """fixed:MS / uniform:LOW,HIGH / lognormal:MEDIAN_MS,SIGMA を秒の乱数生成器へ。"""
+    kind, _, raw = spec.partition(":")
+    values = [float(value) for value in raw.split(",") if value]
+    if kind == "fixed":
+        return lambda rng: values[0] / 1000
+    if kind == "uniform":
+        return lambda rng: rng.uniform(values[0], values[1]) / 1000
+    if kind == "lognormal":
+        mu, sigma = math.log(max(values[0], 1e-3)), values[1]
+        return lambda rng: rng.lognormvariate(mu, sigma) / 1000
+    raise ValueError(f"unknown latency spec: {spec}")
+
+
+class UpstreamState:
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.codes = synthetic_codes(args.universe)
+        self.code_set = set(self.codes)
+        self.latency = parse_latency(args.latency)
+        self.fault_routes = set(args.fault_routes.split(","))
+        self.latency_routes = set(args.latency_routes.split(","))
+        self.rng = random.Random(args.seed)
+        self.lock = threading.Lock()
+        self.counts: Counter[str] = Counter()
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.started = time.monotonic()
+
+        as_of = date.fromisoformat(args.as_of) if args.as_of else datetime.now(scraper.JST).date()
+        self.latest_session = scraper.latest_xtks_session(as_of)
+        first_index = max(0, scraper.xtks_session_index(self.latest_session) - RANGE_SESSIONS["max"])
+        self.sessions = scraper.load_xtks_sessions(as_of)[
+            first_index : scraper.xtks_session_index(self.latest_session) + 1
+        ]
+        latest_friday = self.latest_session - timedelta(days=(self.latest_session.weekday() - 4) % 7)
+        self.publications = [latest_friday - timedelta(days=7 * week) for week in range(4)]
+        self._pdf_cache: dict[date, bytes] = {}
+        self._listed: bytes | None = None
+
+    def draw(self) -> float:
+        with self.lock:
+            return self.rng.random()
+
+    def pdf(self, publication: date) -> bytes:
+        with self.lock:
+            if publication not in self._pdf_cache:
+                self._pdf_cache[publication] = jpx_pdf(self.codes, publication)
+            return self._pdf_cache[publication]
+
+    def listed(self) -> bytes:
+        with self.lock:
+            if self._listed is None:
+                self._listed = listed_companies(self.codes, self.latest_session.replace(day=1))
+            return self._listed
+
+    def record(self, route: str, status: int, elapsed: float) -> None:
+        with self.lock:
+            self.counts[f"{route} {status}"] += 1
+            self.latencies[route].append(elapsed)
+
+    def stats(self) -> dict[str, object]:
+        with self.lock:
+            summary: dict[str, object] = {
+                "uptime_s": round(time.monotonic() - self.started, 3),
+                "counts": dict(sorted(self.counts.items())),
+                "latency_ms": {},
+            }
+            for route, values in self.latencies.items():
+                ordered = sorted(values)
+
+                def quantile(q: float) -> float:
+                    return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000, 2)
+
+                summary["latency_ms"][route] = {
+                    "n": len(ordered),
+                    "p50": quantile(0.50),
+                    "p90": quantile(0.90),
+                    "p99": quantile(0.99),
+                    "max": round(ordered[-1] * 1000, 2),
+                }
+            return summary
+
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    server_version = "UpstreamStandIn/1.0"
+    protocol_version = "HTTP/1.1"
+    state: UpstreamState
+
+    def setup(self) -> None:
+        super().setup()
+        # ヘッダーと本文を別々に送るため、Nagleで40ms待たされないようにする。
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format: str, *args: object) -> None:  # noqa: A002
+        if self.state.args.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self) -> None:  # noqa: N802
+        started = time.monotonic()
+        parts = urlsplit(self.path)
+        route, status = self._dispatch(parts.path, parse_qs(parts.query))
+        self.state.record(route, status, time.monotonic() - started)
+
+    def _dispatch(self, path: str, query: dict[str, list[str]]) -> tuple[str, int]:
+        args = self.state.args
+        if path == "/__stats":
+            return "stats", self._send(200, json.dumps(self.state.stats(), ensure_ascii=False).encode(), "application/json")
+
+        route = path.split("/", 2)[1] if path.count("/") >= 2 else "unknown"
+        if route in self.state.latency_routes:
+            time.sleep(self.state.latency(random.Random(self.state.draw())))
+
+        # --fault-routes 指定時は、その経路だけに障害を注入する。
+        draw = self.state.draw() if route in self.state.fault_routes else 1.0
+        if draw < args.p429:
+            return route, self._send(429, b"Too Many Requests", "text/plain", {"Retry-After": str(args.retry_after)})
+        draw -= args.p429
+        if draw < args.p5xx:
+            status = (500, 502, 503)[int(self.state.draw() * 3)]
+            return route, self._send(status, b"upstream error", "text/plain")
+        draw -= args.p5xx
+
+        body, content_type = self._body(path, query)
+        if body is None or draw < args.p404:
+            return route, self._send(404, b"Not Found", "text/plain")
+        headers: dict[str, str] = {}
+        if path == "/jpx" + JPX_LISTED_PATH:
+            headers["ETag"] = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+            if self.headers.get("If-None-Match") == headers["ETag"]:
+                return route, self._send(304, b"", content_type, headers)
+        slow = self.state.draw() < args.slow_body_rate
+        return route, self._send(200, body, content_type, headers, slow=slow)
+
+    def _body(self, path: str, query: dict[str, list[str]]) -> tuple[bytes | None, str]:
+        state = self.state
+        match = re.fullmatch(r"/irbank/files/([0-9A-Z]{4})/([\w.\-]+)", path)
+        if match:
+            if match.group(1) not in state.code_set:
+                return None, ""
+            return irbank_csv(match.group(1), match.group(2)), "text/csv; charset=utf-8"
+
+        if path in (
+            "/jpx/markets/statistics-equities/margin/05.html",
+            "/jpx/english/markets/statistics-equities/margin/05.html",
+        ):
+            return jpx_page("/jpx", state.publications), "text/html; charset=utf-8"
+
+        match = re.fullmatch(r"/jpx" + re.escape(JPX_ATTACHMENT_DIR) + r"syumatsu(\d{8})00\.pdf", path)
+        if match:
+            publication = datetime.strptime(match.group(1), "%Y%m%d").date()
+            if publication not in state.publications:
+                return None, ""
+            return state.pdf(publication), "application/pdf"
+
+        if path == "/jpx" + JPX_LISTED_PATH:
+            return state.listed(), "application/vnd.ms-excel"
+
+        match = re.fullmatch(r"/yahoo/v8/finance/chart/([0-9A-Z]{4})\.T", path)
+        if match:
+            if match.group(1) not in state.code_set:
+                return None, ""
+            sessions = state.sessions
+            if "period1" in query:
+                start = datetime.fromtimestamp(int(query["period1"][0]), timezone.utc).astimezone(scraper.JST).date()
+                end = (
+                    datetime.fromtimestamp(int(query["period2"][0]), timezone.utc).astimezone(scraper.JST).date()
+                    if "period2" in query
+                    else state.latest_session
+                )
+                keep = slice(bisect.bisect_left(sessions, start), bisect.bisect_left(sessions, end))
+            else:
+                count = RANGE_SESSIONS.get(query.get("range", ["2y"])[0], 490)
+                keep = slice(-count, None)
+            return yahoo_chart(f"{match.group(1)}.T", sessions, keep), "application/json"
+
+        if path == "/stooq/q/d/l/":
+            match = re.fullmatch(r"([0-9a-z]{4})\.jp", query.get("s", [""])[0])
+            if not match or match.group(1).upper() not in state.code_set:
+                return b"No data", "text/plain"
+            sessions = state.sessions
+            first = datetime.strptime(query["d1"][0], "%Y%m%d").date() if "d1" in query else sessions[0]
+            last = datetime.strptime(query["d2"][0], "%Y%m%d").date() if "d2" in query else sessions[-1]
+            keep = slice(bisect.bisect_left(sessions, first), bisect.bisect_right(sessions, last))
+            return stooq_csv(f"{match.group(1).upper()}.T", sessions, keep), "text/csv"
+
+        return None, ""
+
+    def _send(
+        self,
+        status: int,
+        body: bytes,
+        content_type: str,
+        headers: dict[str, str] | None = None,
+        *,
+        slow: bool = False,
+    ) -> int:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if not slow:
+            self.wfile.write(body)
+            return status
+
+        # 本文を小分けにして、全体で slow_body_seconds かけて送る。
+        pieces = max(1, min(50, len(body) // 512))
+        step = math.ceil(len(body) / pieces)
+        for start in range(0, len(body), step):
+            self.wfile.write(body[start : start + step])
+            self.wfile.flush()
+            time.sleep(self.state.args.slow_body_seconds / pieces)
+        return status
+
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="local stand-in for IRBANK/JPX/Yahoo")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--universe", type=int, default=4000, help="合成ユニバースの銘柄数")
+    parser.add_argument("--write-tickers", help="合成ユニバースを tickers.txt 形式で書き出す")
+    parser.add_argument("--as-of", help="日足の最終日の基準日（既定: 今日のJST日付）")
+    parser.add_argument("--latency", default="fixed:0", help="fixed:MS | uniform:LOW,HIGH | lognormal:MEDIAN_MS,SIGMA")
+    parser.add_argument("--p404", type=float, default=0.0)
+    parser.add_argument("--p429", type=float, default=0.0)
+    parser.add_argument("--p5xx", type=float, default=0.0)
+    parser.add_argument("--fault-routes", default="irbank,jpx,yahoo,stooq", help="障害を注入する経路（カンマ区切り）")
+    parser.add_argument("--latency-routes", default="irbank,jpx,yahoo,stooq", help="--latency を適用する経路（カンマ区切り）")
+    parser.add_argument("--retry-after", type=int, default=1, help="429応答のRetry-After秒")
+    parser.add_argument("--slow-body-rate", type=float, default=0.0, help="本文を低速送信する割合")
+    parser.add_argument("--slow-body-seconds", type=float, default=2.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    state = UpstreamState(args)
+    if args.write_tickers:
+        Path(args.write_tickers).write_text("\n".join(state.codes) + "\n", encoding="utf-8")
+        print(f"tickers written: {args.write_tickers} ({len(state.codes)} codes)", flush=True)
+
+    UpstreamHandler.state = state
+    server = ThreadingHTTPServer((args.host, args.port), UpstreamHandler)
+    server.daemon_threads = True
+    print(
+        f"upstream stand-in listening on http://{args.host}:{args.port} "
+        f"universe={len(state.codes)} latest_session={state.latest_session.isoformat()}",
+        flush=True,
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(state.stats(), ensure_ascii=False, indent=2), flush=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
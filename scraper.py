@@ -12,31 +12,57 @@
 - OFFSET / MAX_TICKERS による分割実行に対応
 - metrics.csv の列名と並びを維持
 - 最新営業日の日足が取れない場合は metrics.csv を更新しない
+
+ライブラリとして import し、compute_metrics() で型付きの表を直接得ることもできる。
 """
 
 from __future__ import annotations
 
+import argparse
+import bisect
+import cProfile
 import csv
+import hashlib
 import io
+import json
 import math
 import os
+import pickle
+import pstats
+import queue
+import random
 import re
+import signal
+import socket
+import socketserver
+import sqlite3
 import sys
 import tempfile
+import threading
 import time
+import tracemalloc
 import unicodedata
+import uuid
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import closing, contextmanager
+from dataclasses import dataclass, field
+from email.utils import parsedate_to_datetime
 from html import unescape
+from itertools import islice
 import zipfile
 from datetime import date, datetime, time as dt_time, timedelta
 from pathlib import Path
-from typing import Any
-from urllib.parse import urljoin
+from typing import Any, Callable, Iterator, Protocol, TypeVar
+from urllib.parse import urljoin, urlsplit
 from zoneinfo import ZoneInfo
 
-import exchange_calendars as xcals
+import numpy as np
 import pandas as pd
 import requests
+import urllib3
 import yfinance as yf
+from requests.adapters import HTTPAdapter
 import pdfplumber
 from bs4 import BeautifulSoup
 
@@ -47,9 +73,16 @@ STRICT_DEVIATION_SIGN = os.getenv("STRICT_DEVIATION_SIGN", "1").strip() != "0"
 
 
 # ====== 設定 ======
-IR_CSV = "https://f.irbank.net/files/{code}/{path}"
-JPX_MARGIN_PAGE = "https://www.jpx.co.jp/markets/statistics-equities/margin/05.html"
-JPX_MARGIN_PAGE_EN = "https://www.jpx.co.jp/english/markets/statistics-equities/margin/05.html"
+# 負荷試験では bench/upstream_server.py の代替サーバーへ向け替えられる。
+IRBANK_BASE_URL = os.getenv("IRBANK_BASE_URL", "https://f.irbank.net").rstrip("/")
+JPX_BASE_URL = os.getenv("JPX_BASE_URL", "https://www.jpx.co.jp").rstrip("/")
+# 指定時はyfinanceではなくchart APIを直接呼ぶ（例: http://127.0.0.1:8765/yahoo）。
+YAHOO_CHART_BASE_URL = os.getenv("YAHOO_CHART_BASE_URL", "").strip().rstrip("/")
+STOOQ_BASE_URL = os.getenv("STOOQ_BASE_URL", "https://stooq.com").rstrip("/")
+
+IR_CSV = IRBANK_BASE_URL + "/files/{code}/{path}"
+JPX_MARGIN_PAGE = JPX_BASE_URL + "/markets/statistics-equities/margin/05.html"
+JPX_MARGIN_PAGE_EN = JPX_BASE_URL + "/english/markets/statistics-equities/margin/05.html"
 
 CSV_PL = "fy-profit-and-loss.csv"
 CSV_BS = "fy-balance-sheet.csv"
@@ -58,6 +91,54 @@ CSV_QQ = "qq-yoy-operating-income.csv"
 CSV_PS = "fy-per-share.csv"
 CSV_ALL = "fy-data-all.csv"
 
+# ====== 追加指標の定義 ======
+# INDICATORS="ma_deviation:75,return:20" のように kind:window で並べる。
+# 列名は kind ごとの既定名。name=kind:window で明示もできる。
+@dataclass(frozen=True)
+class IndicatorSpec:
+    name: str
+    kind: str
+    window: int
+
+
+INDICATOR_KINDS = {
+    "ma_deviation": "deviation_{window}ma_pct",  # (終値/N日移動平均-1)*100
+    "return": "return_{window}d_pct",  # N営業日前の終値からの騰落率
+    "atr": "atr_{window}",  # 真の値幅のN日単純平均（円）
+    "volume_zscore": "volume_zscore_{window}",  # 当日出来高のN日平均からの標準化偏差
+}
+DEFAULT_INDICATORS = "ma_deviation:75,ma_deviation:200,return:20,atr:14,volume_zscore:25"
+
+
+def parse_indicator_specs(value: str) -> list[IndicatorSpec]:
+    specs: list[IndicatorSpec] = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name, _, body = item.rpartition("=")
+        kind, _, window_text = body.partition(":")
+        kind = kind.strip()
+        if kind not in INDICATOR_KINDS:
+            raise ValueError(f"INDICATORS: unknown kind {kind!r} (use {', '.join(INDICATOR_KINDS)})")
+        if not window_text.strip().isdigit() or int(window_text) < 2:
+            raise ValueError(f"INDICATORS: window must be an integer >= 2: {item!r}")
+        window = int(window_text)
+        specs.append(
+            IndicatorSpec(
+                name=name.strip() or INDICATOR_KINDS[kind].format(window=window),
+                kind=kind,
+                window=window,
+            )
+        )
+    names = [spec.name for spec in specs]
+    if len(set(names)) != len(names):
+        raise ValueError(f"INDICATORS: duplicate column names {names}")
+    return specs
+
+
+INDICATORS = parse_indicator_specs(os.getenv("INDICATORS", DEFAULT_INDICATORS))
+
 OUTPUT_COLUMNS = [
     "code",
     "per",
@@ -72,17 +153,142 @@ OUTPUT_COLUMNS = [
     "volratio_5_25",
     "deviation_25ma_pct",
 ]
+# 既存の列順は変えず、追加指標は末尾に足す。
+BASE_OUTPUT_COLUMN_COUNT = len(OUTPUT_COLUMNS)
+OUTPUT_COLUMNS += [spec.name for spec in INDICATORS]
+
+# JPX週末残高のアーカイブから計算する列（前週比と、直近N週の信用倍率の傾き）。
+JPX_MARGIN_TREND_WEEKS = max(3, int(os.getenv("JPX_MARGIN_TREND_WEEKS", "4")))
+MARGIN_OUTPUT_COLUMNS = [
+    "margin_short_wow_pct",
+    "margin_long_wow_pct",
+    "credit_ratio_wow",
+    f"credit_ratio_slope_{JPX_MARGIN_TREND_WEEKS}w",
+]
+OUTPUT_COLUMNS += MARGIN_OUTPUT_COLUMNS
+
+# metrics.csv 以外の出力（Parquet/Arrow IPC/NDJSON）で使う型。
+# 欠損はCSVでは空文字、型付き出力ではnullになる。
+INTEGER_OUTPUT_COLUMNS = {"vol5", "vol25"}
+STRING_OUTPUT_COLUMNS = {"code"}
+
+
+def output_schema(columns: list[str] | None = None) -> dict[str, str]:
+    """列名 -> pandas dtype。OUTPUT_COLUMNS から導出する。"""
+    schema: dict[str, str] = {}
+    for column in columns or OUTPUT_COLUMNS:
+        if column in STRING_OUTPUT_COLUMNS:
+            schema[column] = "string"
+        elif column in INTEGER_OUTPUT_COLUMNS:
+            schema[column] = "Int64"
+        else:
+            schema[column] = "float64"
+    return schema
+
 
 JST = ZoneInfo("Asia/Tokyo")
 REQUEST_TIMEOUT = int(os.getenv("REQUEST_TIMEOUT", "30"))
 YAHOO_PERIOD = os.getenv("YAHOO_PERIOD", "2y")
 YAHOO_CHUNK_SIZE = max(1, int(os.getenv("YAHOO_CHUNK_SIZE", "40")))
 YAHOO_RETRIES = max(1, int(os.getenv("YAHOO_RETRIES", "3")))
+STOOQ_RETRIES = max(1, int(os.getenv("STOOQ_RETRIES", "2")))
+# 日足の取得元。先頭が主、2番目があれば遅延・欠損時のヘッジ先（"yahoo" だけでヘッジなし）。
+PRICE_PROVIDERS = os.getenv("PRICE_PROVIDERS", "yahoo,stooq")
+# 主取得元のチャンク所要時間の分位点を超えたら副取得元へも投げる。
+HEDGE_PERCENTILE = min(0.999, max(0.5, float(os.getenv("HEDGE_PERCENTILE", "0.9"))))
+HEDGE_MIN_SECONDS = max(0.0, float(os.getenv("HEDGE_MIN_SECONDS", "5")))
+HEDGE_INITIAL_SECONDS = max(0.0, float(os.getenv("HEDGE_INITIAL_SECONDS", "30")))
+# 全銘柄の取得前に、少数の銘柄の直近数日だけで当日の日足が出ているか確かめる（0で無効）。
+# READINESS_SYMBOLS 未指定時は対象銘柄の先頭 READINESS_SENTINELS 件。出ていなければ
+# READINESS_POLL_SECONDS から倍々（上限 READINESS_MAX_POLL_SECONDS）で待ち、
+# READINESS_WAIT_MINUTES（実行期限があればその手前まで）を過ぎたら全件取得せずに終える。
+READINESS_PROBE = os.getenv("READINESS_PROBE", "1").strip() != "0"
+READINESS_SYMBOLS = os.getenv("READINESS_SYMBOLS", "")
+READINESS_SENTINELS = max(1, int(os.getenv("READINESS_SENTINELS", "3")))
+READINESS_WAIT_MINUTES = max(0.0, float(os.getenv("READINESS_WAIT_MINUTES", "15")))
+READINESS_POLL_SECONDS = max(1.0, float(os.getenv("READINESS_POLL_SECONDS", "30")))
+READINESS_MAX_POLL_SECONDS = max(1.0, float(os.getenv("READINESS_MAX_POLL_SECONDS", "300")))
 IRBANK_RETRIES = max(1, int(os.getenv("IRBANK_RETRIES", "3")))
+# IRBANK CSV は見出し帯と直近の行だけを保持する（0で全行）。縦型は常に全行。
+IRBANK_CSV_TAIL_ROWS = max(0, int(os.getenv("IRBANK_CSV_TAIL_ROWS", "24")))
+# 見出しとして扱う先頭の行数（題名行・複数段の見出しを含む）。
+CSV_HEADER_ROWS = 8
+JPX_RETRIES = max(1, int(os.getenv("JPX_RETRIES", "3")))
+# 3系統共通の再試行・遮断設定（秒）。
+RETRY_BASE_DELAY = max(0.0, float(os.getenv("RETRY_BASE_DELAY", "1.0")))
+RETRY_MAX_DELAY = max(0.0, float(os.getenv("RETRY_MAX_DELAY", "30")))
+CIRCUIT_FAILURE_THRESHOLD = max(1, int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5")))
+CIRCUIT_COOLDOWN = max(0.0, float(os.getenv("CIRCUIT_COOLDOWN", "60")))
+AIMD_DECREASE = max(0.0, float(os.getenv("AIMD_DECREASE", "0.05")))
+AIMD_MAX_INTERVAL = max(0.0, float(os.getenv("AIMD_MAX_INTERVAL", "10")))
 MARKET_DATA_READY_TIME = os.getenv("MARKET_DATA_READY_TIME", "16:15")
 STRICT_JPX = os.getenv("STRICT_JPX", "0").strip() == "1"
 JPX_MARGIN_URL_OVERRIDE = os.getenv("JPX_MARGIN_URL", "").strip()
 MIN_JPX_PARSED_ROWS = max(100, int(os.getenv("MIN_JPX_PARSED_ROWS", "100")))
+# 空文字または0で無効。週ごとの売残・買残を公表日別のParquet（<dir>/YYYY-MM-DD.parquet）で残す。
+JPX_MARGIN_ARCHIVE = os.getenv("JPX_MARGIN_ARCHIVE", "jpx_margin_archive").strip()
+# 空文字または0で無効。取得したIRBANK CSVを (code, source, period, item, value) の縦持ちで
+# <dir>/<コード先頭2文字>.parquet に積み増す。FUNDAMENTAL_YEARS は派生指標の年数。
+FUNDAMENTALS_STORE = os.getenv("FUNDAMENTALS_STORE", "fundamentals_store").strip()
+FUNDAMENTAL_YEARS = max(2, int(os.getenv("FUNDAMENTAL_YEARS", "5")))
+TICKERS_FILE = os.getenv("TICKERS_FILE", "tickers.txt")
+# tickers（既定）は TICKERS_FILE、jpx はJPX上場銘柄一覧から銘柄を選ぶ。
+UNIVERSE = os.getenv("UNIVERSE", "tickers").strip().lower()
+# 名前付きの銘柄リスト（name=path をカンマ区切り、例: watch=watchlist.txt,hold=holdings.txt）。
+# 指定すると UNIVERSE の代わりに全リストの和集合を1回ずつ取得・計算し、
+# metrics.csv（和集合）に加えてリストごとに metrics_<name>.csv を書く。
+PORTFOLIOS = os.getenv("PORTFOLIOS", "").strip()
+JPX_LISTED_URL = os.getenv(
+    "JPX_LISTED_URL",
+    JPX_BASE_URL + "/markets/statistics-equities/misc/tvdivq0000001vg2-att/data_j.xls",
+).strip()
+UNIVERSE_CACHE = Path(os.getenv("UNIVERSE_CACHE", "jpx_listed_index.tsv"))
+UNIVERSE_MAX_AGE_HOURS = max(0.0, float(os.getenv("UNIVERSE_MAX_AGE_HOURS", "24")))
+# 市場・商品区分 / 33業種（コードまたは名称の部分一致）。カンマ区切り、空文字で絞り込みなし。
+UNIVERSE_SEGMENTS = os.getenv("UNIVERSE_SEGMENTS", "内国株式")
+UNIVERSE_SECTORS = os.getenv("UNIVERSE_SECTORS", "")
+# 空文字または0で無効。成功した実行の行を (expected_market_date, code) で upsert する。
+HISTORY_DB = os.getenv("HISTORY_DB", "metrics_history.sqlite").strip()
+# 実行のたびに書き出すスクリーニングの定義（JSON）。ファイルが無ければ何もしない。空文字または0で無効。
+SCREENS_FILE = os.getenv("SCREENS_FILE", "screens.json").strip()
+SCREENS_DIR = Path(os.getenv("SCREENS_DIR", "screens"))
+# csv は常に書く。parquet/arrow は pyarrow が無ければ警告して省略する。
+OUTPUT_FORMATS = [
+    value.strip().lower()
+    for value in os.getenv("OUTPUT_FORMATS", "csv,parquet,ndjson").split(",")
+    if value.strip()
+]
+# 段階ごとのプロファイル。1/all、または cpu,memory,stacks の組み合わせ。空文字または0で無効。
+PROFILE = os.getenv("PROFILE", "").strip().lower()
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profile").strip()
+PROFILE_SAMPLE_INTERVAL = max(0.001, float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005")))
+# 空文字または0で無効。既定では metrics.csv と同じ場所へ追記する。
+TRACE_FILE = os.getenv("TRACE_FILE", "metrics_trace.jsonl").strip()
+POLITE_SLEEP_SCALE = max(0.0, float(os.getenv("POLITE_SLEEP_SCALE", "1")))
+# 銘柄ごと・Yahooチャンクごとの礼儀上の待機（秒）。--plan の見積もりにも使う。
+ROW_SLEEP_SECONDS = 0.4
+YAHOO_CHUNK_SLEEP_SECONDS = 1.5
+XTKS_SESSIONS_FILE = Path(
+    os.getenv(
+        "XTKS_SESSIONS_FILE",
+        str(Path(__file__).resolve().with_name("xtks_sessions.txt")),
+    )
+)
+# 記録・再生。HTTP_ARCHIVE_MODE=record で SESSION と yf.download の応答を HTTP_ARCHIVE へ保存し、
+# replay で通信せずに返す。HTTP_REPLAY_TIMING は記録時の所要時間に掛ける倍率（0で待たない）。
+HTTP_ARCHIVE = os.getenv("HTTP_ARCHIVE", "").strip()
+HTTP_ARCHIVE_MODE = os.getenv("HTTP_ARCHIVE_MODE", "").strip().lower()
+HTTP_REPLAY_TIMING = max(0.0, float(os.getenv("HTTP_REPLAY_TIMING", "0")))
+# 常駐モード（daemon サブコマンド）の制御用UNIXソケットと、定時実行が失敗したときの再試行間隔。
+DAEMON_SOCKET = os.getenv("DAEMON_SOCKET", "scraper.sock").strip()
+DAEMON_RETRY_MINUTES = max(1.0, float(os.getenv("DAEMON_RETRY_MINUTES", "15")))
+# 実行の持ち時間（分、0で無制限）。--deadline でも指定できる。期限が近づくと取得を打ち切り、
+# 書き出し用に DEADLINE_RESERVE_SECONDS を残して、取れた分を出力し打ち切った内容を報告する。
+RUN_DEADLINE_MINUTES = max(0.0, float(os.getenv("RUN_DEADLINE_MINUTES", "0")))
+DEADLINE_RESERVE_SECONDS = max(0.0, float(os.getenv("DEADLINE_RESERVE_SECONDS", "60")))
+SKIPPED_REPORT = os.getenv("SKIPPED_REPORT", "metrics_skipped.json").strip()
+XTKS_SESSIONS_VERSION = 1
+XTKS_SESSIONS_FIRST_YEAR = 2016
 
 SESSION = requests.Session()
 SESSION.headers.update(
@@ -100,6 +306,7 @@ SESSION.headers.update(
 
 # ====== 共通ヘルパー ======
 def polite_sleep(seconds: float) -> None:
+    seconds *= POLITE_SLEEP_SCALE
     if seconds > 0:
         time.sleep(seconds)
 
@@ -114,6 +321,13 @@ def yahoo_symbol(code: str) -> str:
     return f"{code}.T"
 
 
+EMPTY_NUMERIC_TEXT = {"", "-", "--", "---", "None", "null", "nan", "NaN", "－", "―"}
+NUMBER_PATTERN = r"[-+]?\d+(?:\.\d+)?"
+PERIOD_FULL_PATTERN = r"20\d{2}"
+PERIOD_DATE_PATTERN = r"20\d{2}(?:[/.\-年])\d{1,2}(?:(?:[/.\-月])\d{1,2})?(?:日|期)?"
+PERIOD_FISCAL_PATTERN = r"(?:FY)?20\d{2}(?:Q[1-4]|[1-4]Q)?"
+
+
 def safe_float(value: Any) -> float | None:
     if value is None:
         return None
@@ -125,7 +339,7 @@ def safe_float(value: Any) -> float | None:
         pass
 
     text = unicodedata.normalize("NFKC", str(value)).strip()
-    if text in {"", "-", "--", "---", "None", "null", "nan", "NaN", "－", "―"}:
+    if text in EMPTY_NUMERIC_TEXT:
         return None
 
     negative = text.startswith(("△", "▲")) or (
@@ -133,7 +347,7 @@ def safe_float(value: Any) -> float | None:
     )
     text = text.replace(",", "")
     text = text.replace("△", "-").replace("▲", "-")
-    match = re.search(r"[-+]?\d+(?:\.\d+)?", text)
+    match = re.search(NUMBER_PATTERN, text)
     if not match:
         return None
 
@@ -147,6 +361,81 @@ def safe_float(value: Any) -> float | None:
     return number if math.isfinite(number) else None
 
 
+# str() が指数表記（1e+16, 1e-05）になる数値は、safe_float では仮数の先頭だけが
+# 読まれる。同じ結果になるよう、その範囲の数値は文字列経路へ回す。
+_PLAIN_REPR_MAX = 1e16
+_PLAIN_REPR_MIN = 1e-4
+_FAST_NUMERIC_TYPES = (int, float, np.integer, np.floating)
+
+
+def _coerce_numeric_text(text: pd.Series) -> np.ndarray:
+    """NFKC・strip 済みの文字列列に safe_float と同じ規則を一括で適用する。"""
+    negative = text.str.match(r"[△▲]") | (text.str.startswith("(") & text.str.endswith(")"))
+    cleaned = text.str.replace(",", "", regex=False).str.replace(r"[△▲]", "-", regex=True)
+    numbers = cleaned.str.extract(f"({NUMBER_PATTERN})", expand=False).astype("float64").to_numpy()
+    numbers = np.where(negative.to_numpy(dtype=bool) & (numbers > 0), -numbers, numbers)
+    numbers[text.isin(EMPTY_NUMERIC_TEXT).to_numpy() | ~np.isfinite(numbers)] = np.nan
+    return numbers
+
+
+# _looks_like_period の3つの判定を1回の走査にまとめる（FULL は FISCAL に含まれる）。
+_PERIOD_MASK_PATTERN = re.compile(
+    f"^(?:{PERIOD_FISCAL_PATTERN})$|{PERIOD_DATE_PATTERN}",
+    re.IGNORECASE,
+)
+
+
+def _period_mask(text: pd.Series) -> np.ndarray:
+    """_looks_like_period の一括版。text は NFKC・strip 済み。"""
+    compact = text.str.replace(r"\s+", "", regex=True)
+    return compact.str.contains(_PERIOD_MASK_PATTERN).to_numpy(dtype=bool)
+
+
+def coerce_numeric(values: Any) -> tuple[np.ndarray, np.ndarray]:
+    """
+    列・表をまとめて数値化する。(float配列, 年度・日付に見えるセルのマスク) を返す。
+    値は safe_float、マスクは _looks_like_period と同じ判定で、欠損はNaN。
+    すでに数値のセルは文字列処理を通さない。
+    """
+    series = values if isinstance(values, pd.Series) else pd.Series(values, dtype="object")
+    count = len(series)
+    numbers = np.full(count, np.nan)
+    periods = np.zeros(count, dtype=bool)
+    if count == 0:
+        return numbers, periods
+
+    missing = series.isna().to_numpy()
+    if series.dtype.kind in "iuf":
+        fast = ~missing
+    elif pd.api.types.infer_dtype(series, skipna=True) in ("string", "empty"):
+        fast = np.zeros(count, dtype=bool)
+    else:
+        fast = ~missing & series.map(
+            lambda value: isinstance(value, _FAST_NUMERIC_TYPES) and not isinstance(value, (bool, np.bool_))
+        ).to_numpy(dtype=bool)
+
+    if fast.any():
+        raw = series[fast].to_numpy(dtype="float64")
+        magnitude = np.abs(raw)
+        plain = np.isfinite(raw) & (magnitude < _PLAIN_REPR_MAX) & ~((magnitude > 0) & (magnitude < _PLAIN_REPR_MIN))
+        if series.dtype.kind in "iu":
+            plain[:] = True
+        fast_positions = np.flatnonzero(fast)
+        numbers[fast_positions[plain]] = raw[plain]
+        # 指数表記・inf は文字列経路へ。
+        fast[fast_positions[~plain]] = False
+
+    present = np.flatnonzero(~missing)
+    text = series.iloc[present].astype(str)
+    needs_number = ~fast[present]
+
+    text = text.str.normalize("NFKC").str.strip()
+    periods[present] = _period_mask(text)
+    if needs_number.any():
+        numbers[present[needs_number]] = _coerce_numeric_text(text[needs_number])
+    return numbers, periods
+
+
 def safe_div(numerator: Any, denominator: Any, multiplier: float = 1.0) -> float | None:
     n = safe_float(numerator)
     d = safe_float(denominator)
@@ -175,1438 +464,5380 @@ def parse_ready_time(value: str) -> dt_time:
     return dt_time(hour=hour, minute=minute)
 
 
-# ====== 東証営業日の判定 ======
-def expected_market_date(now_jst: datetime | None = None) -> date:
+# ====== トレース（JSON Lines） ======
+# 1段階・1リクエストごとに span を1行のJSONで記録する。
+# 所要時間のほか、HTTPステータス・バイト数・再試行回数・キャッシュ結果を持つ。
+TRACE_RUN_ID = uuid.uuid4().hex[:12]
+# 親子関係はスレッドごとに持つ（ヘッジ取得の作業スレッドが親を取り違えないように）。
+_TRACE_LOCAL = threading.local()
+_TRACE_BUFFER: list[dict[str, Any]] = []
+
+
+def _trace_stack() -> list[dict[str, Any]]:
+    stack = getattr(_TRACE_LOCAL, "stack", None)
+    if stack is None:
+        stack = _TRACE_LOCAL.stack = []
+    return stack
+
+
+def in_current_span(function: Callable[..., T]) -> Callable[..., T]:
+    """別スレッドで実行しても、呼び出し時点の span の子として記録されるようにする。"""
+    parents = list(_trace_stack())
+
+    def run(*args: Any, **kwargs: Any) -> T:
+        stack = _trace_stack()
+        stack[:] = parents
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stack.clear()
+
+    return run
+
+
+@contextmanager
+def trace_span(name: str, **attributes: Any) -> Iterator[dict[str, Any]]:
     """
-    本日が東証営業日の場合は、引け後の反映待ち時刻を過ぎてから本日を返す。
-    土日祝日は、直近の東証営業日を返す。
+    with trace_span("irbank.csv", code=code) as span:
+        span["http_status"] = 200
+    のように、処理中に属性を書き足せる。例外は status=error として記録し再送出する。
     """
-    now_jst = now_jst or datetime.now(JST)
-    today = now_jst.date()
-    ready_time = parse_ready_time(MARKET_DATA_READY_TIME)
+    stack = _trace_stack()
+    span: dict[str, Any] = {
+        "run_id": TRACE_RUN_ID,
+        "span_id": uuid.uuid4().hex[:16],
+        "parent_id": stack[-1]["span_id"] if stack else None,
+        "name": name,
+        "start": datetime.now(JST).isoformat(timespec="milliseconds"),
+        **attributes,
+    }
+    stack.append(span)
+    started = time.perf_counter()
+    try:
+        with profile_stage(name):
+            yield span
+        span.setdefault("status", "ok")
+    except BaseException as exc:
+        span["status"] = "error"
+        span["error"] = f"{type(exc).__name__}: {exc}"[:300]
+        raise
+    finally:
+        span["duration_ms"] = round((time.perf_counter() - started) * 1000, 3)
+        stack.pop()
+        _TRACE_BUFFER.append(span)
 
-    calendar = xcals.get_calendar("XTKS")
-    start = pd.Timestamp(today - timedelta(days=30))
-    end = pd.Timestamp(today)
-    sessions = calendar.sessions_in_range(start, end)
-    session_dates = {pd.Timestamp(session).date() for session in sessions}
 
-    if today in session_dates:
-        if now_jst.time().replace(tzinfo=None) < ready_time:
-            raise RuntimeError(
-                f"本日の東証日足が確定する前です。"
-                f"{today.isoformat()} {ready_time.strftime('%H:%M')} JST以降に実行してください。"
-            )
-        return today
+def trace_http(span: dict[str, Any], response: requests.Response) -> None:
+    """HTTP応答の共通属性を span に書き込む。"""
+    span["host"] = urlsplit(response.url or span.get("url", "")).netloc
+    span["http_status"] = response.status_code
+    if getattr(response, "_content_consumed", True):
+        span["bytes"] = len(response.content or b"")
+    else:
+        # stream=True で本文を未読の場合は宣言サイズだけ記録する。
+        length = response.headers.get("Content-Length", "")
+        span["bytes"] = int(length) if length.isdigit() else None
+
+
+def flush_trace(path: str | None = None) -> None:
+    """溜めた span を追記する。集計は run_id で区切って行う。"""
+    path = TRACE_FILE if path is None else path
+    if not _TRACE_BUFFER:
+        return
+    if not path or path == "0":
+        _TRACE_BUFFER.clear()
+        return
+    with open(path, "a", encoding="utf-8") as file:
+        for span in _TRACE_BUFFER:
+            file.write(json.dumps(span, ensure_ascii=False, default=str) + "\n")
+    print(f"[TRACE] spans={len(_TRACE_BUFFER)} run_id={TRACE_RUN_ID} path={path}", flush=True)
+    _TRACE_BUFFER.clear()
+
+
+def summarize_trace(path: str, run_id: str | None = None, top: int = 10) -> int:
+    """trace_span の出力を段階・ホスト・銘柄別に集計して表示する。"""
+    spans = [
+        json.loads(line)
+        for line in Path(path).read_text(encoding="utf-8").splitlines()
+        if line.strip()
+    ]
+    if not spans:
+        print(f"[WARN] no spans in {path}", flush=True)
+        return 1
+    run_id = run_id or spans[-1]["run_id"]
+    frame = pd.DataFrame([span for span in spans if span["run_id"] == run_id])
+    for column in ("host", "code", "retries", "bytes"):
+        if column not in frame.columns:
+            frame[column] = None
+
+    print(f"run_id={run_id} spans={len(frame)}")
+    by_name = frame.groupby("name").agg(
+        count=("duration_ms", "size"),
+        total_ms=("duration_ms", "sum"),
+        p50_ms=("duration_ms", "median"),
+        p99_ms=("duration_ms", lambda values: values.quantile(0.99)),
+        retries=("retries", "sum"),
+        errors=("status", lambda values: int((values == "error").sum())),
+    )
+    print(by_name.sort_values("total_ms", ascending=False).round(1).to_string())
+
+    http = frame[frame["host"].notna()]
+    if not http.empty:
+        by_host = http.groupby("host").agg(
+            requests=("duration_ms", "size"),
+            total_ms=("duration_ms", "sum"),
+            p90_ms=("duration_ms", lambda values: values.quantile(0.9)),
+            bytes=("bytes", "sum"),
+            retries=("retries", "sum"),
+        )
+        print(by_host.sort_values("total_ms", ascending=False).round(1).to_string())
 
-    past_sessions = [session_date for session_date in session_dates if session_date <= today]
-    if not past_sessions:
-        raise RuntimeError("直近の東証営業日を判定できませんでした")
-    return max(past_sessions)
+    rows = frame[(frame["name"] == "row") & frame["code"].notna()]
+    if not rows.empty:
+        print(rows.nlargest(top, "duration_ms")[["code", "duration_ms"]].to_string(index=False))
+    return 0
 
 
-# ====== Yahoo Finance（日足・出来高） ======
-def _extract_symbol_frame(downloaded: pd.DataFrame, symbol: str) -> pd.DataFrame:
-    if downloaded is None or downloaded.empty:
-        return pd.DataFrame()
+# ====== プロファイル（段階別のCPU・メモリ） ======
+# PROFILE 指定時、下表の span を段階として cProfile・tracemalloc・スタックサンプリングで測る。
+# 同じ段階の span（銘柄ごとの row 等）は1つに積算し、実行の終わりに PROFILE_DIR/<run_id>/ へ
+#   <段階>.pstats      snakeviz / python -m pstats で読める
+#   <段階>.collapsed   flamegraph.pl・speedscope 用の畳み込みスタック（サンプル数）
+#   <段階>.memory.txt  span 終了時に残っていた確保の上位と、span 中のピーク
+# を書く。段階の中で別の段階が始まった場合は外側に含めて測る。
+PROFILE_STAGES = {
+    "calendar": "calendar",
+    "yahoo.chunk": "yahoo_download",
+    "validation": "validation",
+    "jpx.discovery": "jpx_discovery",
+    "jpx.parse": "jpx_parse",
+    "row": "irbank",
+    "write": "write",
+}
+PROFILE_MEMORY_TOP = 25
+
+
+def _profile_kinds(value: str) -> set[str]:
+    if not value or value == "0":
+        return set()
+    if value in ("1", "all", "true"):
+        return {"cpu", "memory", "stacks"}
+    kinds = {part.strip() for part in value.split(",") if part.strip()}
+    unknown = kinds - {"cpu", "memory", "stacks"}
+    if unknown:
+        raise ValueError(f"PROFILE accepts cpu,memory,stacks: {sorted(unknown)}")
+    return kinds
+
+
+@dataclass
+class StageProfile:
+    spans: int = 0
+    wall_s: float = 0.0
+    profiler: cProfile.Profile | None = None
+    samples: Counter[str] | None = None
+    memory: Counter[tuple[str, int]] | None = None
+    memory_blocks: Counter[tuple[str, int]] | None = None
+    peak_bytes: int = 0
+
+
+_PROFILE_KINDS = _profile_kinds(PROFILE)
+_PROFILES: dict[str, StageProfile] = {}
+_PROFILE_ACTIVE: list[str] = []
+_PROFILE_SAMPLER: threading.Thread | None = None
+_PROFILE_SAMPLER_STOP = threading.Event()
+
+
+def _frame_label(frame: Any) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({Path(code.co_filename).name}:{code.co_firstlineno})"
+
+
+def _sample_stacks(thread_id: int) -> None:
+    """計測中の段階があれば、対象スレッドのスタックを一定間隔で数える。"""
+    while not _PROFILE_SAMPLER_STOP.wait(PROFILE_SAMPLE_INTERVAL):
+        active = list(_PROFILE_ACTIVE)
+        if not active:
+            continue
+        frame = sys._current_frames().get(thread_id)
+        stage = _PROFILES.get(active[0])
+        if frame is None or stage is None or stage.samples is None:
+            continue
+        labels: list[str] = []
+        while frame is not None:
+            labels.append(_frame_label(frame))
+            frame = frame.f_back
+        stage.samples[";".join(reversed(labels))] += 1
+
+
+@contextmanager
+def profile_stage(span_name: str) -> Iterator[None]:
+    stage_name = PROFILE_STAGES.get(span_name)
+    if not _PROFILE_KINDS or stage_name is None or _PROFILE_ACTIVE:
+        yield
+        return
+
+    global _PROFILE_SAMPLER
+    stage = _PROFILES.setdefault(stage_name, StageProfile())
+    if "stacks" in _PROFILE_KINDS and _PROFILE_SAMPLER is None:
+        _PROFILE_SAMPLER_STOP.clear()
+        _PROFILE_SAMPLER = threading.Thread(
+            target=_sample_stacks,
+            args=(threading.get_ident(),),
+            name="profile-sampler",
+            daemon=True,
+        )
+        _PROFILE_SAMPLER.start()
+    if "stacks" in _PROFILE_KINDS and stage.samples is None:
+        stage.samples = Counter()
+    if "cpu" in _PROFILE_KINDS and stage.profiler is None:
+        stage.profiler = cProfile.Profile()
+    # span の間だけ追跡すると、スナップショットはその span の確保だけを見ればよい。
+    memory = "memory" in _PROFILE_KINDS and not tracemalloc.is_tracing()
+    if memory:
+        tracemalloc.start(1)
+
+    _PROFILE_ACTIVE.append(stage_name)
+    started = time.perf_counter()
+    if stage.profiler is not None:
+        stage.profiler.enable()
+    try:
+        yield
+    finally:
+        if stage.profiler is not None:
+            stage.profiler.disable()
+        stage.wall_s += time.perf_counter() - started
+        stage.spans += 1
+        _PROFILE_ACTIVE.pop()
+        if memory:
+            _, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            stage.peak_bytes = max(stage.peak_bytes, peak)
+            if stage.memory is None:
+                stage.memory, stage.memory_blocks = Counter(), Counter()
+            assert stage.memory_blocks is not None
+            for statistic in snapshot.statistics("lineno"):
+                frame = statistic.traceback[0]
+                stage.memory[(frame.filename, frame.lineno)] += statistic.size
+                stage.memory_blocks[(frame.filename, frame.lineno)] += statistic.count
+
+
+def flush_profiles(directory: str | None = None) -> Path | None:
+    """積算した段階別プロファイルを書き出す。"""
+    global _PROFILE_SAMPLER
+    if _PROFILE_SAMPLER is not None:
+        _PROFILE_SAMPLER_STOP.set()
+        _PROFILE_SAMPLER.join()
+        _PROFILE_SAMPLER = None
+    if not _PROFILES:
+        return None
 
-    frame: pd.DataFrame
-    if isinstance(downloaded.columns, pd.MultiIndex):
-        level0 = {str(value) for value in downloaded.columns.get_level_values(0)}
-        level1 = {str(value) for value in downloaded.columns.get_level_values(1)}
+    output = Path(PROFILE_DIR if directory is None else directory) / TRACE_RUN_ID
+    output.mkdir(parents=True, exist_ok=True)
+    summary: dict[str, Any] = {}
+    for name, stage in _PROFILES.items():
+        entry: dict[str, Any] = {"spans": stage.spans, "wall_s": round(stage.wall_s, 3)}
+        if stage.profiler is not None:
+            stage.profiler.dump_stats(output / f"{name}.pstats")
+            stats = pstats.Stats(stage.profiler)
+            entry["cpu_s"] = round(stats.total_tt, 3)
+        if stage.samples is not None:
+            with open(output / f"{name}.collapsed", "w", encoding="utf-8") as file:
+                for stack, count in stage.samples.most_common():
+                    file.write(f"{stack} {count}\n")
+            entry["samples"] = sum(stage.samples.values())
+        if stage.memory is not None and stage.memory_blocks is not None:
+            lines = [
+                f"# stage={name} spans={stage.spans} peak_bytes={stage.peak_bytes} "
+                f"(retained at span end, summed over spans)",
+            ]
+            for (filename, lineno), size in stage.memory.most_common(PROFILE_MEMORY_TOP):
+                lines.append(
+                    f"{size / 1024:12.1f} KiB {stage.memory_blocks[(filename, lineno)]:>9} blocks  "
+                    f"{filename}:{lineno}"
+                )
+            (output / f"{name}.memory.txt").write_text("\n".join(lines) + "\n", encoding="utf-8")
+            entry["peak_kib"] = round(stage.peak_bytes / 1024, 1)
+        summary[name] = entry
+        print(
+            f"[PROFILE] stage={name} "
+            + " ".join(f"{key}={value}" for key, value in entry.items()),
+            flush=True,
+        )
 
-        if symbol in level0:
-            frame = downloaded[symbol].copy()
-        elif symbol in level1:
-            frame = downloaded.xs(symbol, axis=1, level=1).copy()
-        else:
-            return pd.DataFrame()
-    else:
-        frame = downloaded.copy()
+    (output / "summary.json").write_text(json.dumps(summary, indent=2) + "\n", encoding="utf-8")
+    print(f"[PROFILE] written: {output}", flush=True)
+    _PROFILES.clear()
+    return output
 
-    if frame.empty:
-        return frame
 
-    frame = frame.dropna(how="all")
-    frame.index = pd.to_datetime(frame.index, errors="coerce")
-    frame = frame[frame.index.notna()].sort_index()
-    return frame
+# ====== 実行期限 ======
+# 各段階は取得の前に deadline_reached() を見て、期限なら打ち切って record_skip() に残す。
+# 再試行の待機と1リクエストのタイムアウトも残り時間で詰める。
+_RUN_DEADLINE: float | None = None
+_RUN_DEADLINE_MINUTES = 0.0
+_SKIPPED: list[dict[str, Any]] = []
 
 
-def download_yahoo_chunk(symbols: list[str]) -> dict[str, pd.DataFrame]:
-    last_error: Exception | None = None
+def start_run_deadline(minutes: float | None = None) -> None:
+    """今から minutes 分後を期限にする（0で無制限）。打ち切りの記録も空にする。"""
+    global _RUN_DEADLINE, _RUN_DEADLINE_MINUTES
+    _RUN_DEADLINE_MINUTES = RUN_DEADLINE_MINUTES if minutes is None else max(0.0, minutes)
+    minutes = _RUN_DEADLINE_MINUTES
+    _RUN_DEADLINE = time.monotonic() + minutes * 60 if minutes > 0 else None
+    _SKIPPED.clear()
 
-    for attempt in range(1, YAHOO_RETRIES + 1):
-        try:
-            downloaded = yf.download(
-                tickers=symbols,
-                period=YAHOO_PERIOD,
-                interval="1d",
-                group_by="ticker",
-                auto_adjust=False,
-                actions=True,
-                threads=False,
-                # 価格補修機能は追加依存が必要なため無効化。
-                repair=False,
-                keepna=False,
-                progress=False,
-                timeout=REQUEST_TIMEOUT,
-                multi_level_index=True,
-            )
 
-            result = {
-                symbol: _extract_symbol_frame(downloaded, symbol)
-                for symbol in symbols
-            }
-            if any(not frame.empty for frame in result.values()):
-                return result
-            raise RuntimeError("Yahoo Finance returned no usable rows")
+def time_left() -> float | None:
+    """書き出し用の余裕を除いた残り秒数。期限なしは None。"""
+    if _RUN_DEADLINE is None:
+        return None
+    return _RUN_DEADLINE - DEADLINE_RESERVE_SECONDS - time.monotonic()
 
-        except Exception as exc:  # yfinance側の例外型変更にも耐える
-            last_error = exc
-            print(
-                f"[WARN] Yahoo download attempt {attempt}/{YAHOO_RETRIES}: "
-                f"{type(exc).__name__}: {exc}",
-                flush=True,
-            )
-            polite_sleep(2.0 * attempt)
 
-    raise RuntimeError(f"Yahoo Finance download failed: {last_error}")
+def deadline_reached(need: float = 0.0) -> bool:
+    """残り時間が need 秒以下なら True。"""
+    left = time_left()
+    return left is not None and left <= need
 
 
-def download_yahoo_all(codes: list[str]) -> dict[str, pd.DataFrame]:
-    frames: dict[str, pd.DataFrame] = {}
-    symbols = [yahoo_symbol(code) for code in codes]
+def record_skip(stage: str, code: str | None = None, item: str | None = None) -> None:
+    _SKIPPED.append({"stage": stage, "code": code, "item": item})
 
-    for start in range(0, len(symbols), YAHOO_CHUNK_SIZE):
-        chunk = symbols[start : start + YAHOO_CHUNK_SIZE]
-        frames.update(download_yahoo_chunk(chunk))
-        if start + YAHOO_CHUNK_SIZE < len(symbols):
-            polite_sleep(1.5)
 
-    return frames
+def skipped_summary() -> dict[str, Any]:
+    stages = Counter(entry["stage"] for entry in _SKIPPED)
+    return {
+        "skipped": len(_SKIPPED),
+        "by_stage": dict(stages),
+        "codes": sorted({entry["code"] for entry in _SKIPPED if entry["code"]}),
+    }
 
 
-def yahoo_metrics(
-    code: str,
-    frame: pd.DataFrame,
-    expected_date: date,
-) -> dict[str, Any]:
-    if frame.empty:
-        raise RuntimeError(f"{code}: Yahoo Financeの日足が0件です")
-    if "Close" not in frame.columns or "Volume" not in frame.columns:
-        raise RuntimeError(
-            f"{code}: Yahoo Financeの必要列がありません: {list(frame.columns)}"
-        )
+def write_skipped_report(expected_date: date | None, path: str | None = None) -> None:
+    """期限付きの実行では、打ち切りがなくても報告を書く（成果物の有無で迷わないように）。"""
+    path = SKIPPED_REPORT if path is None else path
+    if _RUN_DEADLINE is None or not path or path == "0":
+        return
+    report = {
+        "run_id": TRACE_RUN_ID,
+        "expected_market_date": expected_date.isoformat() if expected_date else None,
+        "deadline_minutes": _RUN_DEADLINE_MINUTES,
+        **skipped_summary(),
+        "entries": _SKIPPED,
+    }
+    _atomic_write(
+        Path(path),
+        lambda temporary: temporary.write_text(json.dumps(report, ensure_ascii=False, indent=1), encoding="utf-8"),
+    )
 
-    work = frame.copy()
-    work["Close"] = pd.to_numeric(work["Close"], errors="coerce")
-    work["Volume"] = pd.to_numeric(work["Volume"], errors="coerce")
-    if "Dividends" in work.columns:
-        work["Dividends"] = pd.to_numeric(
-            work["Dividends"],
-            errors="coerce",
-        ).fillna(0)
-    work = work[work["Close"].notna() & (work["Close"] > 0)].copy()
-    work = work.sort_index()
-    if work.empty:
-        raise RuntimeError(f"{code}: Yahoo Financeに有効な終値がありません")
 
-    latest_timestamp = pd.Timestamp(work.index.max())
-    if latest_timestamp.tzinfo is not None:
-        latest_timestamp = latest_timestamp.tz_convert(JST).tz_localize(None)
-    latest_date = latest_timestamp.date()
+# ====== HTTP再試行ポリシー ======
+# IRBANK・JPX・Yahooで共通。ジッター付き指数バックオフ、Retry-Afterの尊重、
+# 429/503を受けたホストの送信間隔をAIMDで調整し、連続失敗でホストを遮断する。
+# リクエストは逐次なので、AIMDは並列数ではなくホストごとの送信間隔に掛ける。
+RETRYABLE_STATUS = {408, 425, 429, 500, 502, 503, 504}
+THROTTLE_STATUS = {429, 503}
+YAHOO_HOST = "query2.finance.yahoo.com"
 
-    if latest_date != expected_date:
-        raise RuntimeError(
-            f"{code}: stale Yahoo data "
-            f"expected={expected_date.isoformat()} received={latest_date.isoformat()}"
-        )
+T = TypeVar("T")
 
-    raw_closes = work["Close"].copy()
-    volumes = work["Volume"].fillna(0)
 
-    # YahooのCloseは株式分割前後で単位が変わることがある。
-    # Adj Closeは配当まで補正するため、25日線用には使わない。
-    # Stock Splitsだけを使い、過去の終値を現在の株数基準へ揃える。
-    split_adjusted_closes = raw_closes.copy()
-    split_events: list[tuple[str, float]] = []
+class CircuitOpenError(RuntimeError):
+    """遮断中のホストへのリクエスト。再試行せず即座に失敗させる。"""
 
-    if "Stock Splits" in work.columns:
-        split_factors = pd.to_numeric(
-            work["Stock Splits"],
-            errors="coerce",
-        ).fillna(0.0)
 
-        normalized_factors = split_factors.where(
-            split_factors > 0,
-            1.0,
-        )
+@dataclass
+class HostState:
+    consecutive_failures: int = 0
+    opened_until: float = 0.0
+    interval: float = 0.0
+    next_allowed: float = 0.0
+    requests: int = 0
+    failures: int = 0
+    throttled: int = 0
 
-        # 各日の「翌日以降」に発生した分割倍率の累積。
-        # 分割当日の終値はすでに分割後価格なので、その日の倍率は除外する。
-        future_split_factor = (
-            normalized_factors.iloc[::-1]
-            .cumprod()
-            .iloc[::-1]
-            / normalized_factors
-        )
 
-        split_adjusted_closes = raw_closes / future_split_factor
+_HOST_STATES: dict[str, HostState] = {}
 
-        for split_date, factor in split_factors[split_factors > 0].items():
-            split_events.append(
-                (
-                    pd.Timestamp(split_date).date().isoformat(),
-                    float(factor),
-                )
-            )
 
-    latest_price = float(raw_closes.iloc[-1])
-    latest_ma_price = float(split_adjusted_closes.iloc[-1])
+def host_of(url: str) -> str:
+    return urlsplit(url).netloc or url
 
-    # 最新日は将来の分割がないため、通常は両者が一致する。
-    if abs(latest_price - latest_ma_price) > max(0.01, latest_price * 0.001):
-        raise RuntimeError(
-            f"{code}: split adjustment changed the latest close unexpectedly "
-            f"raw={latest_price} adjusted={latest_ma_price}"
-        )
 
-    vol5 = int(round(float(volumes.tail(5).mean()))) if len(volumes) >= 5 else None
-    vol25 = int(round(float(volumes.tail(25).mean()))) if len(volumes) >= 25 else None
-    volume_ratio = safe_div(vol5, vol25)
+def host_state(host: str) -> HostState:
+    return _HOST_STATES.setdefault(host, HostState())
 
-    deviation_25ma = None
-    if len(raw_closes) >= 25:
-        raw_recent_25 = raw_closes.tail(25)
-        raw_ma25 = float(raw_recent_25.mean())
 
-        recent_start_date = pd.Timestamp(raw_recent_25.index.min()).date()
-        recent_end_date = pd.Timestamp(raw_recent_25.index.max()).date()
-        split_in_window = any(
-            recent_start_date <= date.fromisoformat(split_date) <= recent_end_date
-            for split_date, _ in split_events
+def parse_retry_after(value: str | None) -> float | None:
+    """Retry-After の秒数またはHTTP日付を秒へ変換する。"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        moment = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=ZoneInfo("UTC"))
+    return max(0.0, (moment - datetime.now(moment.tzinfo)).total_seconds())
+
+
+def retry_delay(attempt: int, retry_after: float | None = None) -> float:
+    """equal jitter の指数バックオフ。Retry-After があればそれより短くしない。"""
+    ceiling = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** (attempt - 1)))
+    delay = random.uniform(ceiling / 2, ceiling)
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, RETRY_MAX_DELAY * 4))
+    return delay
+
+
+def _check_circuit(host: str) -> None:
+    state = host_state(host)
+    remaining = state.opened_until - time.monotonic()
+    if remaining > 0:
+        raise CircuitOpenError(
+            f"{host} is failing repeatedly; circuit open for {remaining:.0f}s more"
         )
 
-        if split_in_window:
-            used_recent_25 = split_adjusted_closes.tail(25)
-            ma25_source = "split_adjusted_close"
-        else:
-            used_recent_25 = raw_recent_25
-            ma25_source = "raw_close"
 
-        ma25 = float(used_recent_25.mean())
+def _pace(host: str) -> None:
+    state = host_state(host)
+    wait = state.next_allowed - time.monotonic()
+    if wait > 0:
+        time.sleep(wait)
+    state.next_allowed = time.monotonic() + state.interval
+    state.requests += 1
 
-        # 25日移動平均線乖離率の定義を固定する。
-        # 終値が25MAより上ならプラス、下ならマイナス。
-        deviation_25ma = (
-            (latest_price / ma25) - 1.0
-        ) * 100.0
 
-        tolerance = max(1e-10, ma25 * 1e-12)
-        if latest_price > ma25 + tolerance:
-            position = "above"
-            expected_sign = "positive"
-            sign_is_valid = deviation_25ma > 0
-        elif latest_price < ma25 - tolerance:
-            position = "below"
-            expected_sign = "negative"
-            sign_is_valid = deviation_25ma < 0
-        else:
-            position = "equal"
-            expected_sign = "zero"
-            deviation_25ma = 0.0
-            sign_is_valid = True
+def record_success(host: str) -> None:
+    state = host_state(host)
+    state.consecutive_failures = 0
+    state.opened_until = 0.0
+    state.interval = max(0.0, state.interval - AIMD_DECREASE)
 
+
+def record_failure(host: str, *, throttled: bool = False) -> None:
+    state = host_state(host)
+    state.failures += 1
+    state.consecutive_failures += 1
+    if throttled:
+        state.throttled += 1
+        state.interval = min(AIMD_MAX_INTERVAL, max(0.5, state.interval * 2))
+    if state.consecutive_failures >= CIRCUIT_FAILURE_THRESHOLD:
+        state.opened_until = time.monotonic() + CIRCUIT_COOLDOWN
         print(
-            f"[DEBUG-25MA] {code} close={output_value(latest_price)} "
-            f"raw_ma25={output_value(raw_ma25)} "
-            f"used_ma25={output_value(ma25)} "
-            f"source={ma25_source} "
-            f"deviation={output_value(deviation_25ma)} "
-            f"position={position} expected_sign={expected_sign} "
-            f"sign_valid={sign_is_valid} "
-            f"formula=(close/ma25-1)*100 "
-            f"split_events={split_events or 'none'}",
+            f"[WARN] circuit opened host={host} "
+            f"consecutive_failures={state.consecutive_failures} "
+            f"cooldown={CIRCUIT_COOLDOWN:.0f}s",
             flush=True,
         )
 
-        if STRICT_DEVIATION_SIGN and not sign_is_valid:
-            raise RuntimeError(
-                f"{code}: 25MA乖離率の符号検証に失敗しました "
-                f"close={latest_price} ma25={ma25} "
-                f"deviation={deviation_25ma} "
-                f"position={position} expected={expected_sign}"
-            )
 
-    trailing_dividend = None
-    if "Dividends" in work.columns:
-        cutoff = pd.Timestamp(expected_date - timedelta(days=370))
-        dividend_rows = work.loc[work.index >= cutoff, "Dividends"]
-        trailing_dividend = float(dividend_rows.sum())
-        if abs(trailing_dividend) < 1e-12:
-            trailing_dividend = 0.0
+def http_get(
+    url: str,
+    *,
+    retries: int,
+    span: dict[str, Any] | None = None,
+    accept: Callable[[requests.Response], bool] | None = None,
+    **kwargs: Any,
+) -> requests.Response:
+    """
+    再試行ポリシー付きの SESSION.get。
+    再試行対象外のステータス（200/404等）はそのまま返し、
+    再試行を使い切った場合は最後の応答を返すか最後の例外を送出する。
+    accept が False を返した200応答も再試行対象として扱う（遮断の失敗回数には数えない）。
+    """
+    host = host_of(url)
+    timeout = kwargs.pop("timeout", REQUEST_TIMEOUT)
+    last_error: Exception | None = None
+    response: requests.Response | None = None
 
-    return {
-        "latest_date": latest_date,
-        "latest_price": latest_price,
-        "trailing_dividend": trailing_dividend,
-        "vol5": vol5,
-        "vol25": vol25,
-        "volratio_5_25": volume_ratio,
-        "deviation_25ma_pct": deviation_25ma,
-    }
+    for attempt in range(1, retries + 1):
+        if span is not None:
+            span["retries"] = attempt - 1
+        _check_circuit(host)
+        _pace(host)
+        left = time_left()
+        kwargs["timeout"] = timeout if left is None else min(timeout, max(1.0, left))
 
+        retry_after: float | None = None
+        try:
+            response = SESSION.get(url, **kwargs)
+            if span is not None:
+                trace_http(span, response)
+            status = response.status_code
+            if status not in RETRYABLE_STATUS and (
+                status != 200 or accept is None or accept(response)
+            ):
+                if status < 500:
+                    record_success(host)
+                return response
+
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            if status == 200:
+                # 本文の検証に落ちただけなら接続は正常。再試行はするが遮断の失敗には数えない。
+                reason = "unacceptable body"
+                record_success(host)
+            else:
+                reason = f"HTTP {status}"
+                record_failure(host, throttled=status in THROTTLE_STATUS)
+            if kwargs.get("stream") and attempt < retries:
+                response.close()
+        except requests.RequestException as exc:
+            last_error = exc
+            response = None
+            reason = f"{type(exc).__name__}: {exc}"
+            record_failure(host)
+
+        print(f"[WARN] {url} -> {reason} attempt={attempt}/{retries}", flush=True)
+        if attempt < retries:
+            delay = retry_delay(attempt, retry_after)
+            if deadline_reached(delay):
+                print(f"[DEADLINE] {url} -> no more retries", flush=True)
+                if span is not None:
+                    span["deadline_cut"] = True
+                break
+            if span is not None:
+                span["backoff_ms"] = round(span.get("backoff_ms", 0) + delay * 1000, 1)
+            # POLITE_SLEEP_SCALE は礼儀上の待機用。バックオフには掛けない。
+            time.sleep(delay)
+
+    if response is not None:
+        return response
+    assert last_error is not None
+    raise last_error
+
+
+def call_with_retry(
+    host: str,
+    function: Callable[[], T],
+    *,
+    retries: int,
+    label: str,
+    span: dict[str, Any] | None = None,
+    cancel: threading.Event | None = None,
+) -> T:
+    """
+    HTTP応答を直接扱えない呼び出し（yf.download等）へ同じポリシーを適用する。
+    cancel が立ったら（ヘッジで他の取得元が先に通ったなど）次の試行もバックオフの待機もしない。
+    """
+    last_error: Exception | None = None
+    for attempt in range(1, retries + 1):
+        if cancel is not None and cancel.is_set():
+            raise RuntimeError(f"{label} cancelled after {attempt - 1} attempts")
+        if span is not None:
+            span["retries"] = attempt - 1
+        _check_circuit(host)
+        _pace(host)
+        try:
+            result = function()
+            record_success(host)
+            return result
+        except CircuitOpenError:
+            raise
+        except Exception as exc:  # yfinance側の例外型変更にも耐える
+            last_error = exc
+            throttled = "ratelimit" in type(exc).__name__.lower() or "429" in str(exc)
+            record_failure(host, throttled=throttled)
+            print(
+                f"[WARN] {label} attempt {attempt}/{retries}: "
+                f"{type(exc).__name__}: {exc}",
+                flush=True,
+            )
+            if attempt < retries:
+                delay = retry_delay(attempt)
+                if deadline_reached(delay):
+                    print(f"[DEADLINE] {label} -> no more retries", flush=True)
+                    break
+                if cancel is not None:
+                    if cancel.wait(delay):
+                        raise RuntimeError(f"{label} cancelled after {attempt} attempts")
+                else:
+                    time.sleep(delay)
+
+    raise RuntimeError(f"{label} failed: {last_error}")
+
+
+def report_host_states() -> None:
+    for host, state in sorted(_HOST_STATES.items()):
+        print(
+            f"[HTTP] host={host} requests={state.requests} failures={state.failures} "
+            f"throttled={state.throttled} interval={state.interval:.2f}s "
+            f"circuit={'open' if state.opened_until > time.monotonic() else 'closed'}",
+            flush=True,
+        )
+        with trace_span("host.summary", host=host) as span:
+            span.update(
+                requests=state.requests,
+                failures=state.failures,
+                throttled=state.throttled,
+                interval_s=round(state.interval, 3),
+            )
 
-# ====== IRBANK CSV（HTMLは使用しない） ======
-def _norm_label(value: Any) -> str:
-    text = "" if value is None else unicodedata.normalize("NFKC", str(value))
-    text = re.sub(r"（.*?）|\(.*?\)", "", text)
-    return re.sub(r"[\s　,/％%円¥\-–—―]", "", text)
 
+# ====== 記録・再生（HTTPアーカイブ） ======
+# 1回の実行で見た応答を1つのZIP（deflate）へまとめる。index.json に順序どおりのエントリ、
+# 本文は sha256 名のメンバーで重複を除いて持つ。同じURLへの再試行も記録順に再生するため、
+# 429→200 のような経路もそのまま再現される。yf.download は独自のHTTPクライアントを使うので、
+# 呼び出し引数をキーに戻り値の DataFrame（pickle）を記録する。自分で記録した書庫だけを再生すること。
+HTTP_ARCHIVE_VERSION = 1
+_DROPPED_REPLAY_HEADERS = {"content-encoding", "transfer-encoding", "content-length"}
+
+
+class HttpArchive:
+    def __init__(self, path: Path, mode: str, timing: float = 0.0) -> None:
+        if mode not in ("record", "replay"):
+            raise ValueError(f"HTTP_ARCHIVE_MODE must be record or replay: {mode}")
+        self.path = path
+        self.mode = mode
+        self.timing = timing
+        self.entries: list[dict[str, Any]] = []
+        self.meta: dict[str, Any] = {}
+        self._members: set[str] = set()
+        self._queues: dict[str, deque[dict[str, Any]]] = {}
+        self._last: dict[str, dict[str, Any]] = {}
+        self._zip: zipfile.ZipFile | None = None
+        # ヘッジ取得で複数スレッドから記録・再生される。
+        self._lock = threading.Lock()
+
+        if mode == "record":
+            self._temporary = path.with_name(path.name + ".tmp")
+            self._zip = zipfile.ZipFile(self._temporary, "w", compression=zipfile.ZIP_DEFLATED)
+            self.meta = {
+                "version": HTTP_ARCHIVE_VERSION,
+                "recorded_at": datetime.now(JST).isoformat(timespec="seconds"),
+                "script_version": SCRIPT_VERSION,
+            }
+            return
+
+        self._zip = zipfile.ZipFile(path, "r")
+        index = json.loads(self._zip.read("index.json"))
+        if index.get("meta", {}).get("version") != HTTP_ARCHIVE_VERSION:
+            raise RuntimeError(f"HTTPアーカイブの版が違います: {path}")
+        self.meta = index["meta"]
+        self.entries = index["entries"]
+        for entry in self.entries:
+            self._queues.setdefault(entry["key"], deque()).append(entry)
+
+    @property
+    def recorded_at(self) -> datetime | None:
+        value = self.meta.get("recorded_at")
+        return datetime.fromisoformat(value) if value else None
+
+    # --- 記録 ---
+    def _store(self, body: bytes) -> str:
+        name = "bodies/" + hashlib.sha256(body).hexdigest()
+        if name not in self._members:
+            assert self._zip is not None
+            self._zip.writestr(name, body)
+            self._members.add(name)
+        return name
+
+    def record(self, key: str, *, elapsed: float, body: bytes | None = None, **fields: Any) -> None:
+        entry = {"key": key, "elapsed": round(elapsed, 6), **fields}
+        with self._lock:
+            if body is not None:
+                entry["body"] = self._store(body)
+            self.entries.append(entry)
+
+    # --- 再生 ---
+    def next_entry(self, key: str) -> dict[str, Any]:
+        """記録順に返す。記録より多く呼ばれた場合は最後の応答を繰り返す。"""
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue:
+                self._last[key] = queue.popleft()
+            elif key not in self._last:
+                raise requests.ConnectionError(f"not in HTTP archive ({self.path}): {key}")
+            entry = self._last[key]
+        if self.timing:
+            time.sleep(entry["elapsed"] * self.timing)
+        return entry
+
+    def body(self, entry: dict[str, Any]) -> bytes:
+        assert self._zip is not None
+        with self._lock:
+            return self._zip.read(entry["body"]) if "body" in entry else b""
+
+    def close(self) -> None:
+        if self._zip is None:
+            return
+        if self.mode == "record":
+            self._zip.writestr(
+                "index.json",
+                json.dumps({"meta": self.meta, "entries": self.entries}, ensure_ascii=False),
+            )
+            self._zip.close()
+            os.replace(self._temporary, self.path)
+            print(
+                f"[OK] HTTP archive recorded entries={len(self.entries)} "
+                f"bodies={len(self._members)} path={self.path}",
+                flush=True,
+            )
+        else:
+            self._zip.close()
+        self._zip = None
 
-EPS_KEYS = [
-    "EPS",
-    "EPS(円)",
-    "EPS（円）",
-    "1株当たり利益",
-    "1株当たり当期純利益",
-    "1株当たり当期純利益(円)",
-    "1株当たり当期純利益（円）",
-    "1株当たり純利益",
-]
-BPS_KEYS = [
-    "BPS",
-    "BPS(円)",
-    "BPS（円）",
-    "1株当たり純資産",
-    "1株当たり純資産(円)",
-    "1株当たり純資産（円）",
-    "1株純資産",
-]
-DPS_KEYS = [
-    "DPS",
-    "年間配当",
-    "1株配当",
-    "1株配当金",
-    "配当金",
-    "配当(円)",
-    "配当（円）",
-    "1株当たり配当金",
-]
-EQ_KEYS = [
-    "自己資本",
-    "自己資本合計",
-    "株主資本",
-    "株主資本合計",
-    "純資産",
-    "純資産合計",
-    "純資産の部合計",
-]
-AS_KEYS = ["総資産", "資産合計", "資産総額", "資産の部合計"]
-NI_KEYS = [
-    "当期純利益",
-    "親会社株主に帰属する当期純利益",
-    "親会社株主に帰属する純利益",
-    "純利益",
-]
-ROE_KEYS = ["ROE", "自己資本利益率"]
-EQR_KEYS = ["自己資本比率"]
 
+def _request_key(method: str, url: str) -> str:
+    return f"{method.upper()} {url}"
 
-def _label_matches(value: Any, keys: list[str]) -> bool:
-    heading = _norm_label(value)
-    if not heading:
-        return False
-    normalized_keys = [_norm_label(key) for key in keys]
-    return any(
-        key and (key == heading or key in heading)
-        for key in normalized_keys
-    )
 
+class ArchiveAdapter(HTTPAdapter):
+    """SESSION に差し込み、記録時は本文を読み切って保存、再生時は保存した応答を返す。"""
 
-def _label_matches_exact(value: Any, keys: list[str]) -> bool:
-    heading = _norm_label(value)
-    if not heading:
-        return False
-    return heading in {_norm_label(key) for key in keys if _norm_label(key)}
+    def __init__(self, archive: HttpArchive) -> None:
+        super().__init__()
+        self.archive = archive
 
+    def send(self, request: requests.PreparedRequest, *args: Any, **kwargs: Any) -> requests.Response:
+        key = _request_key(request.method or "GET", request.url or "")
+        if self.archive.mode == "replay":
+            entry = self.archive.next_entry(key)
+            if "error" in entry:
+                raise requests.ConnectionError(entry["error"])
+            return self._build(request, entry, self.archive.body(entry))
 
-def _looks_like_period(value: Any) -> bool:
-    """
-    年度・年月・日付を財務数値として誤読しない。
-    """
-    if value is None:
-        return False
+        started = time.perf_counter()
+        try:
+            response = super().send(request, *args, **kwargs)
+            body = response.content
+        except requests.RequestException as exc:
+            self.archive.record(key, elapsed=time.perf_counter() - started, error=f"{type(exc).__name__}: {exc}")
+            raise
+        entry = {
+            "status": response.status_code,
+            "reason": response.reason,
+            "headers": dict(response.headers),
+        }
+        self.archive.record(key, elapsed=time.perf_counter() - started, body=body, **entry)
+        # stream=True の呼び出し側が raw を読めるよう、読み切った本文から応答を作り直す。
+        return self._build(request, entry, body)
+
+    def _build(self, request: requests.PreparedRequest, entry: dict[str, Any], body: bytes) -> requests.Response:
+        headers = {
+            key: value
+            for key, value in entry["headers"].items()
+            if key.lower() not in _DROPPED_REPLAY_HEADERS
+        }
+        headers["Content-Length"] = str(len(body))
+        raw = urllib3.HTTPResponse(
+            body=io.BytesIO(body),
+            headers=headers,
+            status=entry["status"],
+            reason=entry.get("reason"),
+            preload_content=False,
+            decode_content=False,
+        )
+        return self.build_response(request, raw)
 
-    text = unicodedata.normalize("NFKC", str(value)).strip()
-    compact = re.sub(r"\s+", "", text)
 
-    if re.fullmatch(r"20\d{2}", compact):
-        return True
-    if re.search(
-        r"20\d{2}(?:[/.\-年])\d{1,2}(?:(?:[/.\-月])\d{1,2})?(?:日|期)?",
-        compact,
-    ):
-        return True
-    if re.fullmatch(r"(?:FY)?20\d{2}(?:Q[1-4]|[1-4]Q)?", compact, re.IGNORECASE):
-        return True
-    return False
+_HTTP_ARCHIVE: HttpArchive | None = None
 
 
-def _numeric_cell(value: Any) -> float | None:
-    if _looks_like_period(value):
+def open_http_archive(
+    path: str | None = None,
+    mode: str | None = None,
+    timing: float | None = None,
+) -> HttpArchive | None:
+    """HTTP_ARCHIVE 指定時に SESSION へアダプタを差し込む。"""
+    global _HTTP_ARCHIVE
+    path = HTTP_ARCHIVE if path is None else path
+    mode = HTTP_ARCHIVE_MODE if mode is None else mode
+    if not path or not mode:
         return None
-    return safe_float(value)
+    _HTTP_ARCHIVE = HttpArchive(Path(path), mode, HTTP_REPLAY_TIMING if timing is None else timing)
+    adapter = ArchiveAdapter(_HTTP_ARCHIVE)
+    SESSION.mount("http://", adapter)
+    SESSION.mount("https://", adapter)
+    print(
+        f"[CONFIG] http_archive mode={mode} path={path}"
+        + (f" recorded_at={_HTTP_ARCHIVE.meta.get('recorded_at')}" if mode == "replay" else ""),
+        flush=True,
+    )
+    return _HTTP_ARCHIVE
 
 
-def _iter_metric_candidates(
-    rows: list[list[str]],
-    keys: list[str],
-    *,
-    exact: bool,
-):
-    matcher = _label_matches_exact if exact else _label_matches
+def close_http_archive() -> None:
+    global _HTTP_ARCHIVE
+    if _HTTP_ARCHIVE is None:
+        return
+    _HTTP_ARCHIVE.close()
+    _HTTP_ARCHIVE = None
+    SESSION.mount("http://", HTTPAdapter())
+    SESSION.mount("https://", HTTPAdapter())
 
-    # A: 項目が縦に並ぶ形式
-    for row in rows:
-        if not row or not matcher(row[0], keys):
-            continue
-        for value in reversed(row[1:]):
-            number = _numeric_cell(value)
-            if number is not None:
-                yield number, value
 
-    # B: 項目がヘッダー列に並ぶ形式
-    header_limit = min(8, len(rows))
-    for header_index in range(header_limit):
-        header = rows[header_index]
-        for column, heading in enumerate(header):
-            if not matcher(heading, keys):
-                continue
-            for data_row in reversed(rows[header_index + 1:]):
-                if column >= len(data_row):
-                    continue
-                value = data_row[column]
-                number = _numeric_cell(value)
-                if number is not None:
-                    yield number, value
+def archive_clock() -> datetime | None:
+    """再生中は記録時刻を「現在」として扱う（期待する営業日を記録時と揃える）。"""
+    if _HTTP_ARCHIVE is not None and _HTTP_ARCHIVE.mode == "replay":
+        return _HTTP_ARCHIVE.recorded_at
+    return None
 
 
-def metric_value(
-    rows: list[list[str]] | None,
-    keys: list[str],
-) -> float | None:
-    """
-    IRBANK CSVの縦型・横型に対応。
-    完全一致を先に調べ、年度セルは採用しない。
-    """
-    if not rows:
-        return None
+def archived_call(label: str, function: Callable[..., T], **kwargs: Any) -> T:
+    """yf.download のような HTTP を直接見られない呼び出しを、引数をキーに記録・再生する。"""
+    archive = _HTTP_ARCHIVE
+    if archive is None:
+        return function(**kwargs)
 
-    for exact in (True, False):
-        for number, _ in _iter_metric_candidates(rows, keys, exact=exact):
-            return number
-    return None
+    key = f"CALL {label} " + json.dumps(kwargs, sort_keys=True, default=str)
+    if archive.mode == "replay":
+        entry = archive.next_entry(key)
+        if "error" in entry:
+            raise RuntimeError(entry["error"])
+        return pickle.loads(archive.body(entry))
 
+    started = time.perf_counter()
+    try:
+        result = function(**kwargs)
+    except Exception as exc:
+        archive.record(key, elapsed=time.perf_counter() - started, error=f"{type(exc).__name__}: {exc}")
+        raise
+    archive.record(key, elapsed=time.perf_counter() - started, body=pickle.dumps(result, protocol=5))
+    return result
 
-DIVIDEND_EXACT_KEYS = [
-    "DPS",
-    "年間配当",
-    "年間配当金",
-    "1株配当",
-    "1株配当金",
-    "1株当たり配当金",
-    "1株当たり年間配当金",
-    "配当合計",
-    "合計",
-]
 
+# ====== 常駐時のキャッシュ ======
+# daemon でだけ有効にする。同じ日の再実行では、取得済みの IRBANK CSV・検証済みの日足指標・
+# JPX信用倍率を使い回し、足りない分だけ取りに行く。日付が変わったら全て捨てる。
+_WARM_CACHE: dict[tuple[Any, ...], Any] | None = None
+_WARM_CACHE_DAY: date | None = None
 
-def dividend_per_share(rows: list[list[str]] | None) -> float | None:
-    """
-    配当CSV専用。
-    大見出しを年度列と誤認せず、年間合計列を優先する。
-    """
-    if not rows:
-        return None
 
-    for number, _ in _iter_metric_candidates(
-        rows,
-        DIVIDEND_EXACT_KEYS,
-        exact=True,
-    ):
-        if 0 <= number <= 100000:
-            return number
+def enable_warm_cache(day: date) -> None:
+    global _WARM_CACHE, _WARM_CACHE_DAY
+    if _WARM_CACHE is None or _WARM_CACHE_DAY != day:
+        _WARM_CACHE = {}
+        _WARM_CACHE_DAY = day
 
-    narrow_keys = [
-        "DPS",
-        "年間配当",
-        "1株配当",
-        "1株当たり配当金",
-    ]
-    for number, _ in _iter_metric_candidates(rows, narrow_keys, exact=False):
-        if 0 <= number <= 100000:
-            return number
 
-    non_period_numbers: list[float] = []
-    for row in rows:
-        for cell in row:
-            number = _numeric_cell(cell)
-            if number is not None:
-                non_period_numbers.append(number)
-    if non_period_numbers and all(number == 0 for number in non_period_numbers):
-        return 0.0
+def clear_warm_cache() -> None:
+    if _WARM_CACHE is not None:
+        _WARM_CACHE.clear()
 
-    return None
 
-def get_csv(code: str, path: str) -> list[list[str]] | None:
-    """数字4桁・英数字コードの両方を試す。404は欠損として扱う。"""
-    url = IR_CSV.format(code=code, path=path)
+def warm_get(key: tuple[Any, ...], default: Any = None) -> Any:
+    return default if _WARM_CACHE is None else _WARM_CACHE.get(key, default)
 
-    for attempt in range(1, IRBANK_RETRIES + 1):
-        try:
-            response = SESSION.get(url, timeout=REQUEST_TIMEOUT)
-            if response.status_code == 404:
-                print(f"[MISS] {url} -> HTTP 404", flush=True)
-                return None
-            if response.status_code != 200:
-                print(
-                    f"[WARN] {url} -> HTTP {response.status_code} "
-                    f"attempt={attempt}/{IRBANK_RETRIES}",
-                    flush=True,
-                )
-            else:
-                # IRBANKのCSVはUTF-8。apparent_encodingの誤判定を避ける。
-                response.encoding = "utf-8-sig"
-                rows = list(csv.reader(io.StringIO(response.text)))
-                if len(rows) >= 2:
-                    print(f"[OK] {url} rows={len(rows)}", flush=True)
-                    return rows
-                print(f"[WARN] {url} -> CSV too short", flush=True)
-        except requests.RequestException as exc:
-            print(
-                f"[WARN] {url} -> {type(exc).__name__}: {exc} "
-                f"attempt={attempt}/{IRBANK_RETRIES}",
-                flush=True,
-            )
 
-        polite_sleep(1.5 * attempt)
+def warm_put(key: tuple[Any, ...], value: Any) -> None:
+    if _WARM_CACHE is not None:
+        _WARM_CACHE[key] = value
 
-    print(f"[FAIL] {url}", flush=True)
-    return None
 
+# ====== 東証営業日の判定 ======
+# 営業日は同梱の xtks_sessions.txt（昇順のISO日付）から二分探索で引く。
+# exchange_calendars はカレンダー構築が重いため、表の再生成時にだけ使う。
+_XTKS_SESSIONS: list[date] | None = None
 
-def _first_available_metric(
-    sources: list[list[list[str]] | None],
-    keys: list[str],
-) -> float | None:
-    for rows in sources:
-        value = metric_value(rows, keys)
-        if value is not None:
-            return value
-    return None
 
+def regenerate_xtks_sessions(
+    path: Path | None = None,
+    *,
+    first_year: int = XTKS_SESSIONS_FIRST_YEAR,
+    last_year: int | None = None,
+) -> list[date]:
+    """
+    exchange_calendarsからXTKS営業日表を作り直す。
+    既定では翌年末までを収録するため、年1回の再生成で足りる。
+    """
+    import exchange_calendars as xcals
 
-def fetch_financial_values(code: str) -> dict[str, float | None]:
-    pl = get_csv(code, CSV_PL)
-    bs = get_csv(code, CSV_BS)
-    dividend = get_csv(code, CSV_DIV)
-    per_share = get_csv(code, CSV_PS)
+    path = path or XTKS_SESSIONS_FILE
+    last_year = last_year or datetime.now(JST).year + 1
 
-    # 個別CSVにない項目を一括CSVで補完する。必要なときだけ1回取得。
-    need_all = any(
-        value is None
-        for value in (
-            metric_value(pl, EPS_KEYS),
-            metric_value(pl, NI_KEYS),
-            metric_value(bs, BPS_KEYS),
-            metric_value(bs, EQ_KEYS),
-            metric_value(bs, AS_KEYS),
-            dividend_per_share(dividend),
-        )
+    calendar = xcals.get_calendar(
+        "XTKS",
+        start=pd.Timestamp(date(first_year, 1, 1)),
+        end=pd.Timestamp(date(last_year, 12, 31)),
     )
-    all_rows = get_csv(code, CSV_ALL) if need_all else None
-
-    eps = _first_available_metric([pl, per_share, all_rows], EPS_KEYS)
-    bps = _first_available_metric([bs, per_share, all_rows], BPS_KEYS)
-    profit = _first_available_metric([pl, all_rows], NI_KEYS)
-    equity = _first_available_metric([bs, all_rows], EQ_KEYS)
-    assets = _first_available_metric([bs, all_rows], AS_KEYS)
-    dps = dividend_per_share(dividend)
-    if dps is None:
-        dps = _first_available_metric([per_share, all_rows], DPS_KEYS)
-    roe_pct = _first_available_metric([pl, all_rows], ROE_KEYS)
-    equity_ratio_pct = _first_available_metric([bs, all_rows], EQR_KEYS)
-
-    found = {
-        "eps": eps,
-        "bps": bps,
-        "profit": profit,
-        "equity": equity,
-        "assets": assets,
-        "dps": dps,
-        "roe_pct": roe_pct,
-        "equity_ratio_pct": equity_ratio_pct,
-    }
+    sessions = [pd.Timestamp(session).date() for session in calendar.sessions]
+    if not sessions:
+        raise RuntimeError("XTKS営業日表を生成できませんでした")
+
+    header = [
+        "# XTKS trading sessions (one ISO date per line, ascending)",
+        f"# version={XTKS_SESSIONS_VERSION}",
+        f"# generated_at={datetime.now(JST).date().isoformat()}",
+        f"# generator=exchange_calendars {getattr(xcals, '__version__', 'unknown')}",
+        f"# coverage={date(first_year, 1, 1).isoformat()}..{date(last_year, 12, 31).isoformat()}",
+    ]
+    temporary_path = path.with_name(path.name + ".tmp")
+    temporary_path.write_text(
+        "\n".join(header + [session.isoformat() for session in sessions]) + "\n",
+        encoding="utf-8",
+    )
+    os.replace(temporary_path, path)
     print(
-        "[DEBUG-IRBANK] "
-        + code
-        + " "
-        + " ".join(
-            f"{key}={'yes' if value is not None else 'no'}"
-            for key, value in found.items()
-        ),
+        f"[OK] XTKS sessions table regenerated sessions={len(sessions)} "
+        f"first={sessions[0].isoformat()} last={sessions[-1].isoformat()} path={path}",
         flush=True,
     )
-    return found
+    return sessions
 
 
-def fetch_opinc_yoy(code: str) -> float | None:
-    rows = get_csv(code, CSV_QQ)
-    if not rows:
-        return None
+def _read_xtks_sessions(path: Path) -> tuple[list[date], date | None]:
+    """営業日表を読む。版が違う・読めない場合は空を返す。"""
+    if not path.exists():
+        return [], None
 
-    # 専用CSVは先頭列が期間、2列目が前年比。
-    for row in reversed(rows[1:]):
-        if len(row) < 2:
-            continue
-        value = row[1]
-        if _looks_like_period(value):
-            continue
-        number = safe_float(value)
-        if number is not None:
-            return number
+    sessions: list[date] = []
+    version: int | None = None
+    coverage_end: date | None = None
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("#"):
+                match = re.match(r"#\s*version=(\d+)", line)
+                if match:
+                    version = int(match.group(1))
+                match = re.match(r"#\s*coverage=\S+\.\.(\d{4}-\d{2}-\d{2})", line)
+                if match:
+                    coverage_end = date.fromisoformat(match.group(1))
+                continue
+            sessions.append(date.fromisoformat(line))
 
-    # レイアウト変更時の限定フォールバック。
-    for exact in (True, False):
-        for number, raw in _iter_metric_candidates(
-            rows,
-            [
-                "営業利益前年同期比",
-                "営業利益前年比",
-                "前年同期比",
-                "前年比",
-            ],
-            exact=exact,
-        ):
-            if not _looks_like_period(raw):
-                return number
+    if version != XTKS_SESSIONS_VERSION:
+        print(
+            f"[WARN] XTKS sessions table version mismatch "
+            f"found={version} expected={XTKS_SESSIONS_VERSION} path={path}",
+            flush=True,
+        )
+        return [], None
+    return sessions, coverage_end or (sessions[-1] if sessions else None)
 
-    return None
 
+def load_xtks_sessions(required_through: date | None = None) -> list[date]:
+    """
+    昇順のXTKS営業日リストを返す。
+    表が無い・古い・収録範囲が足りない場合だけ再生成する。
+    """
+    global _XTKS_SESSIONS
 
-# ====== JPX週次信用残高 ======
-def _parse_date_score(text: str) -> int:
-    normalized = unicodedata.normalize("NFKC", text)
-    patterns = [
-        r"(20\d{2})[年/_\-.]?(\d{1,2})[月/_\-.]?(\d{1,2})",
-        r"(20\d{2})(\d{2})(\d{2})",
-    ]
-    for pattern in patterns:
-        match = re.search(pattern, normalized)
-        if match:
-            try:
-                parsed = date(
-                    int(match.group(1)),
-                    int(match.group(2)),
-                    int(match.group(3)),
-                )
-                return int(parsed.strftime("%Y%m%d"))
-            except ValueError:
-                pass
-    return 0
+    required_through = required_through or datetime.now(JST).date()
+    if _XTKS_SESSIONS is None:
+        sessions, coverage_end = _read_xtks_sessions(XTKS_SESSIONS_FILE)
+        if not sessions or coverage_end is None or coverage_end < required_through:
+            print(
+                f"[WARN] XTKS sessions table does not cover "
+                f"{required_through.isoformat()}; regenerating",
+                flush=True,
+            )
+            sessions = regenerate_xtks_sessions(
+                last_year=max(required_through.year + 1, datetime.now(JST).year + 1),
+            )
+        _XTKS_SESSIONS = sessions
+    elif _XTKS_SESSIONS[-1] < required_through - timedelta(days=14):
+        # 常駐プロセス等で年をまたいだ場合のみ読み直す。
+        _XTKS_SESSIONS = None
+        return load_xtks_sessions(required_through)
+    return _XTKS_SESSIONS
 
 
-def _clean_embedded_url(value: str, base_url: str) -> str:
-    cleaned = unescape(value.strip().strip("'\""))
-    cleaned = cleaned.replace("\\/", "/")
-    cleaned = re.sub(
-        r"\\u002[fF]",
-        "/",
-        cleaned,
-    )
-    cleaned = cleaned.rstrip("\\")
-    return urljoin(base_url, cleaned)
+def is_xtks_session(day: date) -> bool:
+    sessions = load_xtks_sessions(day)
+    position = bisect.bisect_left(sessions, day)
+    return position < len(sessions) and sessions[position] == day
 
 
-STATIC_EXTENSIONS = (
-    ".css",
-    ".js",
-    ".mjs",
-    ".png",
-    ".jpg",
-    ".jpeg",
-    ".gif",
-    ".svg",
-    ".webp",
-    ".ico",
-    ".woff",
-    ".woff2",
-    ".ttf",
-    ".map",
-    ".xml",
-)
+def xtks_session_index(day: date) -> int:
+    """day以前で最も新しい営業日の添字。営業日同士の差で本数を数えられる。"""
+    sessions = load_xtks_sessions(day)
+    position = bisect.bisect_right(sessions, day) - 1
+    if position < 0:
+        raise RuntimeError(f"{day.isoformat()}以前の東証営業日が営業日表にありません")
+    return position
 
 
-def _is_static_asset_url(url: str) -> bool:
-    path = url.split("?", 1)[0].lower()
-    return path.endswith(STATIC_EXTENSIONS)
+def latest_xtks_session(day: date) -> date:
+    return load_xtks_sessions(day)[xtks_session_index(day)]
 
 
-def _candidate_urls_from_html(
-    html_text: str,
-    base_url: str,
-) -> list[tuple[int, int, str]]:
-    soup = BeautifulSoup(html_text, "html.parser")
-    raw_candidates: list[tuple[str, str, int]] = []
+def xtks_sessions_between(start: date, end: date) -> list[date]:
+    sessions = load_xtks_sessions(end)
+    return sessions[bisect.bisect_left(sessions, start) : bisect.bisect_right(sessions, end)]
 
-    for order, tag in enumerate(
-        soup.find_all(["a", "button", "iframe", "object", "embed"])
-    ):
-        context = tag.get_text(" ", strip=True)
-        parent = tag.find_parent(["tr", "li", "section", "article", "div"])
-        if parent is not None:
-            parent_text = parent.get_text(" ", strip=True)
-            if len(parent_text) <= 500:
-                context = f"{context} {parent_text}"
 
-        for attribute in (
-            "href",
-            "src",
-            "data",
-            "data-href",
-            "data-url",
-            "data-download",
-            "data-file",
-            "onclick",
-        ):
-            value = tag.get(attribute)
-            if value:
-                raw_candidates.append((str(value), context, order))
+def expected_market_date(now_jst: datetime | None = None) -> date:
+    """
+    本日が東証営業日の場合は、引け後の反映待ち時刻を過ぎてから本日を返す。
+    土日祝日は、直近の東証営業日を返す。
+    """
+    now_jst = now_jst or datetime.now(JST)
+    today = now_jst.date()
+    ready_time = parse_ready_time(MARKET_DATA_READY_TIME)
 
-    normalized_html = unescape(html_text).replace("\\/", "/")
-    normalized_html = re.sub(r"\\u002[fF]", "/", normalized_html)
-    embedded_pattern = re.compile(
-        r"""(?P<url>
-            (?:https?://|/|\.\.?/)
-            [^\s"'<>]+?
-            (?:
-                \.(?:xlsx?|csv|zip|pdf)(?:\?[^\s"'<>]*)?
-                |
-                (?:-att|_att)/[^\s"'<>]+
+    if is_xtks_session(today):
+        if now_jst.time().replace(tzinfo=None) < ready_time:
+            raise RuntimeError(
+                f"本日の東証日足が確定する前です。"
+                f"{today.isoformat()} {ready_time.strftime('%H:%M')} JST以降に実行してください。"
             )
-        )""",
-        re.VERBOSE | re.IGNORECASE,
+        return today
+
+    latest = latest_xtks_session(today)
+    if latest < today - timedelta(days=30):
+        raise RuntimeError("直近の東証営業日を判定できませんでした")
+    return latest
+
+
+# ====== Yahoo Finance（日足・出来高） ======
+# 指標計算で使う列と型。Open・Adj Close は使わないため保持しない。
+# すべて float64 のまま持つ。配当・分割も分割係数と配当合計に使うため、
+# float32 にすると 7.6 が 7.5999999 になり、出力の4桁丸めが変わりうる。
+YAHOO_FRAME_DTYPES = {
+    "High": "float64",
+    "Low": "float64",
+    "Close": "float64",
+    "Volume": "float64",
+    "Dividends": "float64",
+    "Stock Splits": "float64",
+}
+
+
+def _compact_price_frame(frame: pd.DataFrame) -> pd.DataFrame:
+    """必要列だけを持つ独立した日足にする（チャンク全体を参照し続けない）。"""
+    columns = [column for column in YAHOO_FRAME_DTYPES if column in frame.columns]
+    return pd.DataFrame(
+        {
+            column: pd.to_numeric(frame[column], errors="coerce").astype(YAHOO_FRAME_DTYPES[column])
+            for column in columns
+        },
+        index=frame.index,
     )
-    for order, match in enumerate(
-        embedded_pattern.finditer(normalized_html),
-        start=100000,
-    ):
-        raw_candidates.append((match.group("url"), "", order))
 
-    extension_scores = {
-        ".xlsx": 80,
-        ".xls": 70,
-        ".csv": 60,
-        ".zip": 50,
-        ".pdf": 40,
-    }
 
-    result: list[tuple[int, int, str]] = []
-    seen: set[str] = set()
+def _extract_symbol_frame(downloaded: pd.DataFrame, symbol: str) -> pd.DataFrame:
+    if downloaded is None or downloaded.empty:
+        return pd.DataFrame()
 
-    for raw_url, context, order in raw_candidates:
-        possible_values = [raw_url]
-        possible_values.extend(re.findall(r"""["']([^"']+)["']""", raw_url))
+    # 銘柄の列はビューのまま取り出し、_compact_price_frame で一度だけ複製する。
+    frame: pd.DataFrame
+    if isinstance(downloaded.columns, pd.MultiIndex):
+        level0 = {str(value) for value in downloaded.columns.get_level_values(0)}
+        level1 = {str(value) for value in downloaded.columns.get_level_values(1)}
 
-        for possible in possible_values:
-            url = _clean_embedded_url(possible, base_url)
-            if not url.startswith(("http://", "https://")):
-                continue
-            if url in seen or url.rstrip("/") == base_url.rstrip("/"):
-                continue
-            if _is_static_asset_url(url):
-                continue
+        if symbol in level0:
+            frame = downloaded[symbol]
+        elif symbol in level1:
+            frame = downloaded.xs(symbol, axis=1, level=1)
+        else:
+            return pd.DataFrame()
+    else:
+        frame = downloaded
 
-            lower_path = url.split("?", 1)[0].lower()
-            extension = next(
-                (ext for ext in extension_scores if lower_path.endswith(ext)),
-                "",
-            )
+    if frame.empty:
+        return pd.DataFrame()
 
-            normalized_context = _norm_label(f"{context} {url}")
-            has_margin_context = any(
-                key in normalized_context
-                for key in (
-                    "信用取引週末残高",
-                    "銘柄別信用",
-                    "endofweekoutstandingmargin",
-                    "applicationbased",
-                    "申込分",
-                )
-            )
-            has_attachment_path = any(
-                marker in lower_path
-                for marker in (
-                    "-att/",
-                    "_att/",
-                    "/download/",
-                    "/files/",
-                )
-            )
+    frame = _compact_price_frame(frame).dropna(how="all")
+    frame.index = pd.to_datetime(frame.index, errors="coerce")
+    frame = frame[frame.index.notna()].sort_index()
+    return frame
 
-            if not extension and not has_attachment_path:
+
+def _yahoo_chart_frame(payload: dict[str, Any]) -> pd.DataFrame:
+    """chart APIのJSONを yf.download と同じ列構成の日足へ変換する。"""
+    results = (payload.get("chart") or {}).get("result") or []
+    if not results:
+        return pd.DataFrame()
+    result = results[0]
+    timestamps = result.get("timestamp") or []
+    if not timestamps:
+        return pd.DataFrame()
+
+    quote = ((result.get("indicators") or {}).get("quote") or [{}])[0]
+    adjclose = ((result.get("indicators") or {}).get("adjclose") or [{}])[0]
+    index = pd.DatetimeIndex(
+        pd.to_datetime(timestamps, unit="s", utc=True)
+        .tz_convert(JST)
+        .tz_localize(None)
+        .normalize(),
+        name="Date",
+    )
+    frame = pd.DataFrame(
+        {
+            "Open": quote.get("open"),
+            "High": quote.get("high"),
+            "Low": quote.get("low"),
+            "Close": quote.get("close"),
+            "Adj Close": adjclose.get("adjclose", quote.get("close")),
+            "Volume": quote.get("volume"),
+        },
+        index=index,
+        dtype="float64",
+    )
+
+    events = result.get("events") or {}
+    dividends = pd.Series(0.0, index=index)
+    for event in (events.get("dividends") or {}).values():
+        day = pd.Timestamp(event["date"], unit="s", tz="UTC").tz_convert(JST).tz_localize(None).normalize()
+        if day in dividends.index:
+            dividends[day] += float(event.get("amount") or 0)
+    splits = pd.Series(0.0, index=index)
+    for event in (events.get("splits") or {}).values():
+        day = pd.Timestamp(event["date"], unit="s", tz="UTC").tz_convert(JST).tz_localize(None).normalize()
+        numerator = float(event.get("numerator") or 0)
+        denominator = float(event.get("denominator") or 0)
+        if day in splits.index and numerator > 0 and denominator > 0:
+            splits[day] = numerator / denominator
+    frame["Dividends"] = dividends
+    frame["Stock Splits"] = splits
+    return frame[~frame.index.duplicated(keep="last")]
+
+
+def _yahoo_window(start: date | None, end: date | None) -> dict[str, Any]:
+    """yf.download と chart API に渡す期間。start指定時は period の代わりに使う。"""
+    if start is None:
+        return {"period": YAHOO_PERIOD}
+    return {"start": start.isoformat(), "end": (end or datetime.now(JST).date()) + timedelta(days=1)}
+
+
+def download_yahoo_chart(
+    symbols: list[str],
+    *,
+    start: date | None = None,
+    end: date | None = None,
+    cancel: threading.Event | None = None,
+) -> dict[str, pd.DataFrame]:
+    """YAHOO_CHART_BASE_URL 指定時の取得経路。1銘柄1リクエスト。cancel が立てば残りを取らない。"""
+    params: dict[str, Any] = {"range": YAHOO_PERIOD, "interval": "1d", "events": "div,splits"}
+    if start is not None:
+        last = (end or datetime.now(JST).date()) + timedelta(days=1)
+        params.pop("range")
+        params["period1"] = int(datetime.combine(start, dt_time(0, 0), JST).timestamp())
+        params["period2"] = int(datetime.combine(last, dt_time(0, 0), JST).timestamp())
+
+    result: dict[str, pd.DataFrame] = {}
+    for symbol in symbols:
+        if cancel is not None and cancel.is_set():
+            break
+        url = f"{YAHOO_CHART_BASE_URL}/v8/finance/chart/{symbol}"
+        with trace_span("yahoo.request", url=url, symbol=symbol, cache="miss") as span:
+            response = http_get(
+                url,
+                retries=YAHOO_RETRIES,
+                span=span,
+                params=params,
+            )
+            if response.status_code == 404:
+                result[symbol] = pd.DataFrame()
                 continue
+            response.raise_for_status()
+            result[symbol] = _extract_symbol_frame(_yahoo_chart_frame(response.json()), symbol)
+            span["rows"] = len(result[symbol])
+    return result
 
-            date_score = _parse_date_score(f"{context} {url}")
-            score = extension_scores.get(extension, 10)
-            if has_margin_context:
-                score += 100
-            if has_attachment_path:
-                score += 25
 
-            seen.add(url)
-            result.append((date_score, score, url))
+def download_yahoo_chunk(
+    symbols: list[str],
+    *,
+    start: date | None = None,
+    end: date | None = None,
+    expected_date: date | None = None,
+) -> dict[str, pd.DataFrame]:
+    with trace_span("yahoo.chunk", symbols=len(symbols), first=symbols[0] if symbols else None) as span:
+        result = fetch_price_chunk(symbols, span, start=start, end=end, expected_date=expected_date)
+        span["rows"] = sum(len(frame) for frame in result.values())
+        span["empty_symbols"] = sum(1 for frame in result.values() if frame.empty)
+        return result
+
+
+def _download_yahoo_chunk(
+    symbols: list[str],
+    span: dict[str, Any],
+    *,
+    start: date | None = None,
+    end: date | None = None,
+    cancel: threading.Event | None = None,
+) -> dict[str, pd.DataFrame]:
+    if YAHOO_CHART_BASE_URL:
+        # 銘柄ごとのリクエストが http_get で再試行されるため、ここでは1回だけ。
+        result = download_yahoo_chart(symbols, start=start, end=end, cancel=cancel)
+        if any(not frame.empty for frame in result.values()):
+            return result
+        raise RuntimeError("Yahoo chart API returned no usable rows")
+
+    def attempt() -> dict[str, pd.DataFrame]:
+        downloaded = archived_call(
+            "yf.download",
+            yf.download,
+            tickers=symbols,
+            **_yahoo_window(start, end),
+            interval="1d",
+            group_by="ticker",
+            auto_adjust=False,
+            actions=True,
+            threads=False,
+            # 価格補修機能は追加依存が必要なため無効化。
+            repair=False,
+            keepna=False,
+            progress=False,
+            timeout=REQUEST_TIMEOUT,
+            multi_level_index=True,
+        )
+
+        result = {
+            symbol: _extract_symbol_frame(downloaded, symbol)
+            for symbol in symbols
+        }
+        if any(not frame.empty for frame in result.values()):
+            return result
+        raise RuntimeError("Yahoo Finance returned no usable rows")
+
+    return call_with_retry(
+        YAHOO_HOST,
+        attempt,
+        retries=YAHOO_RETRIES,
+        label="Yahoo Finance download",
+        span=span,
+        cancel=cancel,
+    )
+
+
+# ====== 日足の取得元（主: Yahoo、副: Stooq） ======
+# どの取得元も {symbol: 日足} を返し、日足は _extract_symbol_frame と同じ列・型・索引にそろえる。
+STOOQ_COLUMNS = {"Date", "High", "Low", "Close", "Volume"}
+PERIOD_DAYS = {"1d": 1, "5d": 5, "1mo": 31, "3mo": 92, "6mo": 183, "1y": 366, "2y": 731, "5y": 1827, "10y": 3653}
+
+
+@dataclass(frozen=True)
+class PriceProvider:
+    name: str
+    fetch: Callable[..., dict[str, pd.DataFrame]]
+
+
+def stooq_symbol(symbol: str) -> str:
+    """7203.T → 7203.jp（英字入りのコードは小文字）。"""
+    return symbol.removesuffix(".T").lower() + ".jp"
+
+
+def _stooq_frame(text: str) -> pd.DataFrame:
+    """StooqのCSV（Date,Open,High,Low,Close,Volume）を日足にする。価格は分割調整済み。"""
+    try:
+        frame = pd.read_csv(io.StringIO(text))
+    except (pd.errors.EmptyDataError, pd.errors.ParserError):
+        return pd.DataFrame()
+    if not STOOQ_COLUMNS.issubset(frame.columns):
+        # 該当なしは 200 で "No data" を返す。
+        return pd.DataFrame()
+    frame.index = pd.DatetimeIndex(pd.to_datetime(frame.pop("Date"), errors="coerce"), name="Date")
+    # 配当・分割の列は作らない。配当が無いのか不明なのかを区別できないため、
+    # yahoo_metrics の trailing_dividend は None（0%ではなく空欄）になる。
+    return frame[~frame.index.duplicated(keep="last")]
+
 
+def download_stooq_chunk(
+    symbols: list[str],
+    span: dict[str, Any],
+    *,
+    start: date | None = None,
+    end: date | None = None,
+    cancel: threading.Event | None = None,
+) -> dict[str, pd.DataFrame]:
+    """Stooqの日足CSV。1銘柄1リクエストで、期間は d1/d2 で絞る。cancel が立てば残りを取らない。"""
+    last = end or datetime.now(JST).date()
+    first = start
+    if first is None and YAHOO_PERIOD in PERIOD_DAYS:
+        first = last - timedelta(days=PERIOD_DAYS[YAHOO_PERIOD])
+    params: dict[str, Any] = {"i": "d", "d2": last.strftime("%Y%m%d")}
+    if first is not None:
+        params["d1"] = first.strftime("%Y%m%d")
+
+    result: dict[str, pd.DataFrame] = {}
+    url = f"{STOOQ_BASE_URL}/q/d/l/"
+    for symbol in symbols:
+        if cancel is not None and cancel.is_set():
+            break
+        with trace_span("stooq.request", url=url, symbol=symbol, cache="miss") as request_span:
+            response = http_get(
+                url,
+                retries=STOOQ_RETRIES,
+                span=request_span,
+                params={"s": stooq_symbol(symbol), **params},
+            )
+            if response.status_code == 404:
+                result[symbol] = pd.DataFrame()
+                continue
+            response.raise_for_status()
+            result[symbol] = _extract_symbol_frame(_stooq_frame(response.text), symbol)
+            request_span["rows"] = len(result[symbol])
     return result
 
-def discover_jpx_margin_candidates() -> list[str]:
-    if JPX_MARGIN_URL_OVERRIDE:
-        return [JPX_MARGIN_URL_OVERRIDE]
 
-    all_candidates: list[tuple[int, int, str]] = []
-    visited_pages: set[str] = set()
-    page_queue = [JPX_MARGIN_PAGE, JPX_MARGIN_PAGE_EN]
+PRICE_PROVIDER_REGISTRY = {
+    "yahoo": PriceProvider("yahoo", _download_yahoo_chunk),
+    "stooq": PriceProvider("stooq", download_stooq_chunk),
+}
 
-    # JPXページはJavaScript生成の場合があるため、iframe先も1階層だけ確認。
-    while page_queue and len(visited_pages) < 8:
-        page_url = page_queue.pop(0)
-        if page_url in visited_pages:
-            continue
-        visited_pages.add(page_url)
 
-        response = SESSION.get(page_url, timeout=REQUEST_TIMEOUT)
-        response.raise_for_status()
-        all_candidates.extend(
-            _candidate_urls_from_html(response.text, page_url)
-        )
+def parse_price_providers(value: str) -> list[PriceProvider]:
+    names = [name.strip().lower() for name in value.split(",") if name.strip()]
+    unknown = [name for name in names if name not in PRICE_PROVIDER_REGISTRY]
+    if unknown or not names:
+        raise ValueError(f"unknown PRICE_PROVIDERS: {', '.join(unknown) or value!r}")
+    return [PRICE_PROVIDER_REGISTRY[name] for name in dict.fromkeys(names)]
 
-        soup = BeautifulSoup(response.text, "html.parser")
-        for iframe in soup.find_all("iframe", src=True):
-            iframe_url = urljoin(page_url, iframe.get("src", ""))
-            if iframe_url.startswith("https://www.jpx.co.jp/"):
-                page_queue.append(iframe_url)
 
-    if not all_candidates:
-        raise RuntimeError(
-            "JPXページから信用残高のダウンロード候補を発見できませんでした"
-        )
+_PRICE_PROVIDERS = parse_price_providers(PRICE_PROVIDERS)
+# 主取得元のチャンク所要時間（秒）。常駐時は日をまたいで直近分を使う。
+_PRIMARY_LATENCIES: deque[float] = deque(maxlen=200)
+HEDGE_MIN_SAMPLES = 5
+_PRICE_EXECUTOR: ThreadPoolExecutor | None = None
 
-    all_candidates.sort(reverse=True)
-    ordered: list[str] = []
-    seen: set[str] = set()
-    for _, _, url in all_candidates:
-        if url not in seen:
-            ordered.append(url)
-            seen.add(url)
-    return ordered
 
+def hedge_budget() -> float:
+    """副取得元へ投げるまでの待ち時間。実測が少ないうちは HEDGE_INITIAL_SECONDS。"""
+    if len(_PRIMARY_LATENCIES) < HEDGE_MIN_SAMPLES:
+        return HEDGE_INITIAL_SECONDS
+    return max(HEDGE_MIN_SECONDS, float(np.quantile(np.fromiter(_PRIMARY_LATENCIES, float), HEDGE_PERCENTILE)))
 
-def _payload_kind(url: str, content_type: str, content: bytes) -> str:
-    lower_url = url.split("?", 1)[0].lower()
-    lower_type = content_type.lower()
 
-    if content.startswith(b"%PDF") or "application/pdf" in lower_type or lower_url.endswith(".pdf"):
-        return "pdf"
-    if content.startswith(b"\xD0\xCF\x11\xE0") or lower_url.endswith(".xls"):
-        return "excel"
-    if content.startswith(b"PK\x03\x04"):
-        try:
-            with zipfile.ZipFile(io.BytesIO(content)) as archive:
-                names = set(archive.namelist())
+def _accept_price_frame(frame: pd.DataFrame, expected_date: date | None) -> bool:
+    """終値・出来高があり、期待日が分かっていればその日まで届いている日足だけ採用する。"""
+    if frame is None or frame.empty or "Close" not in frame.columns or "Volume" not in frame.columns:
+        return False
+    closes = frame["Close"].dropna()
+    if closes.empty:
+        return False
+    return expected_date is None or closes.index.max().date() >= expected_date
+
+
+def _fetch_with(
+    provider: PriceProvider,
+    symbols: list[str],
+    *,
+    start: date | None,
+    end: date | None,
+    cancel: threading.Event,
+) -> dict[str, pd.DataFrame]:
+    with trace_span("price.fetch", provider=provider.name, symbols=len(symbols)) as span:
+        result = provider.fetch(symbols, span, start=start, end=end, cancel=cancel)
+        span["cancelled"] = cancel.is_set()
+        return result
+
+
+def fetch_price_chunk(
+    symbols: list[str],
+    span: dict[str, Any],
+    *,
+    start: date | None = None,
+    end: date | None = None,
+    expected_date: date | None = None,
+) -> dict[str, pd.DataFrame]:
+    """
+    主取得元に投げ、hedge_budget() 秒たっても返らない、または返っても検証を通らない銘柄だけ
+    副取得元へ投げる。銘柄ごとに、先に検証を通った日足を採用する。
+    どちらも通らなければ主取得元の日足（または空）を返し、理由は yahoo_metrics に報告させる。
+    """
+    global _PRICE_EXECUTOR
+    primary = _PRICE_PROVIDERS[0]
+    if len(_PRICE_PROVIDERS) == 1:
+        started = time.perf_counter()
+        result = primary.fetch(symbols, span, start=start, end=end)
+        _PRIMARY_LATENCIES.append(time.perf_counter() - started)
+        return result
+
+    secondary = _PRICE_PROVIDERS[1]
+    if _PRICE_EXECUTOR is None:
+        _PRICE_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="price")
+    budget = hedge_budget()
+    left = time_left()
+    if left is not None:
+        # 期限が近いほど早めに副取得元へ投げる。
+        budget = min(budget, max(0.0, left / 2))
+    span["hedge_budget_s"] = round(budget, 3)
+
+    accepted: dict[str, pd.DataFrame] = {}
+    winners: Counter[str] = Counter()
+    fallback: dict[str, pd.DataFrame] = {}
+    started = time.perf_counter()
+    providers: dict[Future, PriceProvider] = {}
+    cancel = threading.Event()
+
+    def submit(provider: PriceProvider, targets: list[str]) -> Future:
+        assert _PRICE_EXECUTOR is not None
+        future = _PRICE_EXECUTOR.submit(
+            in_current_span(_fetch_with), provider, targets, start=start, end=end, cancel=cancel
+        )
+        providers[future] = provider
+        return future
+
+    pending = {submit(primary, symbols)}
+    hedged = False
+    while pending and len(accepted) < len(symbols):
+        timeout = None if hedged else max(0.0, budget - (time.perf_counter() - started))
+        done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            provider = providers[future]
+            if provider is primary:
+                _PRIMARY_LATENCIES.append(time.perf_counter() - started)
+            try:
+                frames = future.result()
+            except Exception as exc:
+                print(f"[WARN] {provider.name} price fetch failed: {type(exc).__name__}: {exc}", flush=True)
+                frames = {}
+            for symbol, frame in frames.items():
+                if symbol in accepted:
+                    continue
+                if _accept_price_frame(frame, expected_date):
+                    accepted[symbol] = frame
+                    winners[provider.name] += 1
+                elif provider is primary:
+                    fallback[symbol] = frame
+
+        if hedged:
+            continue
+        # 予算切れ、または主取得元が検証を通らない銘柄を残して返った時点で副取得元へ投げる。
+        missing = [symbol for symbol in symbols if symbol not in accepted]
+        if missing and (not done or not pending):
+            hedged = True
+            reason = "slow" if not done else "invalid"
+            span["hedged"] = len(missing)
+            span["hedge_reason"] = reason
+            print(
+                f"[HEDGE] {secondary.name} for {len(missing)} symbols "
+                f"({reason}, budget={budget:.1f}s)",
+                flush=True,
+            )
+            pending.add(submit(secondary, missing))
+
+    span["providers"] = dict(winners)
+    # 負けた方は残りの銘柄を取らずに打ち切る。主取得元が未完了なら、ここまでの時間を
+    # 下限として記録する（記録しないと速い回だけが残り、予算が縮み続ける）。
+    cancel.set()
+    if not any(future.done() for future, provider in providers.items() if provider is primary):
+        _PRIMARY_LATENCIES.append(time.perf_counter() - started)
+    return {symbol: accepted.get(symbol, fallback.get(symbol, pd.DataFrame())) for symbol in symbols}
+
+
+def iter_yahoo_chunks(
+    codes: list[str],
+    *,
+    start: date | None = None,
+    end: date | None = None,
+    expected_date: date | None = None,
+) -> Iterator[tuple[list[str], dict[str, pd.DataFrame]]]:
+    """
+    YAHOO_CHUNK_SIZE 銘柄ずつ取得し、(コード, {symbol: 日足}) を順に返す。
+    呼び出し側が結果だけ残して次へ進めば、保持する日足は1チャンク分で済む。
+    expected_date を渡すと、その日に届かない日足は副取得元で取り直す。
+    """
+    for offset in range(0, len(codes), YAHOO_CHUNK_SIZE):
+        if deadline_reached():
+            for code in codes[offset:]:
+                record_skip("yahoo", code)
+            print(f"[DEADLINE] Yahoo: {len(codes) - offset} tickers not fetched", flush=True)
+            return
+        chunk = codes[offset : offset + YAHOO_CHUNK_SIZE]
+        symbols = [yahoo_symbol(code) for code in chunk]
+        yield chunk, download_yahoo_chunk(symbols, start=start, end=end, expected_date=expected_date)
+        if offset + YAHOO_CHUNK_SIZE < len(codes):
+            polite_sleep(YAHOO_CHUNK_SLEEP_SECONDS)
+
+
+def yahoo_market_metrics(
+    codes: list[str],
+    expected_date: date,
+    prices: PriceSource | None = None,
+    *,
+    through: bool = False,
+) -> tuple[dict[str, dict[str, Any]], list[str]]:
+    """
+    チャンクごとに取得→yahoo_metrics で検証し、結果の dict とエラーだけを残す。
+    日足はチャンクを処理し終えた時点で解放する。prices の既定は NetworkPrices。
+    through=True なら expected_date より後の足を落としてから検証する（過去日の再計算用）。
+    """
+    prices = prices or NetworkPrices()
+    market_metrics: dict[str, dict[str, Any]] = {}
+    errors: list[str] = []
+    # 常駐時は同じ日に検証済みの銘柄を取り直さない（通信で得た値だけを使い回す）。
+    cache = isinstance(prices, NetworkPrices)
+    for code in codes if cache else ():
+        cached = warm_get(("yahoo", code, expected_date))
+        if cached is not None:
+            market_metrics[code] = cached
+    pending = [code for code in codes if code not in market_metrics]
+    if len(pending) < len(codes):
+        print(f"[CACHE] Yahoo metrics reused={len(codes) - len(pending)} fetch={len(pending)}", flush=True)
+
+    index = len(codes) - len(pending)
+    for chunk, frames in prices.iter_frames(pending, expected_date):
+        with trace_span("validation", tickers=len(chunk)) as span:
+            for code in chunk:
+                index += 1
+                print(f"[{index}/{len(codes)}] {code} Yahoo validation", flush=True)
+                try:
+                    frame = frames.pop(code, pd.DataFrame())
+                    if through and not frame.empty:
+                        frame = frame[pd.Index(frame.index).date <= expected_date]
+                    market_metrics[code] = yahoo_metrics(code, frame, expected_date)
+                    if cache:
+                        warm_put(("yahoo", code, expected_date), market_metrics[code])
+                    print(
+                        f"[OK] {code} Yahoo date="
+                        f"{market_metrics[code]['latest_date'].isoformat()} "
+                        f"price={output_value(market_metrics[code]['latest_price'])}",
+                        flush=True,
+                    )
+                except Exception as exc:
+                    error = f"{type(exc).__name__}: {exc}"
+                    errors.append(error)
+                    print(f"[ERROR] {error}", flush=True)
+            span["errors"] = sum(1 for code in chunk if code not in market_metrics)
+        del frames
+    return market_metrics, errors
+
+
+def readiness_sentinels(codes: list[str]) -> list[str]:
+    configured = [normalize_code_line(value) for value in READINESS_SYMBOLS.split(",")]
+    configured = [code for code in configured if code]
+    return configured or codes[:READINESS_SENTINELS]
+
+
+def probe_market_data(
+    sentinels: list[str],
+    expected_date: date,
+    span: dict[str, Any],
+) -> tuple[bool, dict[str, str | None]]:
+    """
+    主取得元から直近10日分だけ取り、半数以上の銘柄に expected_date の足があれば準備完了。
+    売買停止中の銘柄が1つ混じっていても待ち続けないよう、全件一致は求めない。
+    """
+    symbols = [yahoo_symbol(code) for code in sentinels]
+    try:
+        frames = _PRICE_PROVIDERS[0].fetch(
+            symbols,
+            span,
+            start=expected_date - timedelta(days=10),
+            end=expected_date,
+        )
+    except Exception as exc:
+        print(f"[WARN] readiness probe failed: {type(exc).__name__}: {exc}", flush=True)
+        return False, {}
+    latest = {
+        symbol: (None if frame.empty else pd.Timestamp(frame.index.max()).date().isoformat())
+        for symbol, frame in frames.items()
+    }
+    ready = sum(1 for symbol in symbols if _accept_price_frame(frames.get(symbol), expected_date))
+    return ready * 2 >= len(symbols), latest
+
+
+def wait_for_market_data(codes: list[str], expected_date: date) -> bool:
+    """当日の日足が出るまで、少数の銘柄だけを間隔を広げながら確かめる。"""
+    sentinels = readiness_sentinels(codes)
+    limit = READINESS_WAIT_MINUTES * 60
+    with trace_span("readiness", sentinels=len(sentinels)) as span:
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            ready, latest = probe_market_data(sentinels, expected_date, span)
+            span["attempts"] = attempt
+            if ready:
+                span["waited_s"] = round(time.monotonic() - started, 1)
+                print(f"[READY] {expected_date.isoformat()} bars found attempt={attempt}", flush=True)
+                return True
+
+            delay = min(READINESS_MAX_POLL_SECONDS, READINESS_POLL_SECONDS * 2 ** (attempt - 1))
+            remaining = limit - (time.monotonic() - started)
+            left = time_left()
+            if left is not None:
+                remaining = min(remaining, left)
+            if delay > remaining:
+                span["waited_s"] = round(time.monotonic() - started, 1)
+                span["ready"] = False
+                print(f"[NOT READY] latest={latest}", flush=True)
+                return False
+            print(
+                f"[WAIT] {expected_date.isoformat()} bars not posted yet latest={latest} "
+                f"retry_in={delay:.0f}s",
+                flush=True,
+            )
+            time.sleep(delay)
+
+
+def _prepare_yahoo_frame(code: str, frame: pd.DataFrame) -> pd.DataFrame:
+    """数値化・無効終値の除去・日付順の整列。yahoo_metrics とバックフィルで共通。"""
+    if frame.empty:
+        raise RuntimeError(f"{code}: Yahoo Financeの日足が0件です")
+    if "Close" not in frame.columns or "Volume" not in frame.columns:
+        raise RuntimeError(
+            f"{code}: Yahoo Financeの必要列がありません: {list(frame.columns)}"
+        )
+
+    # 行の絞り込みで新しい DataFrame になるため、追加の .copy() はしない。
+    close = pd.to_numeric(frame["Close"], errors="coerce")
+    columns = {
+        "Close": close,
+        "Volume": pd.to_numeric(frame["Volume"], errors="coerce"),
+    }
+    if "Dividends" in frame.columns:
+        columns["Dividends"] = pd.to_numeric(
+            frame["Dividends"],
+            errors="coerce",
+        ).fillna(0)
+    work = frame.assign(**columns)[close.notna() & (close > 0)]
+    if not work.index.is_monotonic_increasing:
+        work = work.sort_index()
+    if work.empty:
+        raise RuntimeError(f"{code}: Yahoo Financeに有効な終値がありません")
+    return work
+
+
+def _split_adjusted_closes(work: pd.DataFrame) -> tuple[pd.Series, pd.Series]:
+    """
+    (分割調整後の終値, 分割倍率) を返す。分割がない日の倍率は0。
+
+    YahooのCloseは株式分割前後で単位が変わることがある。
+    Adj Closeは配当まで補正するため、25日線用には使わない。
+    Stock Splitsだけを使い、過去の終値を現在の株数基準へ揃える。
+    """
+    raw_closes = work["Close"]
+    if "Stock Splits" not in work.columns:
+        return raw_closes.copy(), pd.Series(0.0, index=work.index)
+
+    split_factors = pd.to_numeric(
+        work["Stock Splits"],
+        errors="coerce",
+    ).fillna(0.0)
+
+    normalized_factors = split_factors.where(
+        split_factors > 0,
+        1.0,
+    )
+
+    # 各日の「翌日以降」に発生した分割倍率の累積。
+    # 分割当日の終値はすでに分割後価格なので、その日の倍率は除外する。
+    future_split_factor = (
+        normalized_factors.iloc[::-1]
+        .cumprod()
+        .iloc[::-1]
+        / normalized_factors
+    )
+    return raw_closes / future_split_factor, split_factors
+
+
+def _window_sums(cumulative: np.ndarray, window: int) -> np.ndarray:
+    """累積和から末尾N個の和を全日付ぶん作る。N個に満たない位置はNaN。"""
+    sums = np.full(cumulative.shape, np.nan)
+    if len(cumulative) >= window:
+        sums[window - 1 :] = cumulative[window - 1 :] - np.concatenate(([0.0], cumulative[:-window]))
+    return sums
+
+
+def compute_indicators(
+    work: pd.DataFrame,
+    specs: list[IndicatorSpec] | None = None,
+    *,
+    adjusted_closes: pd.Series | None = None,
+) -> pd.DataFrame:
+    """
+    INDICATORS の各指標を全日付ぶん計算する。
+
+    分割調整後の終値・高値・安値・出来高は一度だけ作り、
+    窓の和は累積和の差で取るため、指標や窓を増やしても系列の再走査は増えない。
+    調整後系列の基準は系列末尾なので、分割を含まない窓では生の終値と比率が一致する。
+    """
+    specs = INDICATORS if specs is None else specs
+    if not specs:
+        return pd.DataFrame(index=work.index)
+    if adjusted_closes is None:
+        adjusted_closes, _ = _split_adjusted_closes(work)
+
+    closes = adjusted_closes.to_numpy(dtype="float64")
+    ratio = closes / work["Close"].to_numpy(dtype="float64")
+    count = len(closes)
+    series: dict[str, np.ndarray] = {}
+    cumulative: dict[str, np.ndarray] = {}
+
+    def cumsum(key: str) -> np.ndarray:
+        # 指標に必要な系列だけを、最初に要求されたときに1回作る。
+        if key not in cumulative:
+            if key == "close":
+                values = closes
+            elif key == "true_range":
+                highs = work["High"].to_numpy(dtype="float64") * ratio if "High" in work else closes
+                lows = work["Low"].to_numpy(dtype="float64") * ratio if "Low" in work else closes
+                previous = np.concatenate(([np.nan], closes[:-1]))
+                values = np.fmax(
+                    highs - lows,
+                    np.fmax(np.abs(highs - previous), np.abs(lows - previous)),
+                )
+                values[0] = highs[0] - lows[0]
+            else:
+                # 大きな出来高の二乗和で桁落ちしないよう、平均を引いてから累積する。
+                volumes = work["Volume"].fillna(0).to_numpy(dtype="float64")
+                centered = volumes - (volumes.mean() if count else 0.0)
+                series["volume"] = centered
+                values = centered if key == "volume" else centered * centered
+            cumulative[key] = np.nancumsum(values)
+        return cumulative[key]
+
+    columns: dict[str, np.ndarray] = {}
+    for spec in specs:
+        window = spec.window
+        if spec.kind == "ma_deviation":
+            moving_average = _window_sums(cumsum("close"), window) / window
+            columns[spec.name] = (closes / moving_average - 1.0) * 100.0
+        elif spec.kind == "return":
+            past = np.full(count, np.nan)
+            if count > window:
+                past[window:] = closes[:-window]
+            columns[spec.name] = (closes / past - 1.0) * 100.0
+        elif spec.kind == "atr":
+            columns[spec.name] = _window_sums(cumsum("true_range"), window) / window
+        elif spec.kind == "volume_zscore":
+            sums = _window_sums(cumsum("volume"), window)
+            squares = _window_sums(cumsum("volume_squared"), window)
+            mean = sums / window
+            variance = np.maximum(squares - sums * mean, 0.0) / (window - 1)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                zscore = (series["volume"] - mean) / np.sqrt(variance)
+            columns[spec.name] = np.where(variance > 0, zscore, np.nan)
+    return pd.DataFrame(columns, index=work.index)
+
+
+def price_metric_series(work: pd.DataFrame) -> pd.DataFrame:
+    """
+    全営業日ぶんの vol5 / vol25 / volratio_5_25 / deviation_25ma_pct を
+    rolling で一度に計算する（バックフィル用）。
+    25日窓に分割を含む日は分割調整後の終値、含まない日は生の終値で25MAを取る。
+    調整後終値の基準は系列末尾なので、乖離率は同じ基準の当日終値と比べる。
+    """
+    raw_closes = work["Close"]
+    volumes = work["Volume"].fillna(0)
+    adjusted_closes, split_factors = _split_adjusted_closes(work)
+
+    vol5 = volumes.rolling(5).mean().round()
+    vol25 = volumes.rolling(25).mean().round()
+    split_in_window = (split_factors > 0).astype("int8").rolling(25, min_periods=1).sum() > 0
+
+    raw_deviation = (raw_closes / raw_closes.rolling(25).mean() - 1.0) * 100.0
+    adjusted_deviation = (adjusted_closes / adjusted_closes.rolling(25).mean() - 1.0) * 100.0
+    metrics = pd.DataFrame(
+        {
+            "vol5": vol5,
+            "vol25": vol25,
+            "volratio_5_25": vol5 / vol25.where(vol25 != 0),
+            "deviation_25ma_pct": adjusted_deviation.where(split_in_window, raw_deviation),
+        },
+        index=work.index,
+    )
+    return metrics.join(compute_indicators(work, adjusted_closes=adjusted_closes))
+
+
+def yahoo_metrics(
+    code: str,
+    frame: pd.DataFrame,
+    expected_date: date,
+) -> dict[str, Any]:
+    work = _prepare_yahoo_frame(code, frame)
+
+    latest_timestamp = pd.Timestamp(work.index.max())
+    if latest_timestamp.tzinfo is not None:
+        latest_timestamp = latest_timestamp.tz_convert(JST).tz_localize(None)
+    latest_date = latest_timestamp.date()
+
+    if latest_date != expected_date:
+        raise RuntimeError(
+            f"{code}: stale Yahoo data "
+            f"expected={expected_date.isoformat()} received={latest_date.isoformat()}"
+        )
+
+    raw_closes = work["Close"].copy()
+    volumes = work["Volume"].fillna(0)
+
+    split_adjusted_closes, split_factors = _split_adjusted_closes(work)
+    split_events: list[tuple[str, float]] = [
+        (
+            pd.Timestamp(split_date).date().isoformat(),
+            float(factor),
+        )
+        for split_date, factor in split_factors[split_factors > 0].items()
+    ]
+
+    latest_price = float(raw_closes.iloc[-1])
+    latest_ma_price = float(split_adjusted_closes.iloc[-1])
+
+    # 最新日は将来の分割がないため、通常は両者が一致する。
+    if abs(latest_price - latest_ma_price) > max(0.01, latest_price * 0.001):
+        raise RuntimeError(
+            f"{code}: split adjustment changed the latest close unexpectedly "
+            f"raw={latest_price} adjusted={latest_ma_price}"
+        )
+
+    vol5 = int(round(float(volumes.tail(5).mean()))) if len(volumes) >= 5 else None
+    vol25 = int(round(float(volumes.tail(25).mean()))) if len(volumes) >= 25 else None
+    volume_ratio = safe_div(vol5, vol25)
+
+    deviation_25ma = None
+    if len(raw_closes) >= 25:
+        raw_recent_25 = raw_closes.tail(25)
+        raw_ma25 = float(raw_recent_25.mean())
+
+        recent_start_date = pd.Timestamp(raw_recent_25.index.min()).date()
+        recent_end_date = pd.Timestamp(raw_recent_25.index.max()).date()
+        split_in_window = any(
+            recent_start_date <= date.fromisoformat(split_date) <= recent_end_date
+            for split_date, _ in split_events
+        )
+
+        if split_in_window:
+            used_recent_25 = split_adjusted_closes.tail(25)
+            ma25_source = "split_adjusted_close"
+        else:
+            used_recent_25 = raw_recent_25
+            ma25_source = "raw_close"
+
+        ma25 = float(used_recent_25.mean())
+
+        # 25日移動平均線乖離率の定義を固定する。
+        # 終値が25MAより上ならプラス、下ならマイナス。
+        deviation_25ma = (
+            (latest_price / ma25) - 1.0
+        ) * 100.0
+
+        tolerance = max(1e-10, ma25 * 1e-12)
+        if latest_price > ma25 + tolerance:
+            position = "above"
+            expected_sign = "positive"
+            sign_is_valid = deviation_25ma > 0
+        elif latest_price < ma25 - tolerance:
+            position = "below"
+            expected_sign = "negative"
+            sign_is_valid = deviation_25ma < 0
+        else:
+            position = "equal"
+            expected_sign = "zero"
+            deviation_25ma = 0.0
+            sign_is_valid = True
+
+        print(
+            f"[DEBUG-25MA] {code} close={output_value(latest_price)} "
+            f"raw_ma25={output_value(raw_ma25)} "
+            f"used_ma25={output_value(ma25)} "
+            f"source={ma25_source} "
+            f"deviation={output_value(deviation_25ma)} "
+            f"position={position} expected_sign={expected_sign} "
+            f"sign_valid={sign_is_valid} "
+            f"formula=(close/ma25-1)*100 "
+            f"split_events={split_events or 'none'}",
+            flush=True,
+        )
+
+        if STRICT_DEVIATION_SIGN and not sign_is_valid:
+            raise RuntimeError(
+                f"{code}: 25MA乖離率の符号検証に失敗しました "
+                f"close={latest_price} ma25={ma25} "
+                f"deviation={deviation_25ma} "
+                f"position={position} expected={expected_sign}"
+            )
+
+    trailing_dividend = None
+    if "Dividends" in work.columns:
+        cutoff = pd.Timestamp(expected_date - timedelta(days=370))
+        dividend_rows = work.loc[work.index >= cutoff, "Dividends"]
+        trailing_dividend = float(dividend_rows.sum())
+        if abs(trailing_dividend) < 1e-12:
+            trailing_dividend = 0.0
+
+    indicators = compute_indicators(work, adjusted_closes=split_adjusted_closes)
+    latest_indicators = {
+        name: (None if pd.isna(value) else float(value))
+        for name, value in (indicators.iloc[-1].items() if not indicators.empty else [])
+    }
+
+    return {
+        "latest_date": latest_date,
+        "latest_price": latest_price,
+        "trailing_dividend": trailing_dividend,
+        "vol5": vol5,
+        "vol25": vol25,
+        "volratio_5_25": volume_ratio,
+        "deviation_25ma_pct": deviation_25ma,
+        "indicators": latest_indicators,
+    }
+
+
+# ====== IRBANK CSV（HTMLは使用しない） ======
+def _norm_label(value: Any) -> str:
+    text = "" if value is None else unicodedata.normalize("NFKC", str(value))
+    text = re.sub(r"（.*?）|\(.*?\)", "", text)
+    return re.sub(r"[\s　,/％%円¥\-–—―]", "", text)
+
+
+EPS_KEYS = [
+    "EPS",
+    "EPS(円)",
+    "EPS（円）",
+    "1株当たり利益",
+    "1株当たり当期純利益",
+    "1株当たり当期純利益(円)",
+    "1株当たり当期純利益（円）",
+    "1株当たり純利益",
+]
+BPS_KEYS = [
+    "BPS",
+    "BPS(円)",
+    "BPS（円）",
+    "1株当たり純資産",
+    "1株当たり純資産(円)",
+    "1株当たり純資産（円）",
+    "1株純資産",
+]
+DPS_KEYS = [
+    "DPS",
+    "年間配当",
+    "1株配当",
+    "1株配当金",
+    "配当金",
+    "配当(円)",
+    "配当（円）",
+    "1株当たり配当金",
+]
+EQ_KEYS = [
+    "自己資本",
+    "自己資本合計",
+    "株主資本",
+    "株主資本合計",
+    "純資産",
+    "純資産合計",
+    "純資産の部合計",
+]
+AS_KEYS = ["総資産", "資産合計", "資産総額", "資産の部合計"]
+NI_KEYS = [
+    "当期純利益",
+    "親会社株主に帰属する当期純利益",
+    "親会社株主に帰属する純利益",
+    "純利益",
+]
+ROE_KEYS = ["ROE", "自己資本利益率"]
+EQR_KEYS = ["自己資本比率"]
+
+
+def _label_matcher(keys: list[str], *, exact: bool) -> Callable[[Any], bool]:
+    """見出しの一致判定。キーの正規化は表の走査ごとではなく1回だけ行う。"""
+    normalized_keys = [key for key in (_norm_label(key) for key in keys) if key]
+    key_set = set(normalized_keys)
+
+    def matches(value: Any) -> bool:
+        heading = _norm_label(value)
+        if not heading:
+            return False
+        if exact:
+            return heading in key_set
+        return any(key == heading or key in heading for key in normalized_keys)
+
+    return matches
+
+
+def _looks_like_period(value: Any) -> bool:
+    """
+    年度・年月・日付を財務数値として誤読しない。
+    """
+    if value is None:
+        return False
+
+    text = unicodedata.normalize("NFKC", str(value)).strip()
+    compact = re.sub(r"\s+", "", text)
+
+    if re.fullmatch(PERIOD_FULL_PATTERN, compact):
+        return True
+    if re.search(PERIOD_DATE_PATTERN, compact):
+        return True
+    if re.fullmatch(PERIOD_FISCAL_PATTERN, compact, re.IGNORECASE):
+        return True
+    return False
+
+
+def _numeric_cell(value: Any) -> float | None:
+    if _looks_like_period(value):
+        return None
+    return safe_float(value)
+
+
+def numeric_table(rows: list[list[str]]) -> np.ndarray:
+    """
+    CSV行を (行数, 最大列数) の float 配列にする。
+    年度・日付セル、空セル、列が足りない位置は NaN（= _numeric_cell が None）。
+    """
+    width = max((len(row) for row in rows), default=0)
+    numbers, periods = coerce_numeric([cell for row in rows for cell in row])
+    numbers[periods] = np.nan
+
+    table = np.full((len(rows), width), np.nan)
+    lengths = np.fromiter((len(row) for row in rows), dtype=np.intp, count=len(rows))
+    table[np.arange(width) < lengths[:, None]] = numbers
+    return table
+
+
+def _iter_metric_candidates(
+    rows: list[list[str]],
+    keys: list[str],
+    *,
+    exact: bool,
+):
+    # 呼び出し側は最新の1件で止まるため、セルは末尾から1つずつ数値化する。
+    # 表全体の一括変換（numeric_table）はこの用途では遅くなる。
+    matcher = _label_matcher(keys, exact=exact)
+
+    # A: 項目が縦に並ぶ形式
+    for row in rows:
+        if not row or not matcher(row[0]):
+            continue
+        for value in reversed(row[1:]):
+            number = _numeric_cell(value)
+            if number is not None:
+                yield number, value
+
+    # B: 項目がヘッダー列に並ぶ形式
+    header_limit = min(CSV_HEADER_ROWS, len(rows))
+    for header_index in range(header_limit):
+        header = rows[header_index]
+        for column, heading in enumerate(header):
+            if not matcher(heading):
+                continue
+            for data_row in reversed(rows[header_index + 1:]):
+                if column >= len(data_row):
+                    continue
+                value = data_row[column]
+                number = _numeric_cell(value)
+                if number is not None:
+                    yield number, value
+
+
+def metric_value(
+    rows: list[list[str]] | None,
+    keys: list[str],
+) -> float | None:
+    """
+    IRBANK CSVの縦型・横型に対応。
+    完全一致を先に調べ、年度セルは採用しない。
+    """
+    if not rows:
+        return None
+
+    for exact in (True, False):
+        for number, _ in _iter_metric_candidates(rows, keys, exact=exact):
+            return number
+    return None
+
+
+DIVIDEND_EXACT_KEYS = [
+    "DPS",
+    "年間配当",
+    "年間配当金",
+    "1株配当",
+    "1株配当金",
+    "1株当たり配当金",
+    "1株当たり年間配当金",
+    "配当合計",
+    "合計",
+]
+
+
+def dividend_per_share(rows: list[list[str]] | None) -> float | None:
+    """
+    配当CSV専用。
+    大見出しを年度列と誤認せず、年間合計列を優先する。
+    """
+    if not rows:
+        return None
+
+    for number, _ in _iter_metric_candidates(
+        rows,
+        DIVIDEND_EXACT_KEYS,
+        exact=True,
+    ):
+        if 0 <= number <= 100000:
+            return number
+
+    narrow_keys = [
+        "DPS",
+        "年間配当",
+        "1株配当",
+        "1株当たり配当金",
+    ]
+    for number, _ in _iter_metric_candidates(rows, narrow_keys, exact=False):
+        if 0 <= number <= 100000:
+            return number
+
+    table = numeric_table(rows)
+    non_period_numbers = table[~np.isnan(table)]
+    if non_period_numbers.size and not non_period_numbers.any():
+        return 0.0
+
+    return None
+
+
+def _is_vertical_layout(header: list[str]) -> bool:
+    """行の2列目以降が年度なら、項目が縦に並ぶ形式の見出し。先頭の数列だけで判定する。"""
+    cells = [cell for cell in islice(header, 1, 5) if cell.strip()]
+    return bool(cells) and sum(_looks_like_period(cell) for cell in cells) * 2 >= len(cells)
+
+
+def _vertical_header_index(rows: list[list[str]]) -> int | None:
+    """
+    見出し帯から年度が横に並ぶ行を探す（題名行が先にあってもよい）。縦型ならその行の位置、
+    先頭列が年度の行（横型の本体）に先に当たれば None。
+    """
+    for index, row in enumerate(islice(rows, CSV_HEADER_ROWS)):
+        if row and _looks_like_period(row[0]):
+            return None
+        if _is_vertical_layout(row):
+            return index
+    return None
+
+
+def read_csv_rows(
+    lines: Iterator[str],
+    *,
+    tail_rows: int | None = None,
+) -> list[list[str]]:
+    """
+    CSVを逐次読み、見出し帯（先頭 CSV_HEADER_ROWS 行）と末尾 tail_rows 行だけを返す。
+    利用側は最新の値を末尾から探すため、途中の古い年度は保持しない。
+    縦型（項目が行）は末尾に限らず全行が必要なので、全行を返す。
+    """
+    tail_rows = IRBANK_CSV_TAIL_ROWS if tail_rows is None else tail_rows
+    lines = iter(lines)
+    reader = csv.reader(lines)
+    head = list(islice(reader, CSV_HEADER_ROWS))
+    if not tail_rows or not head or _vertical_header_index(head) is not None:
+        return head + list(reader)
+    # 途中の行はCSVとして解釈せず、生の行のまま末尾 tail_rows 行だけ残す。
+    # IRBANKのCSVはセル内改行を含まないため、行単位で切り出してよい。
+    return head + list(csv.reader(deque(lines, maxlen=tail_rows)))
+
+
+def get_csv(code: str, path: str) -> list[list[str]] | None:
+    """数字4桁・英数字コードの両方を試す。404は欠損として扱う。"""
+    url = IR_CSV.format(code=code, path=path)
+    cached = warm_get(("irbank", code, path), False)
+    if cached is False and deadline_reached():
+        record_skip("irbank", code, path)
+        return None
+    with trace_span("irbank.csv", code=code, path=path, url=url, cache="miss" if cached is False else "hit") as span:
+        rows = _get_csv(url, span) if cached is False else cached
+        # 一時的な失敗は覚えず、取得できた行と404だけを使い回す。
+        if rows or span.get("http_status") == 404:
+            warm_put(("irbank", code, path), rows)
+        span["rows"] = len(rows) if rows else 0
+        span["result"] = "ok" if rows else "missing"
+        return rows
+
+
+def _get_csv(url: str, span: dict[str, Any]) -> list[list[str]] | None:
+    parsed: list[list[str]] = []
+
+    def accept(response: requests.Response) -> bool:
+        # 本文は文字列にせず、受信しながら行単位で解析する。
+        # IRBANKのCSVはUTF-8。apparent_encodingの誤判定を避ける。
+        response.raw.decode_content = True
+        # EOFで urllib3 が自動で閉じると TextIOWrapper の次の読み込みが失敗する。
+        response.raw.auto_close = False
+        stream = io.TextIOWrapper(response.raw, encoding="utf-8-sig", newline="")
+        try:
+            parsed[:] = read_csv_rows(stream)
+        finally:
+            # 接続を閉じずに返すため、ラッパーだけ外す。
+            stream.detach()
+        span["bytes"] = response.raw.tell()
+        if len(parsed) < 2:
+            print(f"[WARN] {url} -> CSV too short", flush=True)
+            return False
+        return True
+
+    # 遮断中（CircuitOpenError）は欠損扱いにせず、実行全体を止める。
+    try:
+        response = http_get(url, retries=IRBANK_RETRIES, span=span, accept=accept, stream=True)
+    except requests.RequestException:
+        print(f"[FAIL] {url}", flush=True)
+        return None
+    response.close()
+
+    if response.status_code == 404:
+        print(f"[MISS] {url} -> HTTP 404", flush=True)
+        return None
+    if response.status_code != 200 or len(parsed) < 2:
+        print(f"[FAIL] {url}", flush=True)
+        return None
+
+    print(f"[OK] {url} rows={len(parsed)}", flush=True)
+    return parsed
+
+
+def _first_available_metric(
+    sources: list[list[list[str]] | None],
+    keys: list[str],
+) -> float | None:
+    for rows in sources:
+        value = metric_value(rows, keys)
+        if value is not None:
+            return value
+    return None
+
+
+# 必須CSV（取得の優先順）。一括CSV（CSV_ALL）は不足を補うときだけ、後回しで取る。
+REQUIRED_CSVS = [CSV_PL, CSV_BS, CSV_DIV, CSV_PS, CSV_QQ]
+
+
+def fetch_required_csvs(code: str) -> dict[str, list[list[str]] | None]:
+    return {path: get_csv(code, path) for path in REQUIRED_CSVS}
+
+
+def needs_data_all(sources: dict[str, list[list[str]] | None]) -> bool:
+    """個別CSVで埋まらない項目があれば一括CSVが要る。"""
+    pl, bs = sources.get(CSV_PL), sources.get(CSV_BS)
+    return any(
+        value is None
+        for value in (
+            metric_value(pl, EPS_KEYS),
+            metric_value(pl, NI_KEYS),
+            metric_value(bs, BPS_KEYS),
+            metric_value(bs, EQ_KEYS),
+            metric_value(bs, AS_KEYS),
+            dividend_per_share(sources.get(CSV_DIV)),
+        )
+    )
+
+
+def fetch_financial_values(
+    code: str,
+    sources: dict[str, list[list[str]] | None] | None = None,
+) -> dict[str, float | None]:
+    """sources を渡すとその取得済みCSVだけで計算する（CSV_ALL がなければ補完しない）。"""
+    if sources is None:
+        sources = {path: get_csv(code, path) for path in (CSV_PL, CSV_BS, CSV_DIV, CSV_PS)}
+        # 個別CSVにない項目を一括CSVで補完する。必要なときだけ1回取得。
+        sources[CSV_ALL] = get_csv(code, CSV_ALL) if needs_data_all(sources) else None
+    pl = sources.get(CSV_PL)
+    bs = sources.get(CSV_BS)
+    dividend = sources.get(CSV_DIV)
+    per_share = sources.get(CSV_PS)
+    all_rows = sources.get(CSV_ALL)
+
+    eps = _first_available_metric([pl, per_share, all_rows], EPS_KEYS)
+    bps = _first_available_metric([bs, per_share, all_rows], BPS_KEYS)
+    profit = _first_available_metric([pl, all_rows], NI_KEYS)
+    equity = _first_available_metric([bs, all_rows], EQ_KEYS)
+    assets = _first_available_metric([bs, all_rows], AS_KEYS)
+    dps = dividend_per_share(dividend)
+    if dps is None:
+        dps = _first_available_metric([per_share, all_rows], DPS_KEYS)
+    roe_pct = _first_available_metric([pl, all_rows], ROE_KEYS)
+    equity_ratio_pct = _first_available_metric([bs, all_rows], EQR_KEYS)
+
+    found = {
+        "eps": eps,
+        "bps": bps,
+        "profit": profit,
+        "equity": equity,
+        "assets": assets,
+        "dps": dps,
+        "roe_pct": roe_pct,
+        "equity_ratio_pct": equity_ratio_pct,
+    }
+    print(
+        "[DEBUG-IRBANK] "
+        + code
+        + " "
+        + " ".join(
+            f"{key}={'yes' if value is not None else 'no'}"
+            for key, value in found.items()
+        ),
+        flush=True,
+    )
+    return found
+
+
+def fetch_opinc_yoy(code: str, rows: list[list[str]] | None = None) -> float | None:
+    """rows を渡すと取得せずにその行から読む。"""
+    rows = get_csv(code, CSV_QQ) if rows is None else rows
+    if not rows:
+        return None
+
+    # 専用CSVは先頭列が期間、2列目が前年比。
+    for row in reversed(rows[1:]):
+        if len(row) < 2:
+            continue
+        number = _numeric_cell(row[1])
+        if number is not None:
+            return number
+
+    # レイアウト変更時の限定フォールバック。
+    for exact in (True, False):
+        for number, raw in _iter_metric_candidates(
+            rows,
+            [
+                "営業利益前年同期比",
+                "営業利益前年比",
+                "前年同期比",
+                "前年比",
+            ],
+            exact=exact,
+        ):
+            if not _looks_like_period(raw):
+                return number
+
+    return None
+
+
+# ====== 財務の時系列（縦持ちストア） ======
+# metric_value は最新の1件しか使わないが、CSVには過去の年度も並んでいる。
+# 取得したCSVを (code, source, period, item, value) へ正規化して残し、
+# 複数年の指標を全銘柄まとめて列演算で求める。item は既知の見出しなら eps 等の正規名。
+FUNDAMENTAL_ITEMS = [
+    ("eps", EPS_KEYS),
+    ("bps", BPS_KEYS),
+    ("dps", DIVIDEND_EXACT_KEYS + DPS_KEYS),
+    ("profit", NI_KEYS),
+    ("equity", EQ_KEYS),
+    ("assets", AS_KEYS),
+    ("roe_pct", ROE_KEYS),
+    ("equity_ratio_pct", EQR_KEYS),
+    ("opinc_yoy_pct", ["営業利益前年同期比", "営業利益前年比", "前年同期比", "前年比"]),
+]
+FUNDAMENTALS_KEY = ["code", "source", "period", "item"]
+# 同じ年度・項目が複数のCSVにあれば、fetch_financial_values と同じ順で先のものを使う。
+FUNDAMENTAL_SOURCE_ORDER = {
+    "eps": [CSV_PL, CSV_PS, CSV_ALL],
+    "bps": [CSV_BS, CSV_PS, CSV_ALL],
+    "dps": [CSV_DIV, CSV_PS, CSV_ALL],
+    "profit": [CSV_PL, CSV_ALL],
+    "equity": [CSV_BS, CSV_ALL],
+    "assets": [CSV_BS, CSV_ALL],
+    "roe_pct": [CSV_PL, CSV_ALL],
+    "equity_ratio_pct": [CSV_BS, CSV_ALL],
+}
+_PERIOD_KEY_PATTERN = re.compile(r"((?:19|20)\d{2})(?:\s*[/.\-年]\s*(\d{1,2}))?")
+# 期間の後ろに付く予想・見込みの印（2026/03 予、2026年3月期(予) など）。実績と混ぜない。
+_FORECAST_MARKER_PATTERN = re.compile(r"予|見込|計画|^\W*E\W*$")
+_ITEM_MATCHERS = [(name, _label_matcher(keys, exact=True)) for name, keys in FUNDAMENTAL_ITEMS]
+
+
+def _period_key(value: Any) -> str | None:
+    """2025/03・2025年3月期・FY2025 → 2025-03 / 2025。期間でない・予想の列や行なら None。"""
+    text = unicodedata.normalize("NFKC", str(value or "")).strip().upper().removeprefix("FY")
+    match = _PERIOD_KEY_PATTERN.match(text)
+    if not match or _FORECAST_MARKER_PATTERN.search(text[match.end():]):
+        return None
+    year, month = match.groups()
+    return f"{year}-{int(month):02d}" if month else year
+
+
+def _fundamental_item(label: str) -> str:
+    for name, matches in _ITEM_MATCHERS:
+        if matches(label):
+            return name
+    return _norm_label(label)
+
+
+def fundamentals_long(code: str, source: str, rows: list[list[str]] | None) -> pd.DataFrame:
+    """IRBANK CSVの行（縦型・横型）を (code, source, period, item, value) にする。"""
+    columns = {"code": [], "source": [], "period": [], "item": [], "value": []}
+    if not rows:
+        return pd.DataFrame(columns)
+
+    header_index = _vertical_header_index(rows)
+    if header_index is not None:
+        # 見出し行が期間、その下の各行の先頭が項目。
+        periods = [_period_key(cell) for cell in rows[header_index][1:]]
+        body = [row[1:] for row in rows[header_index + 1:]]
+        row_labels = [row[0] if row else "" for row in rows[header_index + 1:]]
+        row_keys, column_keys = [_fundamental_item(label) for label in row_labels], periods
+        item_axis = 0
+    else:
+        # 先頭列が期間になった行からが本体。見出しは各列で最も下の空でないセル。
+        start = next((index for index, row in enumerate(rows) if row and _period_key(row[0])), len(rows))
+        width = max((len(row) for row in rows), default=0)
+        labels = [""] * width
+        for header in rows[:start]:
+            for column, cell in enumerate(header):
+                if cell.strip():
+                    labels[column] = cell
+        body_rows = [row for row in rows[start:] if row and _period_key(row[0])]
+        body = [row[1:] for row in body_rows]
+        row_keys = [_period_key(row[0]) for row in body_rows]
+        column_keys = [_fundamental_item(label) if label else None for label in labels[1:]]
+        item_axis = 1
+
+    if not body:
+        return pd.DataFrame(columns)
+    table = numeric_table(body)
+    row_index, column_index = np.nonzero(~np.isnan(table))
+    keys_by_row = np.array(row_keys, dtype=object)[row_index]
+    width = table.shape[1]
+    keys_by_column = np.array((column_keys + [None] * width)[:width], dtype=object)[column_index]
+    items, periods = (keys_by_row, keys_by_column) if item_axis == 0 else (keys_by_column, keys_by_row)
+    frame = pd.DataFrame(
+        {
+            "code": code,
+            "source": source,
+            "period": periods,
+            "item": items,
+            "value": table[row_index, column_index],
+        }
+    )
+    frame = frame[frame["period"].notna() & frame["item"].notna() & (frame["item"] != "")]
+    return frame.drop_duplicates(FUNDAMENTALS_KEY, keep="last").reset_index(drop=True)
+
+
+def _fundamentals_root(root: str | Path | None = None) -> Path | None:
+    value = FUNDAMENTALS_STORE if root is None else str(root)
+    return Path(value) if value and value != "0" else None
+
+
+def update_fundamentals_store(
+    sources: dict[str, dict[str, list[list[str]] | None]],
+    *,
+    root: str | Path | None = None,
+) -> int:
+    """
+    取得したCSVを縦持ちにして、コード先頭2文字ごとのParquetへ積み増す。
+    同じ (code, source, period, item) は新しい値で置き換え、CSVの末尾から外れた古い年度は残す。
+    書き換えるのは今回の銘柄を含むファイルだけ。
+    """
+    directory = _fundamentals_root(root)
+    if directory is None:
+        return 0
+    frames = [
+        fundamentals_long(code, source, rows)
+        for code, tables in sources.items()
+        for source, rows in tables.items()
+        if rows
+    ]
+    frames = [frame for frame in frames if not frame.empty]
+    if not frames:
+        return 0
+    return _upsert_fundamentals(pd.concat(frames, ignore_index=True), directory)
+
+
+def import_fundamentals_store(
+    sources: list[str | Path],
+    *,
+    root: str | Path | None = None,
+) -> int:
+    """別のストア（ワークフローのシャードが書いたものなど）の行をこのストアへ upsert する。"""
+    directory = _fundamentals_root(root)
+    if directory is None:
+        return 0
+    frames = [load_fundamentals(root=source) for source in sources]
+    frames = [frame for frame in frames if not frame.empty]
+    if not frames:
+        return 0
+    return _upsert_fundamentals(pd.concat(frames, ignore_index=True), directory)
+
+
+def _upsert_fundamentals(update: pd.DataFrame, directory: Path) -> int:
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as exc:
+        print(f"[WARN] fundamentals store skipped: {exc}", flush=True)
+        return 0
+
+    directory.mkdir(parents=True, exist_ok=True)
+    for prefix, part in update.groupby(update["code"].str[:2], sort=False):
+        path = directory / f"{prefix}.parquet"
+        if path.exists():
+            part = pd.concat([pq.read_table(path).to_pandas(), part], ignore_index=True)
+        part = part.drop_duplicates(FUNDAMENTALS_KEY, keep="last").sort_values(
+            ["code", "source", "item", "period"], ignore_index=True
+        )
+        table = pa.Table.from_pandas(part, preserve_index=False).cast(
+            pa.schema(
+                [
+                    ("code", pa.string()),
+                    ("source", pa.string()),
+                    ("period", pa.string()),
+                    ("item", pa.string()),
+                    ("value", pa.float64()),
+                ]
+            )
+        )
+        _atomic_write(path, lambda target: pq.write_table(table, target, compression="zstd"))
+    print(f"[OK] fundamentals stored rows={len(update)} tickers={update['code'].nunique()} path={directory}", flush=True)
+    return len(update)
+
+
+def load_fundamentals(
+    *,
+    codes: list[str] | None = None,
+    items: list[str] | None = None,
+    root: str | Path | None = None,
+) -> pd.DataFrame:
+    """ストア全体（codes・items で絞り込み）を縦持ちの表で返す。"""
+    empty = pd.DataFrame({column: pd.Series(dtype="string") for column in FUNDAMENTALS_KEY})
+    empty["value"] = pd.Series(dtype="float64")
+    directory = _fundamentals_root(root)
+    if directory is None or not directory.is_dir():
+        return empty
+    files = sorted(directory.glob("*.parquet"))
+    if codes is not None:
+        prefixes = {code[:2] for code in codes}
+        files = [file for file in files if file.stem in prefixes]
+    if not files:
+        return empty
+
+    import pyarrow.parquet as pq
+
+    filters = []
+    if codes is not None:
+        filters.append(("code", "in", list(codes)))
+    if items is not None:
+        filters.append(("item", "in", list(items)))
+    frames = [pq.read_table(file, filters=filters or None).to_pandas() for file in files]
+    return pd.concat(frames, ignore_index=True) if frames else empty
+
+
+def _latest_values(values: pd.DataFrame, item: str, depth: int) -> pd.DataFrame:
+    """item だけの行を コード × 新しい順（0=最新）の表にする。年度は source の優先順で1つに絞る。"""
+    if values.empty:
+        return pd.DataFrame(dtype="float64", columns=range(depth))
+    order = FUNDAMENTAL_SOURCE_ORDER.get(item, [])
+    values = values.assign(priority=values["source"].map({source: rank for rank, source in enumerate(order)}))
+    # 優先順にないCSVの同名の見出しは使わない（fetch_financial_values と同じ扱い）。
+    values = values[values["priority"].notna()] if order else values
+    values = values.sort_values(["code", "period", "priority"]).drop_duplicates(["code", "period"])
+    values = values.assign(age=values.groupby("code").cumcount(ascending=False))
+    values = values[values["age"] < depth]
+    return values.pivot(index="code", columns="age", values="value").reindex(columns=range(depth))
+
+
+def fundamental_metrics(frame: pd.DataFrame, years: int = FUNDAMENTAL_YEARS) -> pd.DataFrame:
+    """
+    ストアの年次の行から、全銘柄まとめて
+      eps_growth_{N}y_pct  直近とN年前のEPSから求めた年率成長率（どちらかが0以下なら空）
+      roe_avg_{N}y_pct     直近N年のROE平均（ROEがない年は 当期純利益 / 自己資本）
+      dividend_raise_streak 直近から遡って前年より増配が続いた年数
+    を求める。
+    """
+    # 文字列の比較は全行で1回だけにし、以降は項目ごとの小さな表で計算する。
+    depths = {"eps": years + 1, "roe_pct": years, "profit": years, "equity": years, "dps": 64}
+    annual = frame[frame["item"].isin(list(depths)) & (frame["source"] != CSV_QQ)]
+    parts = dict(tuple(annual.groupby("item", sort=False)))
+    eps, roe, profit, equity, dps = (
+        _latest_values(parts.get(item, annual.iloc[:0]), item, depth) for item, depth in depths.items()
+    )
+    codes = eps.index.union(roe.index).union(profit.index).union(dps.index)
+
+    def matrix(values: pd.DataFrame) -> np.ndarray:
+        return values.reindex(codes).to_numpy(dtype="float64")
+
+    eps_matrix = matrix(eps)
+    latest, base = eps_matrix[:, 0], eps_matrix[:, years]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        growth = np.where((latest > 0) & (base > 0), ((latest / base) ** (1 / years) - 1) * 100, np.nan)
+        computed_roe = matrix(profit) / matrix(equity) * 100
+    roe_matrix = matrix(roe)
+    roe_matrix = np.where(np.isnan(roe_matrix), computed_roe, roe_matrix)
+    valid = (~np.isnan(roe_matrix)).sum(axis=1)
+    roe_average = np.where(valid == years, np.nansum(roe_matrix, axis=1) / np.maximum(valid, 1), np.nan)
+
+    dps_matrix = matrix(dps)
+    # 最新と前年、前年と前々年…を比べ、先頭から続く「増配」の数を数える。
+    raised = dps_matrix[:, :-1] > dps_matrix[:, 1:]
+    streak = np.cumprod(raised, axis=1).sum(axis=1)
+
+    return pd.DataFrame(
+        {
+            f"eps_growth_{years}y_pct": growth,
+            f"roe_avg_{years}y_pct": roe_average,
+            "dividend_raise_streak": streak.astype("int64"),
+        },
+        index=pd.Index(codes, name="code"),
+    )
+
+
+def fundamentals_command(args: argparse.Namespace) -> int:
+    """ストアの1銘柄の縦持ち、または全銘柄の派生指標を表示・保存する。"""
+    if args.import_dirs:
+        count = import_fundamentals_store(args.import_dirs)
+        print(f"[OK] fundamentals imported rows={count} from {len(args.import_dirs)} stores", flush=True)
+        return 0
+    if args.code:
+        frame = load_fundamentals(codes=[normalize_code_line(args.code)])
+        if args.item:
+            frame = frame[frame["item"].isin(args.item.split(","))]
+        result = frame.sort_values(["item", "period", "source"], ignore_index=True)
+    else:
+        frame = load_fundamentals(items=["eps", "roe_pct", "profit", "equity", "dps"])
+        result = fundamental_metrics(frame, args.years).reset_index()
+    if frame.empty:
+        print(f"[WARN] fundamentals store is empty: {FUNDAMENTALS_STORE}", flush=True)
+        return 1
+    if args.output:
+        result.to_csv(args.output, index=False)
+        print(f"[OK] wrote {len(result)} rows to {args.output}", flush=True)
+    else:
+        print(result.to_string(index=False))
+    return 0
+
+
+# ====== JPX週次信用残高 ======
+def _parse_date_score(text: str) -> int:
+    normalized = unicodedata.normalize("NFKC", text)
+    patterns = [
+        r"(20\d{2})[年/_\-.]?(\d{1,2})[月/_\-.]?(\d{1,2})",
+        r"(20\d{2})(\d{2})(\d{2})",
+    ]
+    for pattern in patterns:
+        match = re.search(pattern, normalized)
+        if match:
+            try:
+                parsed = date(
+                    int(match.group(1)),
+                    int(match.group(2)),
+                    int(match.group(3)),
+                )
+                return int(parsed.strftime("%Y%m%d"))
+            except ValueError:
+                pass
+    return 0
+
+
+def _clean_embedded_url(value: str, base_url: str) -> str:
+    cleaned = unescape(value.strip().strip("'\""))
+    cleaned = cleaned.replace("\\/", "/")
+    cleaned = re.sub(
+        r"\\u002[fF]",
+        "/",
+        cleaned,
+    )
+    cleaned = cleaned.rstrip("\\")
+    return urljoin(base_url, cleaned)
+
+
+STATIC_EXTENSIONS = (
+    ".css",
+    ".js",
+    ".mjs",
+    ".png",
+    ".jpg",
+    ".jpeg",
+    ".gif",
+    ".svg",
+    ".webp",
+    ".ico",
+    ".woff",
+    ".woff2",
+    ".ttf",
+    ".map",
+    ".xml",
+)
+
+
+def _is_static_asset_url(url: str) -> bool:
+    path = url.split("?", 1)[0].lower()
+    return path.endswith(STATIC_EXTENSIONS)
+
+
+def _candidate_urls_from_html(
+    html_text: str,
+    base_url: str,
+) -> list[tuple[int, int, str]]:
+    soup = BeautifulSoup(html_text, "html.parser")
+    raw_candidates: list[tuple[str, str, int]] = []
+
+    for order, tag in enumerate(
+        soup.find_all(["a", "button", "iframe", "object", "embed"])
+    ):
+        context = tag.get_text(" ", strip=True)
+        parent = tag.find_parent(["tr", "li", "section", "article", "div"])
+        if parent is not None:
+            parent_text = parent.get_text(" ", strip=True)
+            if len(parent_text) <= 500:
+                context = f"{context} {parent_text}"
+
+        for attribute in (
+            "href",
+            "src",
+            "data",
+            "data-href",
+            "data-url",
+            "data-download",
+            "data-file",
+            "onclick",
+        ):
+            value = tag.get(attribute)
+            if value:
+                raw_candidates.append((str(value), context, order))
+
+    normalized_html = unescape(html_text).replace("\\/", "/")
+    normalized_html = re.sub(r"\\u002[fF]", "/", normalized_html)
+    embedded_pattern = re.compile(
+        r"""(?P<url>
+            (?:https?://|/|\.\.?/)
+            [^\s"'<>]+?
+            (?:
+                \.(?:xlsx?|csv|zip|pdf)(?:\?[^\s"'<>]*)?
+                |
+                (?:-att|_att)/[^\s"'<>]+
+            )
+        )""",
+        re.VERBOSE | re.IGNORECASE,
+    )
+    for order, match in enumerate(
+        embedded_pattern.finditer(normalized_html),
+        start=100000,
+    ):
+        raw_candidates.append((match.group("url"), "", order))
+
+    extension_scores = {
+        ".xlsx": 80,
+        ".xls": 70,
+        ".csv": 60,
+        ".zip": 50,
+        ".pdf": 40,
+    }
+
+    result: list[tuple[int, int, str]] = []
+    seen: set[str] = set()
+
+    for raw_url, context, order in raw_candidates:
+        possible_values = [raw_url]
+        possible_values.extend(re.findall(r"""["']([^"']+)["']""", raw_url))
+
+        for possible in possible_values:
+            url = _clean_embedded_url(possible, base_url)
+            if not url.startswith(("http://", "https://")):
+                continue
+            if url in seen or url.rstrip("/") == base_url.rstrip("/"):
+                continue
+            if _is_static_asset_url(url):
+                continue
+
+            lower_path = url.split("?", 1)[0].lower()
+            extension = next(
+                (ext for ext in extension_scores if lower_path.endswith(ext)),
+                "",
+            )
+
+            normalized_context = _norm_label(f"{context} {url}")
+            has_margin_context = any(
+                key in normalized_context
+                for key in (
+                    "信用取引週末残高",
+                    "銘柄別信用",
+                    "endofweekoutstandingmargin",
+                    "applicationbased",
+                    "申込分",
+                )
+            )
+            has_attachment_path = any(
+                marker in lower_path
+                for marker in (
+                    "-att/",
+                    "_att/",
+                    "/download/",
+                    "/files/",
+                )
+            )
+
+            if not extension and not has_attachment_path:
+                continue
+
+            date_score = _parse_date_score(f"{context} {url}")
+            score = extension_scores.get(extension, 10)
+            if has_margin_context:
+                score += 100
+            if has_attachment_path:
+                score += 25
+
+            seen.add(url)
+            result.append((date_score, score, url))
+
+    return result
+
+def discover_jpx_margin_candidates() -> list[str]:
+    if JPX_MARGIN_URL_OVERRIDE:
+        return [JPX_MARGIN_URL_OVERRIDE]
+
+    all_candidates: list[tuple[int, int, str]] = []
+    visited_pages: set[str] = set()
+    page_queue = [JPX_MARGIN_PAGE, JPX_MARGIN_PAGE_EN]
+
+    # JPXページはJavaScript生成の場合があるため、iframe先も1階層だけ確認。
+    while page_queue and len(visited_pages) < 8:
+        page_url = page_queue.pop(0)
+        if page_url in visited_pages:
+            continue
+        visited_pages.add(page_url)
+
+        with trace_span("jpx.page", url=page_url, cache="miss") as span:
+            response = http_get(page_url, retries=JPX_RETRIES, span=span)
+            response.raise_for_status()
+        all_candidates.extend(
+            _candidate_urls_from_html(response.text, page_url)
+        )
+
+        soup = BeautifulSoup(response.text, "html.parser")
+        for iframe in soup.find_all("iframe", src=True):
+            iframe_url = urljoin(page_url, iframe.get("src", ""))
+            if iframe_url.startswith(JPX_BASE_URL + "/"):
+                page_queue.append(iframe_url)
+
+    if not all_candidates:
+        raise RuntimeError(
+            "JPXページから信用残高のダウンロード候補を発見できませんでした"
+        )
+
+    all_candidates.sort(reverse=True)
+    ordered: list[str] = []
+    seen: set[str] = set()
+    for _, _, url in all_candidates:
+        if url not in seen:
+            ordered.append(url)
+            seen.add(url)
+    return ordered
+
+
+def _payload_kind(url: str, content_type: str, content: bytes) -> str:
+    lower_url = url.split("?", 1)[0].lower()
+    lower_type = content_type.lower()
+
+    if content.startswith(b"%PDF") or "application/pdf" in lower_type or lower_url.endswith(".pdf"):
+        return "pdf"
+    if content.startswith(b"\xD0\xCF\x11\xE0") or lower_url.endswith(".xls"):
+        return "excel"
+    if content.startswith(b"PK\x03\x04"):
+        try:
+            with zipfile.ZipFile(io.BytesIO(content)) as archive:
+                names = set(archive.namelist())
                 if "[Content_Types].xml" in names and any(
                     name.startswith("xl/") for name in names
                 ):
-                    return "excel"
-        except Exception:
-            pass
-        return "zip"
-    if (
-        "csv" in lower_type
-        or lower_url.endswith(".csv")
-        or content[:200].count(b",") >= 2
-    ):
-        return "csv"
-    if "spreadsheet" in lower_type or "excel" in lower_type or lower_url.endswith(".xlsx"):
-        return "excel"
-    return "unknown"
+                    return "excel"
+        except Exception:
+            pass
+        return "zip"
+    if (
+        "csv" in lower_type
+        or lower_url.endswith(".csv")
+        or content[:200].count(b",") >= 2
+    ):
+        return "csv"
+    if "spreadsheet" in lower_type or "excel" in lower_type or lower_url.endswith(".xlsx"):
+        return "excel"
+    return "unknown"
+
+
+def _normalize_jpx_security_code(value: Any) -> str:
+    """
+    JPX PDFの新証券コードは、普通株式の場合
+    3674 -> 36740、215A -> 215A0 のように末尾0が付く。
+    metrics.csv/tickers.txtの4文字コードへ戻す。
+    """
+    code = normalize_code_line(str(value))
+    if len(code) == 5 and code.endswith("0"):
+        return code[:-1]
+    return code
+
+
+def credit_ratios_from_balances(balances: pd.DataFrame) -> dict[str, float]:
+    """code/short/long の表から信用倍率（買残÷売残）。売残0・欠損は比率なし。"""
+    short_balances = balances["short"].to_numpy(dtype=float)
+    long_balances = balances["long"].to_numpy(dtype=float)
+    usable = ~np.isnan(short_balances) & ~np.isnan(long_balances) & (short_balances != 0)
+    ratios_column = np.full(len(balances), np.nan)
+    ratios_column[usable] = long_balances[usable] / short_balances[usable]
+
+    keep = ratios_column >= 0
+    return dict(zip(balances["code"].to_numpy()[keep], ratios_column[keep].tolist()))
+
+
+def _parse_jpx_pdf_balances(content: bytes) -> pd.DataFrame:
+    """
+    JPX週末残高PDFの本文行を直接解析し、銘柄ごとの売残・買残を返す。
+
+    行の主な並び:
+      銘柄名 36740 JP... 売残高 売前週比 買残高 買前週比 ...
+    """
+    codes: list[str] = []
+    shorts: list[float | None] = []
+    longs: list[float | None] = []
+
+    line_pattern = re.compile(
+        r"(?P<code>[0-9A-Z]{5})\s+"
+        r"JP[0-9A-Z]{10}\s+"
+        r"(?P<short>[\d,]+)\s+"
+        r"(?:(?:▲|△|-)\s*)?[\d,]+\s+"
+        r"(?P<long>[\d,]+)(?:\s|$)"
+    )
+
+    with pdfplumber.open(io.BytesIO(content)) as pdf:
+        for page in pdf.pages:
+            page_text = page.extract_text() or ""
+            page_text = unicodedata.normalize("NFKC", page_text)
+
+            for line in page_text.splitlines():
+                match = line_pattern.search(line)
+                if not match:
+                    continue
+
+                code = _normalize_jpx_security_code(match.group("code"))
+                if not re.fullmatch(r"[0-9A-Z]{4}", code):
+                    continue
+
+                codes.append(code)
+                shorts.append(safe_float(match.group("short")))
+                longs.append(safe_float(match.group("long")))
+
+    return pd.DataFrame(
+        {
+            "code": codes,
+            "short": pd.array(shorts, dtype="float64"),
+            "long": pd.array(longs, dtype="float64"),
+        }
+    )
+
+
+def _read_pdf_tables(content: bytes) -> list[pd.DataFrame]:
+    frames: list[pd.DataFrame] = []
+    with pdfplumber.open(io.BytesIO(content)) as pdf:
+        for page in pdf.pages:
+            for table in page.extract_tables() or []:
+                if table:
+                    frames.append(pd.DataFrame(table))
+    return frames
+
+
+def _read_jpx_payload(
+    url: str,
+    content_type: str,
+    content: bytes,
+) -> list[pd.DataFrame]:
+    kind = _payload_kind(url, content_type, content)
+    frames: list[pd.DataFrame] = []
+
+    if kind == "csv":
+        for encoding in ("cp932", "utf-8-sig", "utf-8"):
+            try:
+                frames.append(
+                    pd.read_csv(
+                        io.BytesIO(content),
+                        header=None,
+                        encoding=encoding,
+                    )
+                )
+                return frames
+            except Exception:
+                continue
+        raise RuntimeError("JPX CSVを読み込めませんでした")
+
+    if kind == "pdf":
+        return _read_pdf_tables(content)
+
+    if kind == "zip":
+        with zipfile.ZipFile(io.BytesIO(content)) as archive:
+            for name in archive.namelist():
+                payload = archive.read(name)
+                lower_name = name.lower()
+                if lower_name.endswith((".xlsx", ".xls")):
+                    excel = pd.read_excel(
+                        io.BytesIO(payload),
+                        sheet_name=None,
+                        header=None,
+                    )
+                    frames.extend(excel.values())
+                elif lower_name.endswith(".csv"):
+                    for encoding in ("cp932", "utf-8-sig", "utf-8"):
+                        try:
+                            frames.append(
+                                pd.read_csv(
+                                    io.BytesIO(payload),
+                                    header=None,
+                                    encoding=encoding,
+                                )
+                            )
+                            break
+                        except Exception:
+                            continue
+                elif lower_name.endswith(".pdf"):
+                    frames.extend(_read_pdf_tables(payload))
+        return frames
+
+    if kind == "excel":
+        excel = pd.read_excel(
+            io.BytesIO(content),
+            sheet_name=None,
+            header=None,
+        )
+        frames.extend(excel.values())
+        return frames
+
+    raise RuntimeError(
+        f"JPX候補のファイル形式を判定できません: "
+        f"content-type={content_type or 'unknown'} url={url}"
+    )
+
+
+def _header_text(frame: pd.DataFrame, row: int, column: int) -> str:
+    parts: list[str] = []
+    for offset in range(4, -1, -1):
+        source_row = row - offset
+        if source_row < 0:
+            continue
+        value = frame.iat[source_row, column]
+        if pd.isna(value):
+            continue
+        text = _norm_label(value)
+        if text:
+            parts.append(text)
+    return "".join(parts)
+
+
+def _find_jpx_columns(
+    frame: pd.DataFrame,
+) -> tuple[int, int, int, int] | None:
+    max_header_rows = min(50, len(frame))
+
+    for row in range(max_header_rows):
+        headers = [
+            _header_text(frame, row, col)
+            for col in range(frame.shape[1])
+        ]
+
+        code_candidates = [
+            col
+            for col, value in enumerate(headers)
+            if (
+                "銘柄コード" in value
+                or value.endswith("コード")
+                or value == "コード"
+                or value.lower().endswith("code")
+            )
+        ]
+        short_candidates = [
+            col
+            for col, value in enumerate(headers)
+            if any(
+                key in value
+                for key in (
+                    "売残高",
+                    "売残",
+                    "売り残高",
+                    "売り残",
+                    "short",
+                )
+            )
+        ]
+        long_candidates = [
+            col
+            for col, value in enumerate(headers)
+            if any(
+                key in value
+                for key in (
+                    "買残高",
+                    "買残",
+                    "買い残高",
+                    "買い残",
+                    "long",
+                )
+            )
+        ]
+
+        if not code_candidates or not short_candidates or not long_candidates:
+            continue
+
+        def column_score(column: int, side: str) -> tuple[int, int]:
+            value = headers[column]
+            score = 0
+            if "合計" in value or "総" in value or "total" in value.lower():
+                score += 30
+            if side == "short" and value.endswith(("売残高", "売残")):
+                score += 10
+            if side == "long" and value.endswith(("買残高", "買残")):
+                score += 10
+            if "制度" in value or "一般" in value:
+                score -= 5
+            return score, column
+
+        code_col = code_candidates[0]
+        short_col = max(
+            short_candidates,
+            key=lambda col: column_score(col, "short"),
+        )
+        long_col = max(
+            long_candidates,
+            key=lambda col: column_score(col, "long"),
+        )
+        return row, code_col, short_col, long_col
+
+    return None
+
+
+def _parse_jpx_frame_balances(frame: pd.DataFrame) -> pd.DataFrame:
+    """Excel/CSV/PDF表の1枚から、銘柄ごとの売残・買残を返す。"""
+    frame = frame.replace({"\n": " "}, regex=True)
+    columns = _find_jpx_columns(frame)
+    if columns is None:
+        return pd.DataFrame({"code": [], "short": [], "long": []})
+
+    header_row, code_col, short_col, long_col = columns
+    body = frame.iloc[header_row + 1 :]
+    short_balances, _ = coerce_numeric(body.iloc[:, short_col])
+    long_balances, _ = coerce_numeric(body.iloc[:, long_col])
+
+    # 売残・買残のどちらかが数値の行だけコードを正規化する。
+    numeric = np.flatnonzero(~np.isnan(short_balances) | ~np.isnan(long_balances))
+    codes = [_normalize_jpx_security_code(body.iat[position, code_col]) for position in numeric]
+    valid = np.array([bool(re.fullmatch(r"[0-9A-Z]{4}", code)) for code in codes], dtype=bool)
+    return pd.DataFrame(
+        {
+            "code": [code for code, keep in zip(codes, valid) if keep],
+            "short": short_balances[numeric[valid]],
+            "long": long_balances[numeric[valid]],
+        }
+    )
+
+
+def fetch_jpx_credit_ratios() -> tuple[dict[str, float], str, pd.DataFrame]:
+    """
+    最新の週末残高ファイルから (信用倍率, 取得元URL, 売残・買残) を返す。
+    ファイルは書かない。アーカイブへの保存は呼び出し側（JpxMargin.fetch など）が行う。
+    """
+    errors: list[str] = []
+    found: tuple[dict[str, float], str, pd.DataFrame] | None = None
+
+    try:
+        with trace_span("jpx.discovery") as span:
+            candidates = discover_jpx_margin_candidates()
+            span["candidates"] = len(candidates)
+        print(
+            f"[DEBUG-JPX] filtered_download_candidates={len(candidates)}",
+            flush=True,
+        )
+        for preview in candidates[:5]:
+            print(f"[DEBUG-JPX-CANDIDATE] {preview}", flush=True)
+
+        for url in candidates:
+            try:
+                with trace_span("jpx.download", url=url, cache="miss") as span:
+                    response = http_get(url, retries=JPX_RETRIES, span=span)
+                    response.raise_for_status()
+
+                content_type = response.headers.get("Content-Type", "").lower()
+                if any(
+                    blocked in content_type
+                    for blocked in (
+                        "text/css",
+                        "javascript",
+                        "image/",
+                        "font/",
+                    )
+                ):
+                    continue
+                if (
+                    "text/html" in content_type
+                    and _payload_kind(url, content_type, response.content)
+                    == "unknown"
+                ):
+                    continue
+
+                kind = _payload_kind(
+                    url,
+                    content_type,
+                    response.content,
+                )
+
+                best: dict[str, float] = {}
+                best_balances: pd.DataFrame | None = None
+
+                # 現行JPX週末残高はPDF。表抽出より本文行の方が安定する。
+                if kind == "pdf":
+                    with trace_span("jpx.parse", url=url, kind="pdf_text") as span:
+                        balances = _parse_jpx_pdf_balances(response.content)
+                        parsed_text = credit_ratios_from_balances(balances)
+                        span["rows"] = len(parsed_text)
+
+                    if len(parsed_text) >= MIN_JPX_PARSED_ROWS:
+                        print(
+                            f"[OK] JPX credit ratios rows={len(parsed_text)} "
+                            f"source=pdf_text url={url}",
+                            flush=True,
+                        )
+                        found = (parsed_text, url, balances)
+                        break
+
+                    if parsed_text:
+                        print(
+                            f"[WARN] JPX PDF text parse was too small: "
+                            f"parsed_rows={len(parsed_text)} "
+                            f"minimum={MIN_JPX_PARSED_ROWS} url={url}",
+                            flush=True,
+                        )
+                        best = parsed_text
+                        best_balances = balances
+
+                # Excel/CSV/ZIPおよびPDF表抽出のフォールバック。
+                with trace_span("jpx.parse", url=url, kind=kind) as span:
+                    frames = _read_jpx_payload(
+                        url,
+                        content_type,
+                        response.content,
+                    )
+                    for frame in frames:
+                        balances = _parse_jpx_frame_balances(frame)
+                        parsed = credit_ratios_from_balances(balances)
+                        if len(parsed) > len(best):
+                            best = parsed
+                            best_balances = balances
+                    span["frames"] = len(frames)
+                    span["rows"] = len(best)
+
+                if len(best) >= MIN_JPX_PARSED_ROWS:
+                    print(
+                        f"[OK] JPX credit ratios rows={len(best)} url={url}",
+                        flush=True,
+                    )
+                    assert best_balances is not None
+                    found = (best, url, best_balances)
+                    break
+
+                if best:
+                    print(
+                        f"[WARN] JPX candidate rejected: "
+                        f"parsed_rows={len(best)} minimum={MIN_JPX_PARSED_ROWS} "
+                        f"url={url}",
+                        flush=True,
+                    )
+
+            except Exception as exc:
+                errors.append(
+                    f"{url}: {type(exc).__name__}: {exc}"
+                )
+
+        if found is None:
+            detail = errors[-1] if errors else "解析可能な候補なし"
+            raise RuntimeError(
+                "JPX信用残高ファイルを取得・解析できませんでした。"
+                f" last={detail}"
+            )
+        if "3674" in found[0]:
+            print(
+                f"[DEBUG-JPX-3674] credit_ratio={round(found[0]['3674'], 4)}",
+                flush=True,
+            )
+        return found
+
+    except Exception as exc:
+        message = (
+            f"JPX credit ratios unavailable: "
+            f"{type(exc).__name__}: {exc}"
+        )
+        if STRICT_JPX:
+            raise RuntimeError(message) from exc
+        print(f"[WARN] {message}", flush=True)
+        return {}, "", pd.DataFrame({"code": [], "short": [], "long": []})
+
+
+# ====== JPX週末残高アーカイブ ======
+# 公表日ごとに code/short/long を1ファイルへ保存し、過去週のPDFを再取得・再解析せずに
+# 前週比や傾きを計算する。1週は約4,000行・数十KiBに収まる。
+def _margin_archive_root(root: str | Path | None = None) -> Path | None:
+    value = JPX_MARGIN_ARCHIVE if root is None else str(root)
+    return Path(value) if value and value != "0" else None
+
+
+def jpx_publication_date(url: str) -> date | None:
+    """添付ファイル名（syumatsu2026101600.pdf 等）から公表日を読む。"""
+    score = _parse_date_score(urlsplit(url).path.rsplit("/", 1)[-1])
+    return datetime.strptime(str(score), "%Y%m%d").date() if score else None
+
+
+def archive_jpx_margin_week(
+    balances: pd.DataFrame,
+    source: str,
+    *,
+    publication: date | None = None,
+    root: str | Path | None = None,
+) -> Path | None:
+    """1週分の売残・買残を <root>/<公表日>.parquet へ書く。同じ週は置き換える。"""
+    directory = _margin_archive_root(root)
+    publication = publication or jpx_publication_date(source)
+    if directory is None:
+        return None
+    if publication is None:
+        print(f"[WARN] JPX margin archive skipped: publication date unknown url={source}", flush=True)
+        return None
+
+    rows = balances.dropna(subset=["short", "long"]).drop_duplicates("code", keep="last")
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as exc:
+        print(f"[WARN] JPX margin archive skipped: {exc}", flush=True)
+        return None
+
+    table = pa.table(
+        {
+            "publication_date": pa.array([publication] * len(rows), pa.date32()),
+            "code": pa.array(rows["code"].tolist(), pa.string()),
+            "short": pa.array(rows["short"].to_numpy().astype("int64"), pa.int64()),
+            "long": pa.array(rows["long"].to_numpy().astype("int64"), pa.int64()),
+        },
+        metadata={"source": source, "script_version": SCRIPT_VERSION},
+    )
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f"{publication.isoformat()}.parquet"
+    _atomic_write(path, lambda target: pq.write_table(table, target, compression="zstd"))
+    print(f"[OK] JPX margin archived rows={len(rows)} publication={publication.isoformat()} path={path}", flush=True)
+    return path
+
+
+def load_jpx_margin_archive(
+    weeks: int | None = None,
+    *,
+    through: date | None = None,
+    root: str | Path | None = None,
+) -> pd.DataFrame:
+    """アーカイブの直近 weeks 週（through 以前）を publication_date/code/short/long の表で返す。"""
+    empty = pd.DataFrame(
+        {
+            "publication_date": pd.Series(dtype="datetime64[ns]"),
+            "code": pd.Series(dtype="string"),
+            "short": pd.Series(dtype="int64"),
+            "long": pd.Series(dtype="int64"),
+        }
+    )
+    directory = _margin_archive_root(root)
+    if directory is None or not directory.is_dir():
+        return empty
+
+    files = sorted(directory.glob("????-??-??.parquet"))
+    if through is not None:
+        files = [file for file in files if file.stem <= through.isoformat()]
+    if weeks is not None:
+        files = files[-weeks:]
+    if not files:
+        return empty
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pa.concat_tables([pq.read_table(file) for file in files])
+    frame = table.to_pandas()
+    frame["publication_date"] = pd.to_datetime(frame["publication_date"])
+    return frame
+
+
+def margin_trend_metrics(archive: pd.DataFrame, weeks: int = JPX_MARGIN_TREND_WEEKS) -> pd.DataFrame:
+    """
+    最新公表週の前週比（売残・買残は%、信用倍率は差）と、直近 weeks 週の信用倍率の
+    最小二乗の傾き（1週あたり）。週×銘柄の行列で一括計算し、code を索引に返す。
+    前週が10日より前なら前週比は欠損。傾きは3週以上そろった銘柄だけ。
+    """
+    if archive.empty:
+        return pd.DataFrame(columns=MARGIN_OUTPUT_COLUMNS)
+
+    short = archive.pivot(index="publication_date", columns="code", values="short").sort_index()
+    long = archive.pivot(index="publication_date", columns="code", values="long").reindex(short.index)
+    short = short.iloc[-weeks:]
+    long = long.iloc[-weeks:]
+    short_values = short.to_numpy(dtype=float)
+    long_values = long.to_numpy(dtype=float)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = np.where(short_values > 0, long_values / short_values, np.nan)
+
+        result = pd.DataFrame(index=short.columns.astype(str))
+        nan_row = np.full(short_values.shape[1], np.nan)
+        days = (short.index - short.index[-1]).days.to_numpy()
+        if len(days) >= 2 and days[-2] >= -10:
+            previous_short, previous_long = short_values[-2], long_values[-2]
+            result[MARGIN_OUTPUT_COLUMNS[0]] = np.where(
+                previous_short > 0, (short_values[-1] / previous_short - 1) * 100, np.nan
+            )
+            result[MARGIN_OUTPUT_COLUMNS[1]] = np.where(
+                previous_long > 0, (long_values[-1] / previous_long - 1) * 100, np.nan
+            )
+            result[MARGIN_OUTPUT_COLUMNS[2]] = ratio[-1] - ratio[-2]
+        else:
+            for column in MARGIN_OUTPUT_COLUMNS[:3]:
+                result[column] = nan_row
+
+        # 欠けた週を除いた単回帰の傾き。x は最新週からの週数。
+        x = (days / 7.0)[:, None]
+        present = ~np.isnan(ratio)
+        count = present.sum(axis=0)
+        x_mean = np.where(present, x, 0).sum(axis=0) / count
+        y_mean = np.where(present, ratio, 0).sum(axis=0) / count
+        dx = np.where(present, x - x_mean, 0)
+        covariance = (dx * np.where(present, ratio - y_mean, 0)).sum(axis=0)
+        variance = (dx * dx).sum(axis=0)
+        slope = np.where((count >= 3) & (variance > 0), covariance / variance, np.nan)
+        result[MARGIN_OUTPUT_COLUMNS[3]] = slope
+    return result
+
+
+def margin_trends_for(publication: date | None) -> dict[str, dict[str, float]]:
+    """build_row へ渡す {code: {列: 値}}。アーカイブが無い・最新週が違う場合は空。"""
+    if publication is None or _margin_archive_root() is None:
+        return {}
+    try:
+        archive = load_jpx_margin_archive(JPX_MARGIN_TREND_WEEKS, through=publication)
+    except ImportError as exc:
+        print(f"[WARN] JPX margin trends skipped: {exc}", flush=True)
+        return {}
+    if archive.empty or archive["publication_date"].max().date() != publication:
+        return {}
+    trends = margin_trend_metrics(archive)
+    return {
+        code: {column: value for column, value in values.items() if not pd.isna(value)}
+        for code, values in trends.to_dict("index").items()
+    }
+
+
+def margin_command(args: argparse.Namespace) -> int:
+    """手元の週末残高ファイル、または --fetch でJPXの最新週を取り込み、アーカイブの週と行数を表示する。"""
+    if args.fetch:
+        credit_ratios, credit_url, balances = fetch_jpx_credit_ratios()
+        if credit_ratios:
+            archive_jpx_margin_week(balances, credit_url)
+        else:
+            print("[WARN] JPX margin file could not be fetched", flush=True)
+    for name in args.import_files or []:
+        content = Path(name).read_bytes()
+        publication = date.fromisoformat(args.date) if args.date else jpx_publication_date(name)
+        if _payload_kind(name, "", content) == "pdf":
+            balances = _parse_jpx_pdf_balances(content)
+        else:
+            frames = [_parse_jpx_frame_balances(frame) for frame in _read_jpx_payload(name, "", content)]
+            balances = max(frames, key=len) if frames else pd.DataFrame({"code": [], "short": [], "long": []})
+        if balances.empty:
+            print(f"[WARN] no margin balances parsed: {name}", flush=True)
+            continue
+        archive_jpx_margin_week(balances, name, publication=publication)
+
+    archive = load_jpx_margin_archive()
+    if archive.empty:
+        print(f"[WARN] JPX margin archive is empty: {JPX_MARGIN_ARCHIVE}", flush=True)
+        return 1
+    weeks = archive.groupby("publication_date").size()
+    print(f"weeks={len(weeks)} rows={len(archive)} path={JPX_MARGIN_ARCHIVE}")
+    for publication, count in weeks.tail(args.tail).items():
+        print(f"  {publication.date().isoformat()}  {count:>6}")
+    return 0
+
+
+# ====== 上場銘柄ユニバース（JPX上場銘柄一覧） ======
+# data_j.xls（月次更新）を code/name/segment/sector のTSVへ縮めてキャッシュする。
+# 通常の実行はTSVを読むだけ。元ファイルは UNIVERSE_MAX_AGE_HOURS ごとに条件付きGETで確認し、
+# ETag/Last-Modified/本文のハッシュが変わったときだけ解析し直す。
+LISTED_INDEX_VERSION = 1
+LISTED_INDEX_COLUMNS = ["code", "name", "segment", "sector_code", "sector"]
+LISTED_SOURCE_COLUMNS = {
+    "code": ["コード", "LocalCode"],
+    "name": ["銘柄名", "Name(English)"],
+    "segment": ["市場・商品区分", "Section/Products"],
+    "sector_code": ["33業種コード", "33Sector(Code)"],
+    "sector": ["33業種区分", "33Sector(name)"],
+    "as_of": ["日付", "Date"],
+}
+
+
+def _listed_text(value: Any) -> str:
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ""
+    text = unicodedata.normalize("NFKC", str(value))
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def parse_listed_companies(content: bytes) -> tuple[list[dict[str, str]], str]:
+    """上場銘柄一覧（xls/xlsx）を索引の行と基準日（日付列）へ。"""
+    frame = pd.read_excel(io.BytesIO(content), dtype=str)
+    normalized = {re.sub(r"\s", "", _listed_text(column)): column for column in frame.columns}
+    columns: dict[str, Any] = {}
+    for key, candidates in LISTED_SOURCE_COLUMNS.items():
+        for candidate in candidates:
+            if candidate in normalized:
+                columns[key] = normalized[candidate]
+                break
+    if "code" not in columns:
+        raise RuntimeError(f"上場銘柄一覧にコード列がありません columns={list(frame.columns)[:10]}")
+
+    rows: list[dict[str, str]] = []
+    seen: set[str] = set()
+    for record in frame.to_dict("records"):
+        code = normalize_code_line(_listed_text(record[columns["code"]]))
+        if not code or code in seen:
+            continue
+        seen.add(code)
+        row = {key: _listed_text(record[columns[key]]) if key in columns else "" for key in LISTED_INDEX_COLUMNS}
+        row["code"] = code
+        rows.append(row)
+
+    as_of = ""
+    if "as_of" in columns and not frame.empty:
+        as_of = _listed_text(frame[columns["as_of"]].iloc[0])
+    return rows, as_of
+
+
+def _read_listed_index(path: Path) -> tuple[list[dict[str, str]], dict[str, str]]:
+    """索引キャッシュを読む。無い・版が違う場合は空を返す。"""
+    if not path.exists():
+        return [], {}
+
+    rows: list[dict[str, str]] = []
+    meta: dict[str, str] = {}
+    with open(path, "r", encoding="utf-8") as file:
+        for line in file:
+            line = line.rstrip("\n")
+            if not line:
+                continue
+            if line.startswith("#"):
+                key, separator, value = line[1:].strip().partition("=")
+                if separator:
+                    meta[key] = value
+                continue
+            rows.append(dict(zip(LISTED_INDEX_COLUMNS, line.split("\t"))))
+
+    if meta.get("version") != str(LISTED_INDEX_VERSION):
+        print(
+            f"[WARN] listed index version mismatch "
+            f"found={meta.get('version')} expected={LISTED_INDEX_VERSION} path={path}",
+            flush=True,
+        )
+        return [], {}
+    return rows, meta
+
+
+def _write_listed_index(path: Path, rows: list[dict[str, str]], meta: dict[str, str]) -> None:
+    header = [
+        "# JPX listed companies index (tab separated: " + ", ".join(LISTED_INDEX_COLUMNS) + ")",
+        f"# version={LISTED_INDEX_VERSION}",
+        *(f"# {key}={value}" for key, value in meta.items() if key != "version"),
+    ]
+    lines = ["\t".join(row.get(column, "") for column in LISTED_INDEX_COLUMNS) for row in rows]
+    temporary_path = path.with_name(path.name + ".tmp")
+    temporary_path.write_text("\n".join(header + lines) + "\n", encoding="utf-8")
+    os.replace(temporary_path, path)
+
+
+def refresh_listed_index(
+    *,
+    force: bool = False,
+    path: Path | None = None,
+) -> tuple[list[dict[str, str]], dict[str, str]]:
+    """
+    索引キャッシュを返す。確認間隔を過ぎていれば（force で常に）元ファイルを条件付きGETし、
+    変わっていたときだけ解析し直す。取得に失敗した場合は既存のキャッシュを使う。
+    """
+    path = path or UNIVERSE_CACHE
+    rows, meta = _read_listed_index(path)
+    now = datetime.now(JST)
+    same_source = meta.get("source_url") == JPX_LISTED_URL
+    if rows and same_source and not force:
+        try:
+            checked_at = datetime.fromisoformat(meta.get("checked_at", ""))
+        except ValueError:
+            checked_at = None
+        if checked_at is not None and now - checked_at < timedelta(hours=UNIVERSE_MAX_AGE_HOURS):
+            return rows, meta
+
+    headers: dict[str, str] = {}
+    if rows and same_source:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    with trace_span("universe", url=JPX_LISTED_URL) as span:
+        try:
+            response = http_get(JPX_LISTED_URL, retries=JPX_RETRIES, span=span, headers=headers)
+            if response.status_code not in (200, 304):
+                raise RuntimeError(f"HTTP {response.status_code}")
+        except (requests.RequestException, CircuitOpenError, RuntimeError) as exc:
+            if not rows:
+                raise RuntimeError(
+                    f"上場銘柄一覧を取得できず、キャッシュもありません: {JPX_LISTED_URL} ({exc})"
+                ) from exc
+            print(f"[WARN] listed index refresh failed; using cache: {type(exc).__name__}: {exc}", flush=True)
+            span["changed"] = False
+            return rows, meta
+
+        if response.status_code == 304:
+            span["changed"] = False
+            meta["checked_at"] = now.isoformat(timespec="seconds")
+            _write_listed_index(path, rows, meta)
+            return rows, meta
+
+        digest = hashlib.sha256(response.content).hexdigest()
+        span["changed"] = not (rows and same_source and digest == meta.get("sha256"))
+        as_of = meta.get("as_of", "")
+        if span["changed"]:
+            rows, as_of = parse_listed_companies(response.content)
+            if not rows:
+                raise RuntimeError(f"上場銘柄一覧に銘柄がありません: {JPX_LISTED_URL}")
+        span["rows"] = len(rows)
+        meta = {
+            "source_url": JPX_LISTED_URL,
+            "etag": response.headers.get("ETag", ""),
+            "last_modified": response.headers.get("Last-Modified", ""),
+            "sha256": digest,
+            "as_of": as_of,
+            "checked_at": now.isoformat(timespec="seconds"),
+        }
+        _write_listed_index(path, rows, meta)
+        if span["changed"]:
+            print(f"[OK] listed index rebuilt rows={len(rows)} as_of={as_of} path={path}", flush=True)
+    return rows, meta
+
+
+def _filter_tokens(value: str) -> list[str]:
+    return [_listed_text(token) for token in value.split(",") if token.strip()]
+
+
+def filter_listed_index(
+    rows: list[dict[str, str]],
+    *,
+    segments: str | None = None,
+    sectors: str | None = None,
+) -> list[dict[str, str]]:
+    """市場・商品区分は部分一致、33業種はコード一致か名称の部分一致で絞り込む。"""
+    segment_tokens = _filter_tokens(UNIVERSE_SEGMENTS if segments is None else segments)
+    sector_tokens = _filter_tokens(UNIVERSE_SECTORS if sectors is None else sectors)
+    if segment_tokens:
+        segment_pattern = re.compile("|".join(map(re.escape, segment_tokens)))
+        rows = [row for row in rows if segment_pattern.search(row["segment"])]
+    if sector_tokens:
+        sector_codes = set(sector_tokens)
+        sector_pattern = re.compile("|".join(map(re.escape, sector_tokens)))
+        rows = [
+            row
+            for row in rows
+            if row["sector_code"] in sector_codes or sector_pattern.search(row["sector"])
+        ]
+    return rows
+
+
+def listed_universe_codes(
+    *,
+    segments: str | None = None,
+    sectors: str | None = None,
+    offline: bool = False,
+) -> list[str]:
+    """offline=True ではキャッシュだけを読み、元ファイルは確認しない。"""
+    if offline:
+        rows, meta = _read_listed_index(UNIVERSE_CACHE)
+        if not rows:
+            raise RuntimeError(f"上場銘柄一覧のキャッシュがありません: {UNIVERSE_CACHE}")
+    else:
+        rows, meta = refresh_listed_index()
+    selected = filter_listed_index(rows, segments=segments, sectors=sectors)
+    print(
+        f"[CONFIG] universe=jpx listed={len(rows)} selected={len(selected)} "
+        f"as_of={meta.get('as_of', '')} "
+        f"segments={UNIVERSE_SEGMENTS if segments is None else segments!r} "
+        f"sectors={UNIVERSE_SECTORS if sectors is None else sectors!r}",
+        flush=True,
+    )
+    return [row["code"] for row in selected]
+
+
+def universe_command(args: argparse.Namespace) -> int:
+    rows, meta = refresh_listed_index(force=args.refresh)
+    selected = filter_listed_index(rows, segments=args.segment, sectors=args.sector)
+    print(
+        f"listed={len(rows)} selected={len(selected)} as_of={meta.get('as_of', '')} "
+        f"checked_at={meta.get('checked_at', '')} path={UNIVERSE_CACHE}",
+        flush=True,
+    )
+    counts: dict[str, int] = {}
+    for row in selected:
+        counts[row["segment"]] = counts.get(row["segment"], 0) + 1
+    for segment, count in sorted(counts.items(), key=lambda item: -item[1]):
+        print(f"  {count:>6}  {segment}", flush=True)
+    if args.output:
+        Path(args.output).write_text(
+            "".join(f"{row['code']}\n" for row in selected),
+            encoding="utf-8",
+        )
+        print(f"[OK] codes written: {args.output} ({len(selected)} codes)", flush=True)
+    return 0
+
+
+# ====== Main ======
+def read_tickers_file(path: str | Path) -> list[str]:
+    with open(path, "r", encoding="utf-8") as file:
+        raw = [line for line in file if line.strip()]
+
+    codes = [normalize_code_line(line) for line in raw]
+    codes = [code for code in codes if code]
+    return list(dict.fromkeys(codes))
+
+
+def parse_portfolios(value: str | list[str]) -> dict[str, Path]:
+    """"name=path,name=path"（または --portfolio の繰り返し）を 名前 -> ファイル にする。"""
+    entries = value.split(",") if isinstance(value, str) else value
+    portfolios: dict[str, Path] = {}
+    for entry in entries:
+        if not entry.strip():
+            continue
+        name, separator, path = entry.partition("=")
+        name = name.strip()
+        if not separator or not path.strip() or not re.fullmatch(r"[\w.-]+", name):
+            raise RuntimeError(f"PORTFOLIOS は name=path の形式で指定してください: {entry!r}")
+        if name in portfolios:
+            raise RuntimeError(f"PORTFOLIOS の名前が重複しています: {name}")
+        portfolios[name] = Path(path.strip())
+    return portfolios
+
+
+def portfolio_codes(portfolios: dict[str, Path] | None = None) -> dict[str, list[str]]:
+    """名前 -> そのリストの順のコード。portfolios が無ければ PORTFOLIOS を使う。"""
+    portfolios = parse_portfolios(PORTFOLIOS) if portfolios is None else portfolios
+    return {name: read_tickers_file(path) for name, path in portfolios.items()}
+
+
+def read_codes(*, offline: bool = False, portfolios: dict[str, Path] | None = None) -> list[str]:
+    lists = portfolio_codes(portfolios)
+    if lists:
+        # 重なる銘柄は最初に現れたリストの位置で1回だけ取得する。
+        codes = list(dict.fromkeys(code for codes in lists.values() for code in codes))
+    elif UNIVERSE == "jpx":
+        codes = listed_universe_codes(offline=offline)
+    elif UNIVERSE == "tickers":
+        codes = read_tickers_file(TICKERS_FILE)
+    else:
+        raise RuntimeError(f"未対応のUNIVERSEです: {UNIVERSE}（tickers / jpx）")
+
+    offset = int(os.getenv("OFFSET", "0"))
+    limit = int(os.getenv("MAX_TICKERS", "0"))
+    if limit > 0:
+        return codes[offset : offset + limit]
+    if offset > 0:
+        return codes[offset:]
+    return codes
+
+
+def build_row(
+    code: str,
+    market: dict[str, Any],
+    credit_ratios: dict[str, float],
+    margin_trends: dict[str, dict[str, float]] | None = None,
+    sources: dict[str, list[list[str]] | None] | None = None,
+) -> list[Any]:
+    """sources（取得済みのIRBANK CSV）を渡すと通信せずに行を作る。"""
+    latest_price = market["latest_price"]
+    financial = fetch_financial_values(code, sources)
+
+    per = safe_div(latest_price, financial["eps"])
+    pbr = safe_div(latest_price, financial["bps"])
+    roe_pct = financial["roe_pct"]
+    if roe_pct is None:
+        roe_pct = safe_div(
+            financial["profit"],
+            financial["equity"],
+            100.0,
+        )
+    equity_ratio_pct = financial["equity_ratio_pct"]
+    if equity_ratio_pct is None:
+        equity_ratio_pct = safe_div(
+            financial["equity"],
+            financial["assets"],
+            100.0,
+        )
+    dividend_per_share_value = financial["dps"]
+    if dividend_per_share_value is None:
+        dividend_per_share_value = market.get("trailing_dividend")
+        if dividend_per_share_value is not None:
+            print(
+                f"[DEBUG-DIVIDEND] {code} source=yahoo_ttm "
+                f"dps={dividend_per_share_value}",
+                flush=True,
+            )
+
+    dividend_yield_pct = safe_div(
+        dividend_per_share_value,
+        latest_price,
+        100.0,
+    )
+    if dividend_yield_pct is not None and not (0 <= dividend_yield_pct <= 30):
+        print(
+            f"[WARN] {code} rejected abnormal dividend yield: "
+            f"dps={dividend_per_share_value} price={latest_price} "
+            f"yield={dividend_yield_pct}",
+            flush=True,
+        )
+        dividend_yield_pct = None
+
+    op_yoy = fetch_opinc_yoy(code) if sources is None else fetch_opinc_yoy(code, sources.get(CSV_QQ) or [])
+    credit_ratio = credit_ratios.get(code)
+    margin_trend = (margin_trends or {}).get(code, {})
+
+    return [
+        code,
+        output_value(per),
+        output_value(pbr),
+        output_value(roe_pct),
+        output_value(equity_ratio_pct),
+        output_value(dividend_yield_pct),
+        output_value(op_yoy),
+        output_value(credit_ratio),
+        output_value(market["vol5"], digits=0),
+        output_value(market["vol25"], digits=0),
+        output_value(market["volratio_5_25"]),
+        output_value(market["deviation_25ma_pct"]),
+        *(output_value(market["indicators"].get(spec.name)) for spec in INDICATORS),
+        *(output_value(margin_trend.get(column)) for column in MARGIN_OUTPUT_COLUMNS),
+    ]
+
+
+def typed_metrics_frame(
+    rows: list[list[Any]],
+    columns: list[str] | None = None,
+) -> pd.DataFrame:
+    """build_row の行（欠損は空文字）を output_schema の型へ揃える。"""
+    columns = columns or OUTPUT_COLUMNS
+    frame = pd.DataFrame(rows, columns=columns, dtype="object")
+    frame = frame.replace({"": None})
+    for column, dtype in output_schema(columns).items():
+        if dtype == "string":
+            frame[column] = frame[column].astype("string")
+        elif dtype == "Int64":
+            frame[column] = pd.to_numeric(frame[column], errors="coerce").round().astype("Int64")
+        else:
+            frame[column] = pd.to_numeric(frame[column], errors="coerce").astype("float64")
+    return frame
+
+
+def arrow_schema(columns: list[str] | None = None, metadata: dict[str, str] | None = None):
+    import pyarrow as pa
+
+    types = {"string": pa.string(), "Int64": pa.int64(), "float64": pa.float64()}
+    return pa.schema(
+        [
+            pa.field(column, types[dtype], nullable=column != "code")
+            for column, dtype in output_schema(columns).items()
+        ],
+        metadata={key: str(value) for key, value in (metadata or {}).items()},
+    )
+
+
+def _atomic_write(path: Path, write: Callable[[Path], None]) -> None:
+    """同じディレクトリの一時ファイルへ書き、fsync後に置き換える。"""
+    directory = path.parent.resolve()
+    file_descriptor, temporary_name = tempfile.mkstemp(
+        dir=directory,
+        prefix=f"{path.stem}_",
+        suffix=".tmp",
+    )
+    os.close(file_descriptor)
+    temporary_path = Path(temporary_name)
+    try:
+        write(temporary_path)
+        with open(temporary_path, "rb") as file:
+            os.fsync(file.fileno())
+        os.replace(temporary_path, path)
+    finally:
+        temporary_path.unlink(missing_ok=True)
+
+
+def _write_csv(path: Path, rows: list[list[Any]], columns: list[str]) -> None:
+    with open(path, "w", newline="", encoding="utf-8") as file:
+        writer = csv.writer(file)
+        writer.writerow(columns)
+        writer.writerows(rows)
+
+
+def _write_ndjson(path: Path, frame: pd.DataFrame) -> None:
+    with open(path, "w", encoding="utf-8") as file:
+        for record in frame.astype(object).where(frame.notna(), None).to_dict("records"):
+            file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def write_metrics_atomically(
+    rows: list[list[Any]],
+    output_path: Path | str = "metrics.csv",
+    *,
+    columns: list[str] | None = None,
+    metadata: dict[str, str] | None = None,
+) -> None:
+    """
+    metrics.csv と、同じ行から作る型付き出力（metrics.parquet / .arrow / .ndjson）を
+    それぞれ原子的に書き出す。型付き出力の種類は OUTPUT_FORMATS で選ぶ。
+    """
+    output_path = Path(output_path)
+    columns = columns or OUTPUT_COLUMNS
+    metadata = {"script_version": SCRIPT_VERSION, **(metadata or {})}
+
+    _atomic_write(output_path, lambda path: _write_csv(path, rows, columns))
+    print(f"{output_path.name} written", flush=True)
+
+    typed_formats = [value for value in OUTPUT_FORMATS if value != "csv"]
+    if not typed_formats:
+        return
+
+    frame = typed_metrics_frame(rows, columns)
+    for output_format in typed_formats:
+        target = output_path.with_suffix(f".{output_format}")
+        try:
+            if output_format == "ndjson":
+                _atomic_write(target, lambda path: _write_ndjson(path, frame))
+            elif output_format in ("parquet", "arrow"):
+                import pyarrow as pa
+
+                table = pa.Table.from_pandas(
+                    frame,
+                    schema=arrow_schema(columns, metadata),
+                    preserve_index=False,
+                )
+                if output_format == "parquet":
+                    import pyarrow.parquet as pq
+
+                    _atomic_write(target, lambda path: pq.write_table(table, path, compression="zstd"))
+                else:
+                    import pyarrow.feather as feather
+
+                    _atomic_write(target, lambda path: feather.write_feather(table, path, compression="zstd"))
+            else:
+                print(f"[WARN] unknown OUTPUT_FORMATS entry: {output_format}", flush=True)
+                continue
+        except ImportError as exc:
+            print(f"[WARN] {target.name} skipped: {exc}", flush=True)
+            continue
+        print(f"{target.name} written", flush=True)
+
+
+def write_portfolio_outputs(
+    rows: list[list[Any]],
+    lists: dict[str, list[str]],
+    *,
+    metadata: dict[str, str] | None = None,
+) -> dict[str, int]:
+    """和集合の行から、リストごとにその順で metrics_<name>.csv（と型付き出力）を書く。"""
+    by_code = {row[0]: row for row in rows}
+    counts = {}
+    for name, codes in lists.items():
+        selected = [by_code[code] for code in codes if code in by_code]
+        write_metrics_atomically(
+            selected,
+            f"metrics_{name}.csv",
+            metadata={**(metadata or {}), "portfolio": name},
+        )
+        counts[name] = len(selected)
+        if len(selected) < len(codes):
+            print(f"[WARN] portfolio {name}: {len(codes) - len(selected)} of {len(codes)} codes have no row", flush=True)
+    return counts
+
+
+# ====== ライブラリAPI（取得元の差し替え） ======
+# 他のサービスから import scraper して compute_metrics() を呼べるようにする。
+# 株価・財務・信用残の取得元は下の Protocol を満たせば差し替えられ、既定は通信する実装。
+# 同じプロセスで呼び続ければ SESSION の接続と当日キャッシュ（enable_warm_cache）を使い回せる。
+class PriceSource(Protocol):
+    def iter_frames(
+        self, codes: list[str], expected_date: date
+    ) -> Iterator[tuple[list[str], dict[str, pd.DataFrame]]]:
+        """(コード, {コード: 日足}) をチャンクごとに返す。日足は _extract_symbol_frame と同じ形。"""
+        ...
+
+
+class FundamentalsSource(Protocol):
+    def required(self, code: str) -> dict[str, list[list[str]] | None]:
+        """REQUIRED_CSVS の {ファイル名: CSVの行}。取れないものは None。"""
+        ...
+
+    def fallback(self, code: str) -> list[list[str]] | None:
+        """個別CSVで埋まらない項目を補う一括CSV（CSV_ALL）の行。"""
+        ...
+
+
+class MarginSource(Protocol):
+    def fetch(
+        self, expected_date: date, span: dict[str, Any] | None = None
+    ) -> tuple[dict[str, float], dict[str, dict[str, float]]]:
+        """(信用倍率 {コード: 倍率}, 週次の増減 {コード: {MARGIN_OUTPUT_COLUMNSの列: 値}})。"""
+        ...
+
+
+class NetworkPrices:
+    """Yahoo（PRICE_PROVIDERS の順にヘッジ）から YAHOO_CHUNK_SIZE 銘柄ずつ取る。"""
+
+    def iter_frames(
+        self, codes: list[str], expected_date: date
+    ) -> Iterator[tuple[list[str], dict[str, pd.DataFrame]]]:
+        for chunk, frames in iter_yahoo_chunks(codes, expected_date=expected_date):
+            yield chunk, {code: frames.pop(yahoo_symbol(code), pd.DataFrame()) for code in chunk}
+
+
+class IrbankFundamentals:
+    def required(self, code: str) -> dict[str, list[list[str]] | None]:
+        return fetch_required_csvs(code)
+
+    def fallback(self, code: str) -> list[list[str]] | None:
+        return get_csv(code, CSV_ALL)
+
+
+class JpxMargin:
+    """JPXの最新週末残高と、アーカイブからの週次の増減。当日分は warm cache に載せる。"""
+
+    def fetch(
+        self, expected_date: date, span: dict[str, Any] | None = None
+    ) -> tuple[dict[str, float], dict[str, dict[str, float]]]:
+        span = {} if span is None else span
+        cached = warm_get(("jpx", expected_date))
+        if cached is not None:
+            credit_ratios, credit_url = cached
+        elif deadline_reached():
+            record_skip("jpx")
+            print("[DEADLINE] JPX: credit ratios skipped", flush=True)
+            credit_ratios, credit_url = {}, ""
+        else:
+            credit_ratios, credit_url, balances = fetch_jpx_credit_ratios()
+            if credit_ratios:
+                warm_put(("jpx", expected_date), (credit_ratios, credit_url))
+                _best_effort("margin.archive", lambda archive_span: archive_jpx_margin_week(balances, credit_url))
+        span["cache"] = "miss" if cached is None else "hit"
+        span["rows"] = len(credit_ratios)
+        span["url"] = credit_url
+        margin_trends = margin_trends_for(jpx_publication_date(credit_url) if credit_url else None)
+        span["trend_rows"] = len(margin_trends)
+        return credit_ratios, margin_trends
+
+
+class InMemoryPrices:
+    """{コード: 日足} から返す。日足は Close・Volume を含み、日付索引であればよい。"""
+
+    def __init__(self, frames: dict[str, pd.DataFrame]) -> None:
+        self.frames = frames
+
+    def iter_frames(
+        self, codes: list[str], expected_date: date
+    ) -> Iterator[tuple[list[str], dict[str, pd.DataFrame]]]:
+        yield codes, {
+            code: _extract_symbol_frame(self.frames[code], code) for code in codes if code in self.frames
+        }
+
+
+class InMemoryFundamentals:
+    """{コード: {ファイル名: CSV本文 または 行のリスト}} から返す。"""
+
+    def __init__(self, tables: dict[str, dict[str, str | list[list[str]]]]) -> None:
+        self.tables = tables
+
+    def _rows(self, code: str, path: str) -> list[list[str]] | None:
+        table = self.tables.get(code, {}).get(path)
+        if isinstance(table, str):
+            return read_csv_rows(io.StringIO(table)) or None
+        return table
+
+    def required(self, code: str) -> dict[str, list[list[str]] | None]:
+        return {path: self._rows(code, path) for path in REQUIRED_CSVS}
+
+    def fallback(self, code: str) -> list[list[str]] | None:
+        return self._rows(code, CSV_ALL)
+
+
+class InMemoryMargin:
+    def __init__(
+        self,
+        credit_ratios: dict[str, float] | None = None,
+        margin_trends: dict[str, dict[str, float]] | None = None,
+    ) -> None:
+        self.credit_ratios = credit_ratios or {}
+        self.margin_trends = margin_trends or {}
+
+    def fetch(
+        self, expected_date: date, span: dict[str, Any] | None = None
+    ) -> tuple[dict[str, float], dict[str, dict[str, float]]]:
+        return self.credit_ratios, self.margin_trends
+
+
+@dataclass
+class MetricsProviders:
+    prices: PriceSource = field(default_factory=NetworkPrices)
+    fundamentals: FundamentalsSource = field(default_factory=IrbankFundamentals)
+    margin: MarginSource = field(default_factory=JpxMargin)
+
+
+def collect_fundamentals(
+    codes: list[str],
+    fundamentals: FundamentalsSource,
+) -> dict[str, dict[str, list[list[str]] | None]]:
+    """
+    期限に備え、全銘柄の必須CSVを先に取り、一括CSVでの補完は残り時間で後から行う。
+    返り値は {コード: {ファイル名: CSVの行}}。期限で取れなかった銘柄は含まない。
+    """
+    sources: dict[str, dict[str, list[list[str]] | None]] = {}
+    # 礼儀上の待機は通信する取得元のときだけ。
+    pause = ROW_SLEEP_SECONDS if isinstance(fundamentals, IrbankFundamentals) else 0.0
+    with trace_span("rows", tickers=len(codes)):
+        for index, code in enumerate(codes, 1):
+            if deadline_reached():
+                for skipped in codes[index - 1 :]:
+                    record_skip("irbank", skipped, "required")
+                print(f"[DEADLINE] IRBANK: {len(codes) - index + 1} tickers not fetched", flush=True)
+                break
+            print(f"[{index}/{len(codes)}] {code} financial metrics", flush=True)
+            with trace_span("row", code=code):
+                sources[code] = fundamentals.required(code)
+            polite_sleep(pause)
+
+    deferred = [code for code, fetched in sources.items() if needs_data_all(fetched)]
+    if deferred:
+        with trace_span("rows.deferred", tickers=len(deferred)):
+            for index, code in enumerate(deferred):
+                if deadline_reached():
+                    for skipped in deferred[index:]:
+                        record_skip("irbank", skipped, CSV_ALL)
+                    print(f"[DEADLINE] IRBANK: {CSV_ALL} skipped for {len(deferred) - index} tickers", flush=True)
+                    break
+                with trace_span("row", code=code, deferred=True):
+                    sources[code][CSV_ALL] = fundamentals.fallback(code)
+                polite_sleep(pause)
+    return sources
+
+
+def build_rows(
+    codes: list[str],
+    market_metrics: dict[str, dict[str, Any]],
+    credit_ratios: dict[str, float],
+    margin_trends: dict[str, dict[str, float]],
+    sources: dict[str, dict[str, list[list[str]] | None]],
+) -> list[list[Any]]:
+    """財務を取れなかった銘柄も、株価・JPX由来の列だけで行を残す（欠損は空欄）。"""
+    return [
+        build_row(code, market_metrics[code], credit_ratios, margin_trends, sources.get(code, {}))
+        for code in codes
+    ]
+
+
+_COMPUTE_LOCK = threading.Lock()
+
+
+def compute_metrics(
+    codes: list[str],
+    as_of: date | None = None,
+    *,
+    providers: MetricsProviders | None = None,
+    warm_cache: bool = True,
+    deadline_minutes: float = 0.0,
+    trace: bool = False,
+) -> pd.DataFrame:
+    """
+    codes の指標を output_schema の型の DataFrame で返す（trace=True の場合のトレース以外は書かない）。
+    as_of は基準日（東証休業日なら直前の営業日、既定は expected_market_date()）。as_of を指定すると
+    日足はその日までで切って計算する。財務と信用倍率は取得元の最新のまま。
+    最新日の日足を検証できなかった銘柄は行に含めず、理由を attrs["errors"] に入れる。
+    attrs["expected_market_date"] に基準の営業日、attrs["skipped"] に期限で打ち切った取得を入れる。
+    期限・打ち切りの記録・トレースはモジュール全体で1つなので、同時の呼び出しは1つずつ実行する。
+    """
+    with _COMPUTE_LOCK:
+        start_run_deadline(deadline_minutes)
+        providers = providers or MetricsProviders()
+        codes = list(dict.fromkeys(normalize_code_line(code) for code in codes if normalize_code_line(code)))
+        expected_date = expected_market_date() if as_of is None else latest_xtks_session(as_of)
+        if warm_cache:
+            enable_warm_cache(expected_date)
+
+        traced = len(_TRACE_BUFFER)
+        try:
+            with trace_span("compute_metrics", tickers=len(codes), expected_market_date=expected_date.isoformat()):
+                with trace_span("yahoo", tickers=len(codes)) as span:
+                    market_metrics, errors = yahoo_market_metrics(
+                        codes, expected_date, providers.prices, through=as_of is not None
+                    )
+                    span["errors"] = len(errors)
+                valid = [code for code in codes if code in market_metrics]
+                credit_ratios, margin_trends = ({}, {})
+                if valid:
+                    with trace_span("jpx") as span:
+                        credit_ratios, margin_trends = providers.margin.fetch(expected_date, span)
+                sources = collect_fundamentals(valid, providers.fundamentals)
+                rows = build_rows(valid, market_metrics, credit_ratios, margin_trends, sources)
+        finally:
+            if trace:
+                flush_trace()
+            else:
+                # 呼び出し側の作業ディレクトリへ書かないよう、この呼び出しの span は捨てる。
+                del _TRACE_BUFFER[traced:]
+
+        frame = typed_metrics_frame(rows)
+        frame.attrs["expected_market_date"] = expected_date
+        frame.attrs["errors"] = errors
+        frame.attrs["skipped"] = list(_SKIPPED)
+        return frame
+
+
+# ====== 履歴ストア（SQLite） ======
+# 主キー (expected_market_date, code) で「ある日の全銘柄」、
+# 索引 (code, expected_market_date) で「1銘柄の期間」を全件走査せずに引く。
+HISTORY_TABLE = "metrics_history"
+_SQLITE_TYPES = {"string": "TEXT", "Int64": "INTEGER", "float64": "REAL"}
+
+
+def _history_enabled(path: str | None) -> bool:
+    return bool(path) and path != "0"
+
+
+def open_history(path: str | None = None) -> sqlite3.Connection:
+    path = HISTORY_DB if path is None else path
+    if not _history_enabled(path):
+        raise RuntimeError("HISTORY_DB が無効化されています")
+
+    connection = sqlite3.connect(path, timeout=30)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    value_columns = ",\n".join(
+        f"    {column} {_SQLITE_TYPES[dtype]}"
+        for column, dtype in output_schema().items()
+        if column != "code"
+    )
+    connection.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {HISTORY_TABLE} (
+            expected_market_date TEXT NOT NULL,
+            code TEXT NOT NULL,
+        {value_columns},
+            script_version TEXT,
+            updated_at TEXT,
+            PRIMARY KEY (expected_market_date, code)
+        ) WITHOUT ROWID
+        """
+    )
+    connection.execute(
+        f"CREATE INDEX IF NOT EXISTS {HISTORY_TABLE}_code_date "
+        f"ON {HISTORY_TABLE} (code, expected_market_date)"
+    )
+    return connection
+
+
+def _ensure_history_columns(connection: sqlite3.Connection, schema: dict[str, str]) -> None:
+    """出力列が増えたとき（指標の追加など）は列を足す。"""
+    existing = {row[1] for row in connection.execute(f"PRAGMA table_info({HISTORY_TABLE})")}
+    for column, dtype in schema.items():
+        if column not in existing:
+            connection.execute(
+                f'ALTER TABLE {HISTORY_TABLE} ADD COLUMN "{column}" {_SQLITE_TYPES[dtype]}'
+            )
+
+
+def upsert_history(
+    frame: pd.DataFrame,
+    expected_date: date | None,
+    *,
+    path: str | None = None,
+    columns: list[str] | None = None,
+) -> int:
+    """
+    typed_metrics_frame の行を履歴へ upsert する。
+    columns を絞ると、その列だけを更新し他の列は保持する。
+    expected_date が None のときは frame の expected_market_date 列を使う。
+    """
+    columns = [
+        column
+        for column in (columns or list(frame.columns))
+        if column not in ("code", "expected_market_date")
+    ]
+    schema = {column: output_schema([column])[column] for column in columns}
+    names = ["expected_market_date", "code", *columns, "script_version", "updated_at"]
+    quoted = ", ".join(f'"{name}"' for name in names)
+    placeholders = ", ".join("?" for _ in names)
+    updates = ", ".join(
+        f'"{name}" = excluded."{name}"'
+        for name in names
+        if name not in ("expected_market_date", "code")
+    )
+    updated_at = datetime.now(JST).isoformat(timespec="seconds")
+
+    records = [
+        (
+            expected_date.isoformat() if expected_date else str(record["expected_market_date"]),
+            str(record["code"]),
+            *(None if pd.isna(record[column]) else record[column] for column in columns),
+            SCRIPT_VERSION,
+            updated_at,
+        )
+        for record in frame.astype(object).to_dict("records")
+    ]
+    with closing(open_history(path)) as connection, connection:
+        _ensure_history_columns(connection, schema)
+        connection.executemany(
+            f"INSERT INTO {HISTORY_TABLE} ({quoted}) VALUES ({placeholders}) "
+            f"ON CONFLICT (expected_market_date, code) DO UPDATE SET {updates}",
+            records,
+        )
+    return len(records)
 
 
-def _normalize_jpx_security_code(value: Any) -> str:
+def query_history(
+    *,
+    code: str | None = None,
+    start: date | None = None,
+    end: date | None = None,
+    on: date | None = None,
+    columns: list[str] | None = None,
+    path: str | None = None,
+) -> pd.DataFrame:
     """
-    JPX PDFの新証券コードは、普通株式の場合
-    3674 -> 36740、215A -> 215A0 のように末尾0が付く。
-    metrics.csv/tickers.txtの4文字コードへ戻す。
+    code と期間を指定すると1銘柄の時系列、on を指定するとその日の全銘柄を返す。
+    どちらも索引で引くため履歴全体は走査しない。
     """
-    code = normalize_code_line(str(value))
-    if len(code) == 5 and code.endswith("0"):
-        return code[:-1]
-    return code
+    if code is None and on is None:
+        raise ValueError("code か on のどちらかを指定してください")
+
+    conditions: list[str] = []
+    parameters: list[Any] = []
+    if code is not None:
+        conditions.append("code = ?")
+        parameters.append(normalize_code_line(code))
+    if on is not None:
+        conditions.append("expected_market_date = ?")
+        parameters.append(on.isoformat())
+    if start is not None:
+        conditions.append("expected_market_date >= ?")
+        parameters.append(start.isoformat())
+    if end is not None:
+        conditions.append("expected_market_date <= ?")
+        parameters.append(end.isoformat())
+
+    selected = "*"
+    if columns:
+        selected = ", ".join(
+            f'"{column}"'
+            for column in dict.fromkeys(["expected_market_date", "code", *columns])
+        )
+    order = "expected_market_date" if code is not None else "code"
+    with closing(open_history(path)) as connection:
+        frame = pd.read_sql_query(
+            f"SELECT {selected} FROM {HISTORY_TABLE} "
+            f"WHERE {' AND '.join(conditions)} ORDER BY {order}",
+            connection,
+            params=parameters,
+        )
+    value_columns = [
+        column
+        for column in frame.columns
+        if column not in ("expected_market_date", "script_version", "updated_at")
+    ]
+    for column, dtype in output_schema(value_columns).items():
+        frame[column] = frame[column].astype(dtype)
+    return frame
 
 
-def _parse_jpx_pdf_text(content: bytes) -> dict[str, float]:
-    """
-    JPX週末残高PDFの本文行を直接解析する。
+def import_history_csv(csv_path: str, expected_date: date, path: str | None = None) -> int:
+    """過去の metrics.csv（git履歴など）を履歴へ取り込む。"""
+    with open(csv_path, "r", encoding="utf-8", newline="") as file:
+        header, *rows = list(csv.reader(file))
+    return upsert_history(typed_metrics_frame(rows, header), expected_date, path=path)
 
-    行の主な並び:
-      銘柄名 36740 JP... 売残高 売前週比 買残高 買前週比 ...
-    """
-    ratios: dict[str, float] = {}
 
-    line_pattern = re.compile(
-        r"(?P<code>[0-9A-Z]{5})\s+"
-        r"JP[0-9A-Z]{10}\s+"
-        r"(?P<short>[\d,]+)\s+"
-        r"(?:(?:▲|△|-)\s*)?[\d,]+\s+"
-        r"(?P<long>[\d,]+)(?:\s|$)"
-    )
+def history_command(args: argparse.Namespace) -> int:
+    if args.import_csv:
+        if not args.date:
+            print("[FATAL] --import-csv には --date が必要です", flush=True)
+            return 1
+        count = import_history_csv(args.import_csv, date.fromisoformat(args.date))
+        print(f"[OK] history imported rows={count} date={args.date}", flush=True)
+        return 0
 
-    with pdfplumber.open(io.BytesIO(content)) as pdf:
-        for page in pdf.pages:
-            page_text = page.extract_text() or ""
-            page_text = unicodedata.normalize("NFKC", page_text)
+    frame = query_history(
+        code=args.code,
+        start=date.fromisoformat(args.start) if args.start else None,
+        end=date.fromisoformat(args.end) if args.end else None,
+        on=date.fromisoformat(args.date) if args.date else None,
+        columns=args.columns.split(",") if args.columns else None,
+    )
+    if args.output:
+        frame.to_csv(args.output, index=False)
+        print(f"[OK] history rows={len(frame)} written to {args.output}", flush=True)
+    else:
+        frame.to_csv(sys.stdout, index=False)
+    return 0
 
-            for line in page_text.splitlines():
-                match = line_pattern.search(line)
-                if not match:
-                    continue
 
-                code = _normalize_jpx_security_code(match.group("code"))
-                if not re.fullmatch(r"[0-9A-Z]{4}", code):
-                    continue
+# ====== バックフィル ======
+BACKFILL_COLUMNS = [
+    "vol5",
+    "vol25",
+    "volratio_5_25",
+    "deviation_25ma_pct",
+    *(spec.name for spec in INDICATORS),
+]
+# 最長の窓に加え、休場・欠損で足りなくならない程度の余裕を持たせる。
+BACKFILL_WARMUP_SESSIONS = max([25, *(spec.window + 1 for spec in INDICATORS)]) + 15
 
-                short_balance = safe_float(match.group("short"))
-                long_balance = safe_float(match.group("long"))
-                ratio = safe_div(long_balance, short_balance)
 
-                if ratio is not None and ratio >= 0:
-                    ratios[code] = ratio
+def backfill_price_metrics(
+    codes: list[str],
+    start: date,
+    end: date,
+    *,
+    history_path: str | None = None,
+) -> pd.DataFrame:
+    """
+    start..end の各営業日について価格系指標を計算し、履歴ストアへ upsert する。
+    銘柄ごとに日足を1回取得し、rolling で全日付を一括計算する。
+    """
+    sessions = xtks_sessions_between(start, end)
+    if not sessions:
+        raise RuntimeError(f"{start.isoformat()}..{end.isoformat()} に東証営業日がありません")
+    all_sessions = load_xtks_sessions(end)
+    first_index = max(0, xtks_session_index(sessions[0]) - BACKFILL_WARMUP_SESSIONS)
+    fetch_start = all_sessions[first_index]
+
+    session_index = pd.DatetimeIndex(pd.to_datetime(sessions))
+
+    # 日足はチャンク単位で処理し、期間内の指標行だけを残す。
+    results: list[pd.DataFrame] = []
+    for chunk, frames in iter_yahoo_chunks(codes, start=fetch_start, end=sessions[-1]):
+        for code in chunk:
+            frame = frames.pop(yahoo_symbol(code), pd.DataFrame())
+            try:
+                work = _prepare_yahoo_frame(code, frame)
+            except RuntimeError as exc:
+                print(f"[WARN] backfill skipped: {exc}", flush=True)
+                continue
+            if work.index.tz is not None:
+                work.index = work.index.tz_convert(JST).tz_localize(None)
+            work.index = work.index.normalize()
 
-    if "3674" in ratios:
+            metrics = price_metric_series(work).reindex(session_index).dropna(how="all")
+            if metrics.empty:
+                continue
+            metrics["code"] = code
+            metrics["expected_market_date"] = [day.date().isoformat() for day in metrics.index]
+            results.append(metrics)
+
+    if not results:
+        raise RuntimeError("バックフィル対象の日足を取得できませんでした")
+
+    combined = pd.concat(results, ignore_index=True)
+    combined["vol5"] = combined["vol5"].astype("Int64")
+    combined["vol25"] = combined["vol25"].astype("Int64")
+    for column in BACKFILL_COLUMNS[2:]:
+        combined[column] = combined[column].round(4)
+    combined = combined[["expected_market_date", "code", *BACKFILL_COLUMNS]]
+
+    path = HISTORY_DB if history_path is None else history_path
+    if _history_enabled(path):
+        count = upsert_history(combined, None, path=path, columns=BACKFILL_COLUMNS)
         print(
-            f"[DEBUG-JPX-3674] credit_ratio={round(ratios['3674'], 4)}",
+            f"[OK] backfill upserted rows={count} codes={combined['code'].nunique()} "
+            f"sessions={combined['expected_market_date'].nunique()} db={path}",
             flush=True,
         )
-
-    return ratios
+    return combined
+
+
+# ====== スクリーニング ======
+# 条件式と並べ替えキーは DataFrame.eval で列全体に対して評価する（行ごとのループはしない）。
+# 例: where="per < 15 and roe_pct > 10 and volratio_5_25 > 1.5", sort="-deviation_25ma_pct"
+# 履歴ストアから読んだときに落とす管理用の列。
+_SCREEN_DROP_COLUMNS = ["script_version", "updated_at"]
+
+
+@dataclass(frozen=True)
+class ScreenSpec:
+    name: str
+    where: str = ""
+    # カンマ区切り。列名または式、先頭に - を付けると降順。
+    sort: str = ""
+    top: int | None = None
+    columns: tuple[str, ...] = ()
+
+
+def load_screen_specs(path: str | Path) -> list[ScreenSpec]:
+    """{"名前": {"where": ..., "sort": ..., "top": ..., "columns": [...]}, ...} を読む。"""
+    with open(path, "r", encoding="utf-8") as file:
+        data = json.load(file)
+    specs = []
+    for name, value in data.items():
+        if not re.fullmatch(r"[\w.-]+", name):
+            raise ValueError(f"スクリーニング名にはファイル名に使える文字だけを使ってください: {name!r}")
+        specs.append(
+            ScreenSpec(
+                name=name,
+                where=value.get("where", ""),
+                sort=value.get("sort", ""),
+                top=value.get("top"),
+                columns=tuple(value.get("columns", ())),
+            )
+        )
+    return specs
 
 
-def _read_pdf_tables(content: bytes) -> list[pd.DataFrame]:
-    frames: list[pd.DataFrame] = []
-    with pdfplumber.open(io.BytesIO(content)) as pdf:
-        for page in pdf.pages:
-            for table in page.extract_tables() or []:
-                if table:
-                    frames.append(pd.DataFrame(table))
-    return frames
+def _screen_key(frame: pd.DataFrame, key: str) -> pd.Series:
+    if key in frame.columns:
+        return frame[key]
+    return pd.Series(frame.eval(key), index=frame.index)
 
 
-def _read_jpx_payload(
-    url: str,
-    content_type: str,
-    content: bytes,
-) -> list[pd.DataFrame]:
-    kind = _payload_kind(url, content_type, content)
-    frames: list[pd.DataFrame] = []
+def screen_metrics(
+    frame: pd.DataFrame,
+    where: str = "",
+    sort: str = "",
+    *,
+    top: int | None = None,
+    columns: list[str] | tuple[str, ...] = (),
+) -> pd.DataFrame:
+    """where で絞り、sort の順に並べ、先頭 top 件を返す。欠損は条件を満たさず、並べ替えでは末尾。"""
+    result = frame
+    if where.strip():
+        mask = frame.eval(where)
+        if not isinstance(mask, pd.Series) or not (
+            pd.api.types.is_bool_dtype(mask) or mask.dtype == object
+        ):
+            raise ValueError(f"where は真偽値の式にしてください: {where!r}")
+        result = frame[mask.fillna(False).astype(bool)]
+
+    keys = [key.strip() for key in sort.split(",") if key.strip()]
+    if keys and not result.empty:
+        order = pd.DataFrame(
+            {f"key{index}": _screen_key(result, key.lstrip("-").strip()) for index, key in enumerate(keys)},
+            index=result.index,
+        )
+        order = order.sort_values(
+            list(order.columns),
+            ascending=[not key.startswith("-") for key in keys],
+            na_position="last",
+            kind="stable",
+        )
+        result = result.loc[order.index]
 
-    if kind == "csv":
-        for encoding in ("cp932", "utf-8-sig", "utf-8"):
-            try:
-                frames.append(
-                    pd.read_csv(
-                        io.BytesIO(content),
-                        header=None,
-                        encoding=encoding,
-                    )
-                )
-                return frames
-            except Exception:
-                continue
-        raise RuntimeError("JPX CSVを読み込めませんでした")
+    if top is not None:
+        result = result.head(top)
+    if columns:
+        result = result[list(dict.fromkeys(["code", *columns]))]
+    return result.reset_index(drop=True)
 
-    if kind == "pdf":
-        return _read_pdf_tables(content)
 
-    if kind == "zip":
-        with zipfile.ZipFile(io.BytesIO(content)) as archive:
-            for name in archive.namelist():
-                payload = archive.read(name)
-                lower_name = name.lower()
-                if lower_name.endswith((".xlsx", ".xls")):
-                    excel = pd.read_excel(
-                        io.BytesIO(payload),
-                        sheet_name=None,
-                        header=None,
-                    )
-                    frames.extend(excel.values())
-                elif lower_name.endswith(".csv"):
-                    for encoding in ("cp932", "utf-8-sig", "utf-8"):
-                        try:
-                            frames.append(
-                                pd.read_csv(
-                                    io.BytesIO(payload),
-                                    header=None,
-                                    encoding=encoding,
-                                )
-                            )
-                            break
-                        except Exception:
-                            continue
-                elif lower_name.endswith(".pdf"):
-                    frames.extend(_read_pdf_tables(payload))
-        return frames
+def latest_history_date(path: str | None = None) -> date | None:
+    with closing(open_history(path)) as connection:
+        (value,) = connection.execute(f"SELECT MAX(expected_market_date) FROM {HISTORY_TABLE}").fetchone()
+    return date.fromisoformat(value) if value else None
 
-    if kind == "excel":
-        excel = pd.read_excel(
-            io.BytesIO(content),
-            sheet_name=None,
-            header=None,
-        )
-        frames.extend(excel.values())
-        return frames
 
-    raise RuntimeError(
-        f"JPX候補のファイル形式を判定できません: "
-        f"content-type={content_type or 'unknown'} url={url}"
-    )
+def load_screen_frame(input_path: str | Path = "metrics.csv", *, on: str | None = None) -> pd.DataFrame:
+    """
+    on を指定すると履歴ストアのその日（"latest" は最新日）、無ければ metrics の出力を読む。
+    .parquet はそのまま、.csv は typed_metrics_frame と同じ型へ揃える。
+    """
+    if on:
+        day = latest_history_date() if on == "latest" else date.fromisoformat(on)
+        if day is None:
+            raise RuntimeError("履歴ストアが空です")
+        frame = query_history(on=day)
+        return frame.drop(columns=[column for column in _SCREEN_DROP_COLUMNS if column in frame.columns])
+
+    input_path = Path(input_path)
+    if input_path.suffix == ".parquet":
+        return pd.read_parquet(input_path)
+    with open(input_path, "r", encoding="utf-8", newline="") as file:
+        header, *rows = list(csv.reader(file))
+    return typed_metrics_frame(rows, header)
+
+
+def write_screen(frame: pd.DataFrame, path: str | Path) -> None:
+    """拡張子で形式を選ぶ（.parquet / .ndjson、それ以外はCSV）。"""
+    path = Path(path)
+    if path.suffix == ".parquet":
+        _atomic_write(path, lambda target: frame.to_parquet(target, index=False, compression="zstd"))
+    elif path.suffix == ".ndjson":
+        _atomic_write(path, lambda target: _write_ndjson(target, frame))
+    else:
+        _atomic_write(path, lambda target: frame.to_csv(target, index=False))
 
 
-def _header_text(frame: pd.DataFrame, row: int, column: int) -> str:
-    parts: list[str] = []
-    for offset in range(4, -1, -1):
-        source_row = row - offset
-        if source_row < 0:
-            continue
-        value = frame.iat[source_row, column]
-        if pd.isna(value):
-            continue
-        text = _norm_label(value)
-        if text:
-            parts.append(text)
-    return "".join(parts)
+def _screens_path(path: str | None = None) -> Path | None:
+    path = SCREENS_FILE if path is None else path
+    if not path or path == "0" or not Path(path).exists():
+        return None
+    return Path(path)
 
 
-def _find_jpx_columns(
+def publish_screens(
     frame: pd.DataFrame,
-) -> tuple[int, int, int, int] | None:
-    max_header_rows = min(50, len(frame))
+    specs: list[ScreenSpec],
+    directory: str | Path | None = None,
+) -> dict[str, int]:
+    """スクリーニングごとに <directory>/<名前>.csv を書き、名前 -> 行数 を返す。"""
+    directory = Path(SCREENS_DIR if directory is None else directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    counts = {}
+    for spec in specs:
+        result = screen_metrics(frame, spec.where, spec.sort, top=spec.top, columns=spec.columns)
+        write_screen(result, directory / f"{spec.name}.csv")
+        counts[spec.name] = len(result)
+    return counts
+
+
+def screen_command(args: argparse.Namespace) -> int:
+    frame = load_screen_frame(args.input, on=args.date)
+    if args.config:
+        counts = publish_screens(frame, load_screen_specs(args.config), args.output_dir)
+        for name, count in counts.items():
+            print(f"[OK] screen {name}: {count}/{len(frame)} rows", flush=True)
+        return 0
 
-    for row in range(max_header_rows):
-        headers = [
-            _header_text(frame, row, col)
-            for col in range(frame.shape[1])
-        ]
+    result = screen_metrics(
+        frame,
+        args.where or "",
+        args.sort or "",
+        top=args.top,
+        columns=args.columns.split(",") if args.columns else (),
+    )
+    if args.output:
+        write_screen(result, args.output)
+        print(f"[OK] screen rows={len(result)}/{len(frame)} written to {args.output}", flush=True)
+    else:
+        result.to_csv(sys.stdout, index=False)
+    return 0
 
-        code_candidates = [
-            col
-            for col, value in enumerate(headers)
-            if (
-                "銘柄コード" in value
-                or value.endswith("コード")
-                or value == "コード"
-                or value.lower().endswith("code")
-            )
-        ]
-        short_candidates = [
-            col
-            for col, value in enumerate(headers)
-            if any(
-                key in value
-                for key in (
-                    "売残高",
-                    "売残",
-                    "売り残高",
-                    "売り残",
-                    "short",
-                )
-            )
-        ]
-        long_candidates = [
-            col
-            for col, value in enumerate(headers)
-            if any(
-                key in value
-                for key in (
-                    "買残高",
-                    "買残",
-                    "買い残高",
-                    "買い残",
-                    "long",
-                )
-            )
-        ]
 
-        if not code_candidates or not short_candidates or not long_candidates:
-            continue
+# ====== 実行計画（ドライラン） ======
+# 通信せずに、ユニバースと設定から取得元ごとのリクエスト数・バイト数・所要時間を見積もる。
+# 1リクエストの時間とバイト数は直近 PLAN_TRACE_RUNS 回のトレースから取り、
+# 無い場合は PLAN_DEFAULTS を使う。待機は polite_sleep と同じく POLITE_SLEEP_SCALE を掛ける。
+PLAN_TRACE_RUNS = max(1, int(os.getenv("PLAN_TRACE_RUNS", "5")))
+PLAN_DEFAULTS: dict[str, tuple[float, int]] = {  # span名: (ミリ秒, バイト)
+    "universe": (1500.0, 1_200_000),
+    "yahoo.request": (400.0, 60_000),
+    "stooq.request": (400.0, 30_000),
+    "readiness": (1200.0, 0),
+    "yahoo.chunk": (8000.0, 2_000_000),
+    "irbank.csv": (350.0, 12_000),
+    "jpx.page": (500.0, 40_000),
+    "jpx.download": (2500.0, 600_000),
+}
+# 副取得元へ回る銘柄の割合。トレースに price.fetch が無いときに使う。
+PLAN_HEDGE_RATIO = 0.05
+
+
+def _recent_trace_spans(path: str, runs: int = PLAN_TRACE_RUNS) -> pd.DataFrame:
+    """直近 runs 回分の span。トレースが無ければ空の表。"""
+    if not path or path == "0" or not Path(path).exists():
+        return pd.DataFrame(columns=["run_id", "name", "duration_ms", "bytes", "path"])
+    spans = [
+        json.loads(line)
+        for line in Path(path).read_text(encoding="utf-8").splitlines()
+        if line.strip()
+    ]
+    frame = pd.DataFrame(spans)
+    for column in ("run_id", "name", "duration_ms", "bytes", "path"):
+        if column not in frame.columns:
+            frame[column] = None
+    recent = list(dict.fromkeys(frame["run_id"].dropna()))[-runs:]
+    return frame[frame["run_id"].isin(recent)]
+
+
+def _span_cost(spans: pd.DataFrame, name: str, path: str | None = None) -> dict[str, Any]:
+    """1リクエストあたりの平均・p90時間（秒）と平均バイト数。"""
+    selected = spans[spans["name"] == name]
+    if path is not None:
+        selected = selected[selected["path"] == path]
+    durations = pd.to_numeric(selected["duration_ms"], errors="coerce").dropna()
+    sizes = pd.to_numeric(selected["bytes"], errors="coerce").dropna()
+    default_ms, default_bytes = PLAN_DEFAULTS[name]
+    return {
+        "mean_s": (durations.mean() if len(durations) else default_ms) / 1000,
+        "p90_s": (durations.quantile(0.9) if len(durations) else default_ms) / 1000,
+        "bytes": float(sizes.mean()) if len(sizes) else float(default_bytes),
+        "basis": f"trace n={len(durations)}" if len(durations) else "default",
+    }
 
-        def column_score(column: int, side: str) -> tuple[int, int]:
-            value = headers[column]
-            score = 0
-            if "合計" in value or "総" in value or "total" in value.lower():
-                score += 30
-            if side == "short" and value.endswith(("売残高", "売残")):
-                score += 10
-            if side == "long" and value.endswith(("買残高", "買残")):
-                score += 10
-            if "制度" in value or "一般" in value:
-                score -= 5
-            return score, column
 
-        code_col = code_candidates[0]
-        short_col = max(
-            short_candidates,
-            key=lambda col: column_score(col, "short"),
+def _per_run_count(spans: pd.DataFrame, name: str, default: float) -> float:
+    counts = spans[spans["name"] == name].groupby("run_id").size()
+    return float(counts.mean()) if len(counts) else default
+
+
+def plan_run(codes: list[str], *, trace_path: str | None = None) -> dict[str, Any]:
+    """通常実行1回分の見積もり。取得元ごとの requests/bytes/est_s/p90_s を返す。"""
+    path = TRACE_FILE if trace_path is None else trace_path
+    if not path or path == "0":
+        path = "metrics_trace.jsonl"
+    spans = _recent_trace_spans(path)
+    count = len(codes)
+    sleep_scale = POLITE_SLEEP_SCALE
+    sources: dict[str, dict[str, Any]] = {}
+
+    def add(source: str, requests_count: float, cost: dict[str, Any], note: str = "") -> None:
+        entry = sources.setdefault(
+            source,
+            {"requests": 0.0, "bytes": 0.0, "est_s": 0.0, "p90_s": 0.0, "basis": []},
         )
-        long_col = max(
-            long_candidates,
-            key=lambda col: column_score(col, "long"),
+        entry["requests"] += requests_count
+        entry["bytes"] += requests_count * cost["bytes"]
+        entry["est_s"] += requests_count * cost["mean_s"]
+        entry["p90_s"] += requests_count * cost["p90_s"]
+        entry["basis"].append(note or cost["basis"])
+
+    universe_note = "tickers file"
+    if UNIVERSE == "jpx":
+        _, meta = _read_listed_index(UNIVERSE_CACHE)
+        try:
+            checked_at = datetime.fromisoformat(meta.get("checked_at", ""))
+            fresh = datetime.now(JST) - checked_at < timedelta(hours=UNIVERSE_MAX_AGE_HOURS)
+        except ValueError:
+            fresh = False
+        cost = _span_cost(spans, "universe")
+        universe_note = f"cache {'fresh' if fresh else 'stale'} ({cost['basis']})"
+        add("universe", 0 if fresh else 1, cost, universe_note)
+
+    chunks = math.ceil(count / YAHOO_CHUNK_SIZE)
+    price_cost = _span_cost(spans, "yahoo.request" if YAHOO_CHART_BASE_URL else "yahoo.chunk")
+    if YAHOO_CHART_BASE_URL:
+        add("yahoo", count, price_cost)
+    else:
+        add("yahoo", chunks, price_cost)
+
+    # 当日の足の確認（run_scrape と同じ条件）。試行回数と待ち時間は直近のトレースから取る。
+    if READINESS_PROBE and count > READINESS_SENTINELS:
+        sentinels = len(readiness_sentinels(codes))
+        probes = spans[spans["name"] == "readiness"]
+        attempts = pd.to_numeric(
+            probes["attempts"] if "attempts" in probes.columns else pd.Series(dtype="float64"),
+            errors="coerce",
+        ).dropna()
+        attempt_count = float(attempts.mean()) if len(attempts) else 1.0
+        probe_requests = attempt_count * (sentinels if YAHOO_CHART_BASE_URL else 1)
+        waited = _span_cost(spans, "readiness")
+        sources["readiness"] = {
+            "requests": probe_requests,
+            "bytes": probe_requests * price_cost["bytes"],
+            "est_s": waited["mean_s"],
+            "p90_s": waited["p90_s"],
+            "basis": [f"sentinels={sentinels} attempts={attempt_count:.1f} {waited['basis']}"],
+        }
+
+    # 遅い・検証に落ちた銘柄を副取得元へ回す分。割合は price.fetch の銘柄数の比から取る。
+    if len(_PRICE_PROVIDERS) > 1:
+        primary, secondary = _PRICE_PROVIDERS[0], _PRICE_PROVIDERS[1]
+        fetches = spans[spans["name"] == "price.fetch"]
+        hedge_ratio, hedge_note = PLAN_HEDGE_RATIO, f"hedge ratio={PLAN_HEDGE_RATIO:.2f} (default)"
+        if {"provider", "symbols"} <= set(fetches.columns):
+            symbols = pd.to_numeric(fetches["symbols"], errors="coerce").groupby(fetches["provider"]).sum()
+            if symbols.get(primary.name, 0) > 0:
+                hedge_ratio = float(symbols.get(secondary.name, 0)) / float(symbols[primary.name])
+                hedge_note = f"hedge ratio={hedge_ratio:.2f} (trace)"
+        hedge_cost = _span_cost(spans, f"{secondary.name}.request")
+        add(secondary.name, count * hedge_ratio, hedge_cost, f"{hedge_note} {hedge_cost['basis']}")
+
+    # fy-data-all は個別CSVで項目が欠けた銘柄だけ取得する。比率はトレースから取る。
+    irbank = spans[spans["name"] == "irbank.csv"]
+    base_codes = irbank[irbank["path"] == CSV_PL]["code"].nunique() if "code" in irbank else 0
+    all_codes = irbank[irbank["path"] == CSV_ALL]["code"].nunique() if "code" in irbank else 0
+    all_ratio = all_codes / base_codes if base_codes else 1.0
+    for csv_path in (CSV_PL, CSV_BS, CSV_DIV, CSV_PS, CSV_QQ):
+        add("irbank", count, _span_cost(spans, "irbank.csv", csv_path))
+    add("irbank", count * all_ratio, _span_cost(spans, "irbank.csv", CSV_ALL), f"fy-data-all ratio={all_ratio:.2f}")
+
+    if JPX_MARGIN_URL_OVERRIDE:
+        add("jpx", 1, _span_cost(spans, "jpx.download"))
+    else:
+        add("jpx", _per_run_count(spans, "jpx.page", 2.0), _span_cost(spans, "jpx.page"))
+        add("jpx", _per_run_count(spans, "jpx.download", 1.0), _span_cost(spans, "jpx.download"))
+
+    sleep_s = (max(0, chunks - 1) * YAHOO_CHUNK_SLEEP_SECONDS + count * ROW_SLEEP_SECONDS) * sleep_scale
+    sources["sleep"] = {
+        "requests": 0.0,
+        "bytes": 0.0,
+        "est_s": sleep_s,
+        "p90_s": sleep_s,
+        "basis": [f"POLITE_SLEEP_SCALE={sleep_scale:g}"],
+    }
+
+    total = {
+        key: sum(entry[key] for entry in sources.values())
+        for key in ("requests", "bytes", "est_s", "p90_s")
+    }
+    return {
+        "tickers": count,
+        "trace_path": path,
+        "trace_runs": int(spans["run_id"].nunique()),
+        "sources": sources,
+        "total": total,
+    }
+
+
+def plan_command(budget_minutes: float, portfolios: dict[str, Path] | None = None) -> int:
+    codes = read_codes(offline=True, portfolios=portfolios)
+    plan = plan_run(codes)
+    lists = portfolio_codes(portfolios)
+    universe = UNIVERSE
+    if lists:
+        universe = f"portfolios({','.join(lists)}) listed={sum(map(len, lists.values()))}"
+    print(
+        f"[PLAN] universe={universe} tickers={plan['tickers']} "
+        f"offset={os.getenv('OFFSET', '0')} max_tickers={os.getenv('MAX_TICKERS', '0')} "
+        f"yahoo_chunk_size={YAHOO_CHUNK_SIZE} trace_runs={plan['trace_runs']} trace={plan['trace_path']}",
+        flush=True,
+    )
+    print(f"{'source':<10}{'requests':>10}{'MiB':>10}{'est_min':>10}{'p90_min':>10}  basis")
+    for source, entry in [*plan["sources"].items(), ("total", {**plan["total"], "basis": []})]:
+        print(
+            f"{source:<10}{entry['requests']:>10.0f}{entry['bytes'] / 2**20:>10.1f}"
+            f"{entry['est_s'] / 60:>10.1f}{entry['p90_s'] / 60:>10.1f}  "
+            + ", ".join(dict.fromkeys(entry["basis"]))
         )
-        return row, code_col, short_col, long_col
 
-    return None
+    budget_s = budget_minutes * 60
+    shards = max(1, math.ceil(plan["total"]["p90_s"] / budget_s)) if budget_s > 0 else 1
+    print(
+        f"[PLAN] budget={budget_minutes:g}min shards={shards} "
+        f"max_tickers_per_shard={math.ceil(plan['tickers'] / shards) if plan['tickers'] else 0} (p90)",
+        flush=True,
+    )
+    return 0
+
+
+# ====== 常駐モード ======
+# 1プロセスで SESSION の接続プール・営業日表・当日分のキャッシュを持ち続け、
+# XTKS営業日の MARKET_DATA_READY_TIME に自分で実行する。制御はUNIXソケットへ1行で送る。
+#   refresh        当日キャッシュを使って実行（足りない分だけ取得）
+#   refresh full   キャッシュを捨てて実行
+#   status         状態・次回予定・直近の結果
+#   stop           終了
+# 実行は常に1本ずつ。ソケット側は結果が出るまで待ち、1行のJSONで返す。
+def next_scheduled_run(
+    now: datetime,
+    last_run_day: date | None,
+    retry_at: datetime | None = None,
+) -> datetime:
+    """last_run_day 以降で最初の営業日の反映時刻。当日分が未実行で時刻を過ぎていれば now。"""
+    ready = parse_ready_time(MARKET_DATA_READY_TIME)
+    for offset in range(15):
+        day = now.date() + timedelta(days=offset)
+        if day == last_run_day or not is_xtks_session(day):
+            continue
+        scheduled = max(now, datetime.combine(day, ready, JST))
+        if retry_at is not None and retry_at.date() == day:
+            scheduled = max(scheduled, retry_at)
+        return scheduled
+    raise RuntimeError("15日以内に東証営業日が見つかりません")
+
+
+def daemon_run(trigger: str, *, full: bool = False) -> dict[str, Any]:
+    """run_scrape を1回実行する。main() の通常実行と同じ後始末をする。"""
+    global TRACE_RUN_ID
+    TRACE_RUN_ID = uuid.uuid4().hex[:12]
+    now = datetime.now(JST)
+    enable_warm_cache(now.date())
+    if full:
+        clear_warm_cache()
+    started = time.perf_counter()
+    print(f"[DAEMON] run start trigger={trigger} full={full}", flush=True)
+    error = ""
+    try:
+        with trace_span("run", script_version=SCRIPT_VERSION, trigger=trigger):
+            status = run_scrape()
+    except Exception as exc:
+        error = f"{type(exc).__name__}: {exc}"
+        print(f"[FATAL] {error}", flush=True)
+        print("metrics.csvは更新していません。", flush=True)
+        status = 1
+    finally:
+        report_host_states()
+        flush_trace()
+        flush_profiles()
+    result = {
+        "status": status,
+        "trigger": trigger,
+        "started_at": now.isoformat(timespec="seconds"),
+        "seconds": round(time.perf_counter() - started, 3),
+        "run_id": TRACE_RUN_ID,
+    }
+    if error:
+        result["error"] = error
+    print(f"[DAEMON] run end {json.dumps(result, ensure_ascii=False)}", flush=True)
+    return result
+
 
+class _DaemonHandler(socketserver.StreamRequestHandler):
+    server: "_DaemonServer"
 
-def _parse_jpx_frame(frame: pd.DataFrame) -> dict[str, float]:
-    frame = frame.replace({"\n": " "}, regex=True)
-    columns = _find_jpx_columns(frame)
-    if columns is None:
-        return {}
+    def handle(self) -> None:
+        command = self.rfile.readline().decode("utf-8").strip().lower()
+        reply = self.server.control(command)
+        self.wfile.write((json.dumps(reply, ensure_ascii=False, default=str) + "\n").encode("utf-8"))
 
-    header_row, code_col, short_col, long_col = columns
-    ratios: dict[str, float] = {}
 
-    for row in range(header_row + 1, len(frame)):
-        raw_code = frame.iat[row, code_col]
-        code = _normalize_jpx_security_code(raw_code)
-        if not re.fullmatch(r"[0-9A-Z]{4}", code):
-            continue
+class _DaemonServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
 
-        short_balance = safe_float(frame.iat[row, short_col])
-        long_balance = safe_float(frame.iat[row, long_col])
-        ratio = safe_div(long_balance, short_balance)
-        if ratio is not None and ratio >= 0:
-            ratios[code] = ratio
+    def __init__(self, path: str, jobs: queue.Queue, state: dict[str, Any]) -> None:
+        super().__init__(path, _DaemonHandler)
+        self.jobs = jobs
+        self.state = state
 
-    return ratios
+    def control(self, command: str) -> dict[str, Any]:
+        if command == "status":
+            return dict(self.state)
+        if command == "stop":
+            self.jobs.put(None)
+            return {"stopping": True}
+        if command in ("refresh", "refresh full"):
+            done = threading.Event()
+            result: dict[str, Any] = {}
+            self.jobs.put((command, command.endswith("full"), done, result))
+            done.wait()
+            return result
+        return {"error": f"unknown command: {command!r} (refresh / refresh full / status / stop)"}
 
 
-def fetch_jpx_credit_ratios() -> tuple[dict[str, float], str]:
-    errors: list[str] = []
+def send_daemon_command(command: str, socket_path: str | None = None) -> dict[str, Any]:
+    with closing(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)) as client:
+        client.connect(socket_path or DAEMON_SOCKET)
+        client.sendall((command.strip() + "\n").encode("utf-8"))
+        with client.makefile("r", encoding="utf-8") as reader:
+            return json.loads(reader.readline())
+
+
+def run_daemon(socket_path: str | None = None) -> int:
+    path = Path(socket_path or DAEMON_SOCKET)
+    if path.exists():
+        try:
+            send_daemon_command("status", str(path))
+        except OSError:
+            path.unlink()  # 前回の異常終了で残ったソケット
+        else:
+            print(f"[FATAL] daemon already running: {path}", flush=True)
+            return 1
+
+    jobs: queue.Queue = queue.Queue()
+    state: dict[str, Any] = {
+        "state": "idle",
+        "pid": os.getpid(),
+        "runs": 0,
+        "last_run_day": None,
+        "next_run": None,
+        "last": None,
+    }
+    retry_at: datetime | None = None
+    server = _DaemonServer(str(path), jobs, state)
+    threading.Thread(target=server.serve_forever, name="daemon-socket", daemon=True).start()
+    signal.signal(signal.SIGTERM, lambda *_: jobs.put(None))
+    load_xtks_sessions()
+    print(f"[DAEMON] listening socket={path} ready_time={MARKET_DATA_READY_TIME}", flush=True)
 
     try:
-        candidates = discover_jpx_margin_candidates()
-        print(
-            f"[DEBUG-JPX] filtered_download_candidates={len(candidates)}",
-            flush=True,
-        )
-        for preview in candidates[:5]:
-            print(f"[DEBUG-JPX-CANDIDATE] {preview}", flush=True)
+        while True:
+            last_run_day = date.fromisoformat(state["last_run_day"]) if state["last_run_day"] else None
+            next_run = next_scheduled_run(datetime.now(JST), last_run_day, retry_at)
+            state["next_run"] = next_run.isoformat(timespec="seconds")
+            # 長く眠り込まず、1時間ごとに予定を計算し直す（営業日表の更新・時計のずれ対策）。
+            wait = min(3600.0, (next_run - datetime.now(JST)).total_seconds())
+            try:
+                job = jobs.get(timeout=max(0.0, wait))
+            except queue.Empty:
+                if datetime.now(JST) < next_run:
+                    continue
+                job = ("schedule", False, None, None)
+            if job is None:
+                break
 
-        for url in candidates:
+            trigger, full, done, reply = job
+            state["state"] = "running"
             try:
-                response = SESSION.get(url, timeout=REQUEST_TIMEOUT)
-                response.raise_for_status()
+                result = daemon_run(trigger, full=full)
+            finally:
+                state["state"] = "idle"
+            state["runs"] += 1
+            state["last"] = result
+
+            now = datetime.now(JST)
+            ready = datetime.combine(now.date(), parse_ready_time(MARKET_DATA_READY_TIME), JST)
+            if result["status"] == 0 and is_xtks_session(now.date()) and now >= ready:
+                state["last_run_day"] = now.date().isoformat()
+                retry_at = None
+            elif trigger == "schedule":
+                retry_at = now + timedelta(minutes=DAEMON_RETRY_MINUTES)
+                print(f"[DAEMON] scheduled run failed; retry at {retry_at.isoformat(timespec='seconds')}", flush=True)
+            if done is not None:
+                reply.update(result)
+                done.set()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+        path.unlink(missing_ok=True)
+        print("[DAEMON] stopped", flush=True)
+    return 0
 
-                content_type = response.headers.get("Content-Type", "").lower()
-                if any(
-                    blocked in content_type
-                    for blocked in (
-                        "text/css",
-                        "javascript",
-                        "image/",
-                        "font/",
-                    )
-                ):
-                    continue
-                if (
-                    "text/html" in content_type
-                    and _payload_kind(url, content_type, response.content)
-                    == "unknown"
-                ):
-                    continue
 
-                kind = _payload_kind(
-                    url,
-                    content_type,
-                    response.content,
-                )
+def parse_args(argv: list[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="日本株指標収集スクリプト")
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="通信せずにリクエスト数・バイト数・所要時間を見積もる",
+    )
+    parser.add_argument(
+        "--plan-budget",
+        type=float,
+        default=25.0,
+        help="--plan で分割数を決める1回あたりの持ち時間（分）",
+    )
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        default=None,
+        help="実行の持ち時間（分）。既定: RUN_DEADLINE_MINUTES",
+    )
+    parser.add_argument(
+        "--portfolio",
+        action="append",
+        default=None,
+        metavar="NAME=PATH",
+        help="名前付きの銘柄リスト（繰り返し可）。既定: PORTFOLIOS",
+    )
+    subparsers = parser.add_subparsers(dest="command")
 
-                best: dict[str, float] = {}
+    sessions_parser = subparsers.add_parser(
+        "sessions",
+        help="XTKS営業日表（xtks_sessions.txt）を再生成する",
+    )
+    sessions_parser.add_argument("--first-year", type=int, default=XTKS_SESSIONS_FIRST_YEAR)
+    sessions_parser.add_argument("--last-year", type=int, default=None)
 
-                # 現行JPX週末残高はPDF。表抽出より本文行の方が安定する。
-                if kind == "pdf":
-                    parsed_text = _parse_jpx_pdf_text(response.content)
+    trace_parser = subparsers.add_parser(
+        "trace",
+        help="トレース（JSON Lines）を段階・ホスト・銘柄別に集計する",
+    )
+    trace_parser.add_argument("--file", default=TRACE_FILE or "metrics_trace.jsonl")
+    trace_parser.add_argument("--run-id", default=None, help="既定は最新の実行")
+    trace_parser.add_argument("--top", type=int, default=10)
 
-                    if len(parsed_text) >= MIN_JPX_PARSED_ROWS:
-                        print(
-                            f"[OK] JPX credit ratios rows={len(parsed_text)} "
-                            f"source=pdf_text url={url}",
-                            flush=True,
-                        )
-                        return parsed_text, url
+    export_parser = subparsers.add_parser(
+        "export",
+        help="既存のmetrics.csvから型付き出力（OUTPUT_FORMATS）を作り直す",
+    )
+    export_parser.add_argument("--input", default="metrics.csv")
 
-                    if parsed_text:
-                        print(
-                            f"[WARN] JPX PDF text parse was too small: "
-                            f"parsed_rows={len(parsed_text)} "
-                            f"minimum={MIN_JPX_PARSED_ROWS} url={url}",
-                            flush=True,
-                        )
-                        best = parsed_text
+    history_parser = subparsers.add_parser(
+        "history",
+        help="履歴ストアを照会する（--code と期間、または --date）",
+    )
+    history_parser.add_argument("--code", help="1銘柄の時系列")
+    history_parser.add_argument("--start", help="YYYY-MM-DD")
+    history_parser.add_argument("--end", help="YYYY-MM-DD")
+    history_parser.add_argument("--date", help="その日の全銘柄 / --import-csv の基準日")
+    history_parser.add_argument("--columns", help="取得する列（カンマ区切り）")
+    history_parser.add_argument("--output", help="CSVの保存先（既定: 標準出力）")
+    history_parser.add_argument("--import-csv", help="過去のmetrics.csvを取り込む")
+
+    backfill_parser = subparsers.add_parser(
+        "backfill",
+        help="期間内の各営業日の vol5/vol25/volratio/deviation_25ma を履歴ストアへ書く",
+    )
+    backfill_parser.add_argument("--start", required=True, help="YYYY-MM-DD")
+    backfill_parser.add_argument("--end", required=True, help="YYYY-MM-DD")
+    backfill_parser.add_argument("--output", help="計算結果のCSV保存先（任意）")
 
-                # Excel/CSV/ZIPおよびPDF表抽出のフォールバック。
-                frames = _read_jpx_payload(
-                    url,
-                    content_type,
-                    response.content,
-                )
-                for frame in frames:
-                    parsed = _parse_jpx_frame(frame)
-                    if len(parsed) > len(best):
-                        best = parsed
+    margin_parser = subparsers.add_parser(
+        "margin",
+        help="JPX週末残高アーカイブへ手元のファイルを取り込む・週を一覧する",
+    )
+    margin_parser.add_argument("--import", dest="import_files", nargs="+", help="PDF/Excel/CSV/ZIP")
+    margin_parser.add_argument("--fetch", action="store_true", help="JPXの最新週を取得してアーカイブする")
+    margin_parser.add_argument("--date", help="公表日 YYYY-MM-DD（既定: ファイル名から）")
+    margin_parser.add_argument("--tail", type=int, default=12, help="表示する直近の週数")
+
+    fundamentals_parser = subparsers.add_parser(
+        "fundamentals",
+        help="財務の縦持ちストアを照会する（--code で1銘柄、既定は全銘柄の複数年指標）",
+    )
+    fundamentals_parser.add_argument("--code", help="1銘柄の (source, period, item, value)")
+    fundamentals_parser.add_argument("--item", help="--code で表示する項目（カンマ区切り、例: eps,dps）")
+    fundamentals_parser.add_argument("--years", type=int, default=FUNDAMENTAL_YEARS, help="成長率・平均の年数")
+    fundamentals_parser.add_argument("--output", help="CSVの保存先（既定: 標準出力）")
+    fundamentals_parser.add_argument(
+        "--import", dest="import_dirs", nargs="+", help="別のストアのディレクトリを取り込む"
+    )
 
-                if len(best) >= MIN_JPX_PARSED_ROWS:
-                    print(
-                        f"[OK] JPX credit ratios rows={len(best)} url={url}",
-                        flush=True,
-                    )
-                    return best, url
+    screen_parser = subparsers.add_parser(
+        "screen",
+        help="metricsの出力（または履歴ストアの1日分）を条件式で絞り込み、並べ替えて書き出す",
+    )
+    screen_parser.add_argument("--where", help='条件式（例: "per < 15 and roe_pct > 10"）')
+    screen_parser.add_argument("--sort", help="並べ替えキー（カンマ区切り、列名または式。先頭 - で降順）")
+    screen_parser.add_argument("--top", type=int, default=None, help="先頭から残す件数")
+    screen_parser.add_argument("--columns", help="出力する列（カンマ区切り、code は常に含む）")
+    screen_parser.add_argument("--input", default="metrics.csv", help=".csv または .parquet")
+    screen_parser.add_argument("--date", help="履歴ストアのその日を読む（YYYY-MM-DD または latest）")
+    screen_parser.add_argument("--output", help="保存先（.csv/.parquet/.ndjson、既定: 標準出力）")
+    screen_parser.add_argument("--config", help="名前付きスクリーニングの定義（JSON）をまとめて書き出す")
+    screen_parser.add_argument("--output-dir", default=None, help="--config の保存先（既定: SCREENS_DIR）")
+
+    daemon_parser = subparsers.add_parser(
+        "daemon",
+        help="常駐して営業日の反映時刻に実行し、UNIXソケットで refresh/status/stop を受け付ける",
+    )
+    daemon_parser.add_argument("--socket", default=None, help="既定: DAEMON_SOCKET")
+    daemon_parser.add_argument("--send", help="起動中の常駐プロセスへ送るコマンド（例: refresh）")
 
-                if best:
-                    print(
-                        f"[WARN] JPX candidate rejected: "
-                        f"parsed_rows={len(best)} minimum={MIN_JPX_PARSED_ROWS} "
-                        f"url={url}",
-                        flush=True,
-                    )
+    universe_parser = subparsers.add_parser(
+        "universe",
+        help="JPX上場銘柄一覧の索引キャッシュを更新・確認する",
+    )
+    universe_parser.add_argument("--refresh", action="store_true", help="確認間隔を無視して元ファイルを確認する")
+    universe_parser.add_argument("--segment", default=None, help="既定: UNIVERSE_SEGMENTS")
+    universe_parser.add_argument("--sector", default=None, help="既定: UNIVERSE_SECTORS")
+    universe_parser.add_argument("--output", help="選ばれたコードを tickers.txt 形式で書き出す")
 
-            except Exception as exc:
-                errors.append(
-                    f"{url}: {type(exc).__name__}: {exc}"
-                )
+    return parser.parse_args(argv)
 
-        detail = errors[-1] if errors else "解析可能な候補なし"
-        raise RuntimeError(
-            "JPX信用残高ファイルを取得・解析できませんでした。"
-            f" last={detail}"
-        )
 
-    except Exception as exc:
-        message = (
-            f"JPX credit ratios unavailable: "
-            f"{type(exc).__name__}: {exc}"
-        )
-        if STRICT_JPX:
-            raise RuntimeError(message) from exc
-        print(f"[WARN] {message}", flush=True)
-        return {}, ""
+def main(argv: list[str] | None = None) -> int:
+    args = parse_args(argv)
+    open_http_archive()
+    try:
+        return run_command(args)
+    finally:
+        close_http_archive()
+        flush_profiles()
 
 
-# ====== Main ======
-def read_codes() -> list[str]:
-    with open("tickers.txt", "r", encoding="utf-8") as file:
-        raw = [line for line in file if line.strip()]
+def _cli_portfolios(args: argparse.Namespace) -> dict[str, Path] | None:
+    return parse_portfolios(args.portfolio) if args.portfolio else None
 
-    codes = [normalize_code_line(line) for line in raw]
-    codes = [code for code in codes if code]
-    codes = list(dict.fromkeys(codes))
 
-    offset = int(os.getenv("OFFSET", "0"))
-    limit = int(os.getenv("MAX_TICKERS", "0"))
-    if limit > 0:
-        return codes[offset : offset + limit]
-    if offset > 0:
-        return codes[offset:]
-    return codes
+def run_command(args: argparse.Namespace) -> int:
+    if args.command == "sessions":
+        regenerate_xtks_sessions(
+            first_year=args.first_year,
+            last_year=args.last_year,
+        )
+        return 0
+    if args.command == "trace":
+        return summarize_trace(args.file, args.run_id, args.top)
+    if args.command == "history":
+        return history_command(args)
+    if args.command == "backfill":
+        try:
+            with trace_span("backfill", start=args.start, end=args.end):
+                result = backfill_price_metrics(
+                    read_codes(),
+                    date.fromisoformat(args.start),
+                    date.fromisoformat(args.end),
+                )
+            if args.output:
+                result.to_csv(args.output, index=False)
+            return 0
+        except Exception as exc:
+            print(f"[FATAL] {type(exc).__name__}: {exc}", flush=True)
+            return 1
+        finally:
+            report_host_states()
+            flush_trace()
+    if args.command == "daemon":
+        if args.send:
+            reply = send_daemon_command(args.send, args.socket)
+            print(json.dumps(reply, ensure_ascii=False, indent=2), flush=True)
+            return int(reply.get("status", 0) or 0) if "error" not in reply else 1
+        return run_daemon(args.socket)
+    if args.command == "margin":
+        try:
+            return margin_command(args)
+        except Exception as exc:
+            print(f"[FATAL] {type(exc).__name__}: {exc}", flush=True)
+            return 1
+    if args.command == "fundamentals":
+        try:
+            return fundamentals_command(args)
+        except Exception as exc:
+            print(f"[FATAL] {type(exc).__name__}: {exc}", flush=True)
+            return 1
+    if args.command == "screen":
+        try:
+            return screen_command(args)
+        except Exception as exc:
+            print(f"[FATAL] {type(exc).__name__}: {exc}", flush=True)
+            return 1
+    if args.command == "universe":
+        try:
+            return universe_command(args)
+        except Exception as exc:
+            print(f"[FATAL] {type(exc).__name__}: {exc}", flush=True)
+            return 1
+        finally:
+            flush_trace()
+    if args.command == "export":
+        with open(args.input, "r", encoding="utf-8", newline="") as file:
+            header, *rows = list(csv.reader(file))
+        write_metrics_atomically(rows, args.input, columns=header)
+        return 0
 
+    if args.plan:
+        try:
+            return plan_command(args.plan_budget, _cli_portfolios(args))
+        except Exception as exc:
+            print(f"[FATAL] {type(exc).__name__}: {exc}", flush=True)
+            return 1
 
-def build_row(
-    code: str,
-    market: dict[str, Any],
-    credit_ratios: dict[str, float],
-) -> list[Any]:
-    latest_price = market["latest_price"]
-    financial = fetch_financial_values(code)
+    print("[START] YAHOO_FREE_R12_20260725", flush=True)
+    try:
+        with trace_span("run", script_version=SCRIPT_VERSION):
+            return run_scrape(args.deadline, portfolios=_cli_portfolios(args))
+    except Exception as exc:
+        print(f"[FATAL] {type(exc).__name__}: {exc}", flush=True)
+        print("metrics.csvは更新していません。", flush=True)
+        return 1
+    finally:
+        report_host_states()
+        flush_trace()
 
-    per = safe_div(latest_price, financial["eps"])
-    pbr = safe_div(latest_price, financial["bps"])
-    roe_pct = financial["roe_pct"]
-    if roe_pct is None:
-        roe_pct = safe_div(
-            financial["profit"],
-            financial["equity"],
-            100.0,
-        )
-    equity_ratio_pct = financial["equity_ratio_pct"]
-    if equity_ratio_pct is None:
-        equity_ratio_pct = safe_div(
-            financial["equity"],
-            financial["assets"],
-            100.0,
-        )
-    dividend_per_share_value = financial["dps"]
-    if dividend_per_share_value is None:
-        dividend_per_share_value = market.get("trailing_dividend")
-        if dividend_per_share_value is not None:
-            print(
-                f"[DEBUG-DIVIDEND] {code} source=yahoo_ttm "
-                f"dps={dividend_per_share_value}",
-                flush=True,
-            )
 
-    dividend_yield_pct = safe_div(
-        dividend_per_share_value,
-        latest_price,
-        100.0,
-    )
-    if dividend_yield_pct is not None and not (0 <= dividend_yield_pct <= 30):
+def _best_effort(stage: str, function: Callable[[dict[str, Any]], None], **attributes: Any) -> None:
+    """
+    出力に必須でない付随処理（リスト別出力・スクリーニング・各ストア・アーカイブ）を span 付きで実行する。
+    metrics.csv の内容はこれらに依存しないため、失敗しても警告だけにして実行は失敗にしない。
+    """
+    with trace_span(stage, **attributes) as span:
+        try:
+            function(span)
+        except Exception as exc:
+            span["error"] = f"{type(exc).__name__}: {exc}"
+            print(f"[WARN] {stage} failed: {type(exc).__name__}: {exc}", flush=True)
+
+
+def run_scrape(
+    deadline_minutes: float | None = None,
+    providers: MetricsProviders | None = None,
+    portfolios: dict[str, Path] | None = None,
+) -> int:
+    start_run_deadline(deadline_minutes)
+    providers = providers or MetricsProviders()
+    lists = portfolio_codes(portfolios)
+    codes = read_codes(portfolios=portfolios)
+    print(f"[CONFIG] script_version={SCRIPT_VERSION}", flush=True)
+    if lists:
+        sizes = " ".join(f"{name}={len(members)}" for name, members in lists.items())
         print(
-            f"[WARN] {code} rejected abnormal dividend yield: "
-            f"dps={dividend_per_share_value} price={latest_price} "
-            f"yield={dividend_yield_pct}",
+            f"[CONFIG] portfolios {sizes} listed={sum(map(len, lists.values()))} unique={len(codes)}",
             flush=True,
         )
-        dividend_yield_pct = None
+    print(
+        f"[CONFIG] deviation_sign_rule={DEVIATION_SIGN_RULE} "
+        f"strict={STRICT_DEVIATION_SIGN}",
+        flush=True,
+    )
+    print(f"Total tickers to process in this shard: {len(codes)}", flush=True)
+    if time_left() is not None:
+        print(f"[CONFIG] deadline_in={time_left() + DEADLINE_RESERVE_SECONDS:.0f}s reserve={DEADLINE_RESERVE_SECONDS:.0f}s", flush=True)
 
-    op_yoy = fetch_opinc_yoy(code)
-    credit_ratio = credit_ratios.get(code)
+    if not codes:
+        print("[FATAL] tickers.txtに処理対象がありません", flush=True)
+        return 1
 
-    return [
-        code,
-        output_value(per),
-        output_value(pbr),
-        output_value(roe_pct),
-        output_value(equity_ratio_pct),
-        output_value(dividend_yield_pct),
-        output_value(op_yoy),
-        output_value(credit_ratio),
-        output_value(market["vol5"], digits=0),
-        output_value(market["vol25"], digits=0),
-        output_value(market["volratio_5_25"]),
-        output_value(market["deviation_25ma_pct"]),
-    ]
+    with trace_span("calendar") as span:
+        expected_date = expected_market_date(archive_clock())
+        span["expected_market_date"] = expected_date.isoformat()
+    print(
+        f"[CONFIG] source=YahooFinance/IRBANK-CSV/JPX "
+        f"expected_market_date={expected_date.isoformat()} "
+        f"strict_jpx={STRICT_JPX}",
+        flush=True,
+    )
 
+    # 全件取得の前に、当日の日足が出ているかを少数の銘柄で確かめる。
+    # 常駐時に全銘柄が検証済みなら確かめる必要はない。残りが見張り銘柄の数以下なら
+    # （1銘柄ずつのシャードなど）本取得の日付検証で足りるので、同じ銘柄を二度取らない。
+    pending = [code for code in codes if warm_get(("yahoo", code, expected_date)) is None]
+    if (
+        READINESS_PROBE
+        and len(pending) > READINESS_SENTINELS
+        and isinstance(providers.prices, NetworkPrices)
+    ):
+        if not wait_for_market_data(pending, expected_date):
+            print(
+                f"[FATAL] {expected_date.isoformat()}の日足がまだ出ていません。"
+                f"全銘柄の取得は行わず、metrics.csvは更新しません。",
+                flush=True,
+            )
+            return 1
 
-def write_metrics_atomically(rows: list[list[Any]]) -> None:
-    output_path = Path("metrics.csv")
-    output_directory = output_path.parent.resolve()
+    # Yahooの日付を全銘柄で先に検証する。
+    # 1件でも古ければ、IRBANK取得やmetrics.csv更新へ進まない。
+    # 日足はチャンク単位で取得・検証し、保持するのは指標の dict だけ。
+    with trace_span("yahoo", tickers=len(codes)) as span:
+        market_metrics, validation_errors = yahoo_market_metrics(codes, expected_date, providers.prices)
+        span["errors"] = len(validation_errors)
 
-    temporary_path: Path | None = None
-    try:
-        with tempfile.NamedTemporaryFile(
-            mode="w",
-            newline="",
-            encoding="utf-8",
-            dir=output_directory,
-            prefix="metrics_",
-            suffix=".tmp",
-            delete=False,
-        ) as temporary_file:
-            temporary_path = Path(temporary_file.name)
-            writer = csv.writer(temporary_file)
-            writer.writerow(OUTPUT_COLUMNS)
-            writer.writerows(rows)
-            temporary_file.flush()
-            os.fsync(temporary_file.fileno())
-
-        os.replace(temporary_path, output_path)
-        print("metrics.csv written", flush=True)
-    finally:
-        if temporary_path is not None and temporary_path.exists():
-            temporary_path.unlink(missing_ok=True)
+    if validation_errors:
+        print(
+            f"[FATAL] Yahoo Financeの最新日付を確認できない銘柄が"
+            f"{len(validation_errors)}件あります。metrics.csvは更新しません。",
+            flush=True,
+        )
+        return 1
+    # 期限で取得できなかった銘柄は出力しない（株価のない行は作れない）。
+    codes = [code for code in codes if code in market_metrics]
+    if not codes:
+        print("[FATAL] 期限までにYahoo Financeの日足を取得できた銘柄がありません", flush=True)
+        write_skipped_report(expected_date)
+        return 1
 
+    with trace_span("jpx") as span:
+        credit_ratios, margin_trends = providers.margin.fetch(expected_date, span)
 
-def main() -> int:
-    print("[START] YAHOO_FREE_R12_20260725", flush=True)
-    try:
-        codes = read_codes()
-        print(f"[CONFIG] script_version={SCRIPT_VERSION}", flush=True)
+    sources = collect_fundamentals(codes, providers.fundamentals)
+    rows = build_rows(codes, market_metrics, credit_ratios, margin_trends, sources)
+    for row in rows:
+        filled = sum(1 for value in row[1:] if value not in ("", None))
         print(
-            f"[CONFIG] deviation_sign_rule={DEVIATION_SIGN_RULE} "
-            f"strict={STRICT_DEVIATION_SIGN}",
+            f"[OK] {row[0]} filled={filled}/{len(OUTPUT_COLUMNS) - 1} "
+            f"credit={'yes' if row[0] in credit_ratios else 'no'}",
             flush=True,
         )
-        print(f"Total tickers to process in this shard: {len(codes)}", flush=True)
 
-        if not codes:
-            print("[FATAL] tickers.txtに処理対象がありません", flush=True)
-            return 1
+    with trace_span("write", rows=len(rows)):
+        write_metrics_atomically(
+            rows,
+            metadata={"expected_market_date": expected_date.isoformat()},
+        )
+    if lists:
+        def write_lists(span: dict[str, Any]) -> None:
+            counts = write_portfolio_outputs(
+                rows,
+                lists,
+                metadata={"expected_market_date": expected_date.isoformat()},
+            )
+            span["rows"] = sum(counts.values())
 
-        expected_date = expected_market_date()
+        _best_effort("portfolios", write_lists, portfolios=len(lists))
+    write_skipped_report(expected_date)
+    if _SKIPPED:
+        summary = skipped_summary()
         print(
-            f"[CONFIG] source=YahooFinance/IRBANK-CSV/JPX "
-            f"expected_market_date={expected_date.isoformat()} "
-            f"strict_jpx={STRICT_JPX}",
+            f"[DEADLINE] wrote {len(rows)} rows; skipped {summary['skipped']} fetches "
+            f"{summary['by_stage']} report={SKIPPED_REPORT}",
             flush=True,
         )
 
-        yahoo_frames = download_yahoo_all(codes)
-
-        # Yahooの日付を全銘柄で先に検証する。
-        # 1件でも古ければ、IRBANK取得やmetrics.csv更新へ進まない。
-        market_metrics: dict[str, dict[str, Any]] = {}
-        validation_errors: list[str] = []
-        for index, code in enumerate(codes, 1):
-            print(f"[{index}/{len(codes)}] {code} Yahoo validation", flush=True)
-            symbol = yahoo_symbol(code)
-            try:
-                market_metrics[code] = yahoo_metrics(
-                    code,
-                    yahoo_frames.get(symbol, pd.DataFrame()),
-                    expected_date,
-                )
-                print(
-                    f"[OK] {code} Yahoo date="
-                    f"{market_metrics[code]['latest_date'].isoformat()} "
-                    f"price={output_value(market_metrics[code]['latest_price'])}",
-                    flush=True,
-                )
-            except Exception as exc:
-                error = f"{type(exc).__name__}: {exc}"
-                validation_errors.append(error)
-                print(f"[ERROR] {error}", flush=True)
+    if _screens_path() is not None:
+        def write_screens(span: dict[str, Any]) -> None:
+            counts = publish_screens(typed_metrics_frame(rows), load_screen_specs(_screens_path()))
+            span["screens"] = len(counts)
+            print(f"[OK] screens written to {SCREENS_DIR}: {counts}", flush=True)
 
-        if validation_errors:
-            print(
-                f"[FATAL] Yahoo Financeの最新日付を確認できない銘柄が"
-                f"{len(validation_errors)}件あります。metrics.csvは更新しません。",
-                flush=True,
-            )
-            return 1
+        _best_effort("screens", write_screens)
 
-        credit_ratios, _ = fetch_jpx_credit_ratios()
+    if _fundamentals_root() is not None and isinstance(providers.fundamentals, IrbankFundamentals):
+        def store_fundamentals(span: dict[str, Any]) -> None:
+            span["rows"] = update_fundamentals_store(sources)
 
-        rows: list[list[Any]] = []
-        for index, code in enumerate(codes, 1):
-            print(f"[{index}/{len(codes)}] {code} financial metrics", flush=True)
-            row = build_row(code, market_metrics[code], credit_ratios)
-            rows.append(row)
-            filled = sum(1 for value in row[1:] if value not in ("", None))
-            print(
-                f"[OK] {code} filled={filled}/{len(OUTPUT_COLUMNS) - 1} "
-                f"credit={'yes' if code in credit_ratios else 'no'}",
-                flush=True,
-            )
-            polite_sleep(0.4)
+        _best_effort("fundamentals", store_fundamentals, tickers=len(sources))
 
-        write_metrics_atomically(rows)
-        return 0
+    if _history_enabled(HISTORY_DB):
+        def upsert(span: dict[str, Any]) -> None:
+            span["upserted"] = upsert_history(typed_metrics_frame(rows), expected_date)
+            print(f"[OK] history upserted rows={span['upserted']} db={HISTORY_DB}", flush=True)
 
-    except Exception as exc:
-        print(f"[FATAL] {type(exc).__name__}: {exc}", flush=True)
-        print("metrics.csvは更新していません。", flush=True)
-        return 1
+        _best_effort("history", upsert, rows=len(rows))
+    return 0
 
 
 if __name__ == "__main__":